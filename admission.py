@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+admission_waits = metrics.Histogram(
+    "swarm_admission_wait_seconds", "Time clusters waited for all of their agent slots to be reserved"
+)
+admitted_clusters = metrics.Counter(
+    "swarm_admitted_clusters_total", "Clusters admitted, by whether they jumped the queue", ("backfilled",)
+)
+available_slots = metrics.Gauge("swarm_admission_available_slots", "Agent slots not reserved by any cluster")
+queued_clusters = metrics.Gauge("swarm_admission_queued_clusters", "Clusters waiting to be admitted")
+
+# How long the cluster at the head of the queue lets smaller clusters behind it go first before it
+# insists on being next, so that big clusters can't be starved by a stream of small ones
+default_max_backfill_delay = 300
+
+
+class Reservation:
+    """
+    A cluster's request for agent slots. granted resolves once all of the slots have been reserved
+    for the cluster, after which the slots are given back one by one with release().
+    """
+
+    def __init__(self, controller, name, slots):
+        self.controller = controller
+        self.name = name
+        self.slots = slots
+        self.held = 0
+        self.requested_at = time.monotonic()
+        self.granted = Future()
+
+    def release(self, slots=1):
+        self.controller.release(self, slots)
+
+    def withdraw(self):
+        self.controller.withdraw(self)
+
+
+class AdmissionController:
+    """
+    Gang scheduler for agent slots.
+
+    A cluster only makes progress once all of its agents are running, and its agents only make
+    space for others once the cluster is installed. So if clusters were allowed to launch a partial
+    set of agents, they could fill all of the capacity between them and dead lock. Instead, every
+    cluster reserves all of its agent slots at once, atomically, or waits until it can.
+
+    Clusters are admitted in the order they asked, but when the cluster at the head of the queue
+    doesn't fit yet, smaller clusters behind it that do fit are admitted first (backfill), so that
+    one big cluster doesn't keep the capacity idle. Once the head has waited for max_backfill_delay
+    seconds backfilling stops until it's admitted.
+    """
+
+    def __init__(self, capacity, max_backfill_delay=default_max_backfill_delay):
+        self.capacity = capacity
+        self.available = capacity
+        self.max_backfill_delay = max_backfill_delay
+        self.logging = logging.getLogger("swarm")
+
+        self.lock = threading.Lock()
+        self.queue = []
+
+        available_slots.set_function(lambda: {(): self.available})
+        queued_clusters.set_function(lambda: {(): len(self.queue)})
+
+    def request(self, name, slots) -> Reservation:
+        """
+        Ask for slots on behalf of a cluster, returns a reservation whose granted future resolves
+        once the slots are reserved
+        """
+        if slots > self.capacity:
+            raise ValueError(f"{name} needs {slots} agent slots, more than the total capacity of {self.capacity}")
+
+        reservation = Reservation(self, name, slots)
+
+        with self.lock:
+            self.queue.append(reservation)
+            granted = self.schedule()
+
+        self.grant(granted)
+
+        return reservation
+
+    def release(self, reservation: Reservation, slots):
+        with self.lock:
+            slots = min(slots, reservation.held)
+            reservation.held -= slots
+            self.available += slots
+            granted = self.schedule()
+
+        self.grant(granted)
+
+    def withdraw(self, reservation: Reservation):
+        """
+        Give up on a reservation, whether it's still queued or already granted, e.g. because its cluster failed.
+        Its granted future resolves (to None, if it wasn't granted) and all the slots it holds are released.
+        """
+        with self.lock:
+            if reservation in self.queue:
+                self.queue.remove(reservation)
+
+        if not reservation.granted.done():
+            reservation.granted.set_result(None)
+
+        self.release(reservation, reservation.held)
+
+    def schedule(self):
+        """
+        Reserve slots for every queued cluster that can be admitted right now. Must be called with the lock held,
+        returns the newly admitted reservations, whose futures must be resolved after the lock is released.
+        """
+        granted = []
+        remaining = []
+        head = None
+
+        for reservation in self.queue:
+            if head is None and reservation.slots <= self.available:
+                pass
+            elif head is None:
+                head = reservation
+                remaining.append(reservation)
+                continue
+            elif reservation.slots > self.available or time.monotonic() - head.requested_at > self.max_backfill_delay:
+                remaining.append(reservation)
+                continue
+
+            reservation.held = reservation.slots
+            self.available -= reservation.slots
+            granted.append((reservation, head is not None))
+
+        self.queue = remaining
+
+        return granted
+
+    def grant(self, granted):
+        for reservation, backfilled in granted:
+            self.logging.info(
+                f"Admitted {reservation.name} with {reservation.slots} agent slots{' (backfilled)' if backfilled else ''}"
+            )
+            admission_waits.observe(time.monotonic() - reservation.requested_at)
+            admitted_clusters.inc(str(backfilled).lower())
+            reservation.granted.set_result(reservation)
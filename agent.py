@@ -1,25 +1,41 @@
 import logging
 import os
 import re
-import requests
 import subprocess
 import uuid
 import json
 import tempfile
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional
 
 from collections import OrderedDict
 from dataclasses import dataclass
-from pathlib import Path
-from statemachine import RetryingStateMachine
+from statemachine import RetryingStateMachine, RetryPolicy, Suspension
 from swarmexecutor import SwarmExecutor
 from swarmkubecache import SwarmKubeCache
+from bmhstatuswriter import BmhStatusWriter
 from withcontainerconfigs import WithContainerConfigs
-
+import teardown
+from ratelimit import limiter
 
 SCRIPT_DIR = Path(__file__).parent
 
+# Thousands of agents hit the hub and the service at once, so when those fail, the agents back off with
+# jitter rather than retrying in lockstep. States that can get stuck have deadlines, so that a stuck agent
+# fails and gives its slot back rather than holding it forever. Overridable through the service config,
+# see SwarmAgentConfig
+default_retry_policies = {
+    "Waiting for ISO URL on InfraEnv": RetryPolicy("decorrelated_jitter", base_delay=5, max_delay=60, deadline=3600),
+    'Seting BMH provisioning state to "ready"': RetryPolicy("decorrelated_jitter", base_delay=1, max_delay=60),
+    "Waiting for ISO URL on BMH": RetryPolicy("decorrelated_jitter", base_delay=5, max_delay=60, deadline=3600),
+    "Download ISO": RetryPolicy("decorrelated_jitter", base_delay=5, max_delay=120, deadline=1800),
+    'Seting BMH provisioning state to "provisioned"': RetryPolicy("decorrelated_jitter", base_delay=1, max_delay=60),
+    "Running agent": RetryPolicy("exponential", base_delay=5, max_delay=300, deadline=4 * 3600),
+}
+
+# How many failed attempts, across all of its states, an agent gets before it's failed
+default_failure_budget = 50
+
 
 @dataclass
 class SwarmAgentConfig:
@@ -43,7 +59,10 @@ class SwarmAgentConfig:
     shared_graphroot: Path
     k8s_api_server_url: str
     kube_cache: SwarmKubeCache
+    bmh_status_writer: BmhStatusWriter
     num_locks: int
+    retry_policies: Dict[str, RetryPolicy]
+    failure_budget: Optional[int]
 
 
 @dataclass
@@ -71,6 +90,17 @@ class Agent(RetryingStateMachine, WithContainerConfigs):
     A state machine to execute the commands for a single swarm agent
     """
 
+    checkpoint_attributes = (
+        "host_id",
+        "infraenv_iso_url",
+        "infraenv_id",
+        "bmh_iso_url",
+        "container_config",
+        "container_storage_conf",
+        "cluster_hosts_file_path",
+        "agent_pid",
+    )
+
     def __init__(
         self,
         swarm_agent_config: SwarmAgentConfig,
@@ -90,10 +120,17 @@ class Agent(RetryingStateMachine, WithContainerConfigs):
                     "Generating container configurations": self.create_container_configs,
                     "Running agent": self.run_agent,
                     "Done": self.done,
+                    "Failed": self.failed,
                 }
             ),
             logging=logging,
             name=f"Agent {cluster_agent_config.index}",
+            async_states={
+                "Waiting for ISO URL on InfraEnv": self.wait_iso_url_infraenv_async,
+                "Waiting for ISO URL on BMH": self.wait_iso_url_bmh_async,
+            },
+            retry_policies={**default_retry_policies, **swarm_agent_config.retry_policies},
+            failure_budget=swarm_agent_config.failure_budget,
         )
 
         self.swarm_agent_config = swarm_agent_config
@@ -101,6 +138,8 @@ class Agent(RetryingStateMachine, WithContainerConfigs):
 
         self.host_id = str(uuid.uuid4())
         self.identifier = cluster_agent_config.identifier
+        self.cluster_hosts_file_path = None
+        self.agent_pid = None
         self.logging = logging
 
         # Aliases
@@ -119,25 +158,40 @@ class Agent(RetryingStateMachine, WithContainerConfigs):
 
         # Endpoints
         self.service_url = swarm_agent_config.service_url
-        self.k8s_api_server_url = swarm_agent_config.k8s_api_server_url
 
         # Logging paths
         self.log_dir = self.agent_dir / "logs"
         self.agent_stdout_path = self.agent_dir / "agent.stdout.logs"
         self.agent_stderr_path = self.agent_dir / "agent.stderr.logs"
 
+    @property
+    def timeline_track(self):
+        # On the timeline, agents go right next to their cluster
+        return (self.cluster_agent_config.cluster_identifier, self.name)
+
     def initialize(self, next_state):
         for dir in (self.agent_dir, self.log_dir, self.personal_graphroot):
             dir.mkdir(parents=True, exist_ok=True)
 
         return next_state
 
+    @property
+    def download_iso_command(self):
+        return ["curl", "--insecure", "--silent", "--show-error", "--output", "/dev/null", self.bmh_iso_url]
+
     def download_iso(self, next_state):
-        self.swarm_agent_config.executor.check_call(
-            ["curl", "--insecure", "--silent", "--show-error", "--output", "/dev/null", self.bmh_iso_url]
-        )
+        limiter.acquire("service", "download")
 
-        return next_state
+        executor = self.swarm_agent_config.executor
+        download_process = executor.Popen(self.download_iso_command)
+
+        def downloaded(returncode):
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, self.download_iso_command)
+
+            return next_state
+
+        return Suspension(executor.supervise(download_process), downloaded, cancel=download_process.kill)
 
     @staticmethod
     def get_infraenv_id_from_url(url):
@@ -149,97 +203,96 @@ class Agent(RetryingStateMachine, WithContainerConfigs):
 
         raise RuntimeError("Could not find infraenv ID from url")
 
-    def wait_iso_url_infraenv(self, next_state):
-        infraenv = self.swarm_agent_config.kube_cache.get_infraenv(
-            namespace=self.cluster_agent_config.cluster_identifier, name=self.cluster_agent_config.cluster_identifier
+    @property
+    def infraenv_iso_url_condition(self):
+        return dict(
+            api_type="infraenvs",
+            namespace=self.cluster_agent_config.cluster_identifier,
+            name=self.cluster_agent_config.cluster_identifier,
+            predicate=lambda infraenv: infraenv.iso_download_url,
         )
 
-        if infraenv is not None:
-            iso_url = infraenv.get("status", {}).get("isoDownloadURL", "")
+    def wait_iso_url_infraenv(self, next_state):
+        infraenv = self.swarm_agent_config.kube_cache.wait_for(**self.infraenv_iso_url_condition)
+
+        return self.got_infraenv_iso_url(infraenv, next_state)
 
-            if iso_url == "":
-                self.logging.info("Infraenv .status.isoDownloadURL is empty")
-                return self.state
+    async def wait_iso_url_infraenv_async(self, next_state):
+        infraenv = await self.swarm_agent_config.kube_cache.wait_for_async(**self.infraenv_iso_url_condition)
 
-            self.logging.info(f"Infraenv .status.isoDownloadURL found {iso_url}")
-            self.infraenv_iso_url = iso_url
+        return self.got_infraenv_iso_url(infraenv, next_state)
 
-            self.infraenv_id = self.get_infraenv_id_from_url(self.infraenv_iso_url)
+    def got_infraenv_iso_url(self, infraenv, next_state):
+        if infraenv is None:
+            self.logging.info(
+                f"Timed out waiting for infraenv {self.cluster_agent_config.cluster_identifier}/{self.cluster_agent_config.cluster_identifier} .status.isoDownloadURL"
+            )
+            return self.state
 
-            return next_state
+        iso_url = infraenv.iso_download_url
+        self.logging.info(f"Infraenv .status.isoDownloadURL found {iso_url}")
+        self.infraenv_iso_url = iso_url
 
-        self.logging.info(
-            f"Infraenv {self.cluster_agent_config.cluster_identifier}/{self.cluster_agent_config.cluster_identifier} not found"
-        )
+        self.infraenv_id = self.get_infraenv_id_from_url(self.infraenv_iso_url)
 
-        return self.state
+        return next_state
 
-    def wait_iso_url_bmh(self, next_state):
-        baremetalhost = self.swarm_agent_config.kube_cache.get_baremetalhost(
-            namespace=self.cluster_agent_config.cluster_identifier, name=self.identifier
+    @property
+    def bmh_iso_url_condition(self):
+        return dict(
+            api_type="baremetalhosts",
+            namespace=self.cluster_agent_config.cluster_identifier,
+            name=self.identifier,
+            predicate=lambda baremetalhost: baremetalhost.image_url,
         )
 
-        if baremetalhost is not None:
-            iso_url = baremetalhost.get("spec", {}).get("image", {}).get("url", "")
+    def wait_iso_url_bmh(self, next_state):
+        baremetalhost = self.swarm_agent_config.kube_cache.wait_for(**self.bmh_iso_url_condition)
 
-            if iso_url == "":
-                self.logging.info("BMH .spec.image.url is empty")
-                return self.state
+        return self.got_bmh_iso_url(baremetalhost, next_state)
 
-            self.logging.info(f"BMH .spec.image.url found {iso_url}")
-            self.bmh_iso_url = iso_url
+    async def wait_iso_url_bmh_async(self, next_state):
+        baremetalhost = await self.swarm_agent_config.kube_cache.wait_for_async(**self.bmh_iso_url_condition)
 
-            self.infraenv_id = self.get_infraenv_id_from_url(self.infraenv_iso_url)
+        return self.got_bmh_iso_url(baremetalhost, next_state)
 
-            return next_state
+    def got_bmh_iso_url(self, baremetalhost, next_state):
+        if baremetalhost is None:
+            self.logging.info(
+                f"Timed out waiting for BMH {self.cluster_agent_config.cluster_identifier}/{self.identifier} .spec.image.url"
+            )
+            return self.state
 
-        self.logging.info(f"BMH {self.cluster_agent_config.cluster_identifier}/{self.identifier} not found")
+        iso_url = baremetalhost.image_url
+        self.logging.info(f"BMH .spec.image.url found {iso_url}")
+        self.bmh_iso_url = iso_url
 
-        return self.state
+        self.infraenv_id = self.get_infraenv_id_from_url(self.infraenv_iso_url)
 
-    def set_bmh_provisioning_state(self, provisioning_state):
+        return next_state
+
+    def set_bmh_provisioning_state(self, provisioning_state, next_state):
         baremetalhost = self.swarm_agent_config.kube_cache.get_baremetalhost(
             namespace=self.cluster_agent_config.cluster_identifier, name=self.identifier
         )
 
-        if baremetalhost is not None:
-            baremetalhost["status"] = {
-                "errorCount": 0,
-                "errorMessage": "",
-                "goodCredentials": {},
-                "hardwareProfile": "",
-                "operationalStatus": "discovered",
-                "poweredOn": True,
-                "provisioning": {"state": provisioning_state, "ID": "", "image": {"url": ""}},
-            }
-
-            response = requests.put(
-                f"{self.k8s_api_server_url}/apis/metal3.io/v1alpha1/namespaces/{self.cluster_agent_config.cluster_identifier}/baremetalhosts/{self.identifier}/status",
-                json=baremetalhost,
-                headers={"Authorization": f"Bearer {self.swarm_agent_config.token}"},
-                verify=str(self.swarm_agent_config.ca_cert_path),
-            )
-            response.raise_for_status()
-
-            return True
+        if baremetalhost is None:
+            self.logging.info(f"BMH {self.cluster_agent_config.cluster_identifier}/{self.identifier} not found")
+            return self.state
 
-        self.logging.info(f"BMH {self.cluster_agent_config.cluster_identifier}/{self.identifier} not found")
+        written = self.swarm_agent_config.bmh_status_writer.write(
+            self.cluster_agent_config.cluster_identifier, self.identifier, provisioning_state
+        )
 
-        return False
+        return Suspension(written, lambda _: next_state)
 
     def ready_bmh(self, next_state):
-        if self.set_bmh_provisioning_state("ready"):
-            return next_state
-
-        return self.state
+        return self.set_bmh_provisioning_state("ready", next_state)
 
     def provisioned_bmh(self, next_state):
-        if self.set_bmh_provisioning_state("provisioned"):
-            return next_state
-
-        return self.state
+        return self.set_bmh_provisioning_state("provisioned", next_state)
 
-    def run_agent(self, next_state):
+    def start_agent(self):
         # We place the hosts file under /var/log because it's mounted for the installer
         with tempfile.NamedTemporaryFile(
             mode="w", delete=False, dir=Path("/var/log"), prefix="agent_cluster_hosts_"
@@ -247,6 +300,9 @@ class Agent(RetryingStateMachine, WithContainerConfigs):
             cluster_hosts_file.write(json.dumps(self.cluster_agent_config.cluster_hosts))
             cluster_hosts_file_path = cluster_hosts_file.name
 
+        # Remembered so that the file can be removed when the cluster is torn down
+        self.cluster_hosts_file_path = cluster_hosts_file_path
+
         agent_environment = {
             "CONTAINERS_CONF": str(self.container_config),
             "CONTAINERS_STORAGE_CONF": str(self.container_storage_conf),
@@ -279,7 +335,7 @@ class Agent(RetryingStateMachine, WithContainerConfigs):
                 agent_stdout_file.write(
                     f"Running agent with command: {agent_command} and env {agent_environment}".encode("utf-8")
                 )
-                agent_process = self.swarm_agent_config.executor.Popen(
+                return self.swarm_agent_config.executor.Popen(
                     self.swarm_agent_config.executor.prepare_sudo_command(agent_command, agent_environment),
                     env={**os.environ, **agent_environment},
                     stdin=subprocess.DEVNULL,
@@ -287,11 +343,55 @@ class Agent(RetryingStateMachine, WithContainerConfigs):
                     stderr=agent_stderr_file,
                 )
 
-        if agent_process.wait() != 0:
-            self.logging.error(f"Agent exited with non-zero exit code {agent_process.returncode}")
+    def run_agent(self, next_state):
+        executor = self.swarm_agent_config.executor
+
+        # A resumed agent might still have its agent process running from before the swarm restarted
+        agent_exited = None
+        if self.agent_pid is not None:
+            agent_exited = executor.adopt(self.agent_pid, "agent", str(self.container_config))
+
+        if agent_exited is None:
+            # The service names the Agent CR after the host ID, its progress goes on the agent's timeline track
+            self.swarm_agent_config.kube_cache.track_object(
+                "agents", self.cluster_agent_config.cluster_identifier, self.host_id, self.timeline_track
+            )
+
+            agent_process = self.start_agent()
+            agent_exited = executor.supervise(agent_process)
+
+            self.agent_pid = agent_process.pid
+            self.checkpoint()
+
+        return Suspension(
+            agent_exited, lambda returncode: self.agent_exited(returncode, next_state), cancel=self.kill_processes
+        )
+
+    def kill_processes(self):
+        # The agent, and everything it runs, has the agent's container config in its environment
+        container_config = getattr(self, "container_config", None)
+        if container_config is not None:
+            teardown.kill_processes(teardown.find_processes(str(container_config)))
+
+    def agent_exited(self, returncode, next_state):
+        self.agent_pid = None
+
+        if returncode is None:
+            self.logging.info(f"Adopted agent process of {self.identifier} exited, its exit code is unknown")
+            return next_state
+
+        if returncode != 0:
+            self.logging.error(f"Agent exited with non-zero exit code {returncode}")
             return self.state
 
         return next_state
 
     def done(self, _):
         return self.state
+
+    def failed(self, _):
+        return self.state
+
+    def on_failure(self):
+        # Its slot is given back once its finished future completes, see Cluster.create_agents
+        self.kill_processes()
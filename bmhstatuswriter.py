@@ -0,0 +1,175 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+from kubeclient import Conflict, KubeClient, api_types
+from swarmkubecache import SwarmKubeCache
+
+write_latencies = metrics.Histogram(
+    "swarm_bmh_status_write_seconds",
+    "Time from a BMH provisioning state being asked for until it was written, by provisioning state",
+    ("state",),
+)
+status_writes = metrics.Counter(
+    "swarm_bmh_status_writes_total",
+    "BMH provisioning states asked for, by whether they were written, superseded by a newer state of the same BMH "
+    "before they were written, or failed",
+    ("result",),
+)
+status_conflicts = metrics.Counter(
+    "swarm_bmh_status_conflicts_total", "BMH status patches rejected for being made against a stale resourceVersion"
+)
+queued_writes = metrics.Gauge("swarm_bmh_status_queued", "BMHs with a provisioning state waiting to be written")
+
+# Workers, each writing one BMH at a time over its own keep-alive connection
+default_workers = 4
+
+# A conflict means our resourceVersion was stale, which is cheap to fix, so conflicts are retried right away
+max_conflict_retries = 5
+
+
+def provisioning_status(provisioning_state):
+    return {
+        "errorCount": 0,
+        "errorMessage": "",
+        "goodCredentials": {},
+        "hardwareProfile": "",
+        "operationalStatus": "discovered",
+        "poweredOn": True,
+        "provisioning": {"state": provisioning_state, "ID": "", "image": {"url": ""}},
+    }
+
+
+class BmhStatusWriter:
+    """
+    Writes the provisioning state agents want their BMHs to be in (see Agent.set_bmh_provisioning_state), in
+    place of the baremetal-operator which would normally do that.
+
+    Agents only enqueue the state they want, and get a future that's resolved once it's written. A few workers
+    write the queue, oldest BMH first, each by merge patching just the BMH's status, conditional on the
+    resourceVersion the kube cache has. A stale resourceVersion is retried right away with the BMH's current
+    one, rather than the whole agent state being retried after a delay. A BMH whose state changes again before
+    it's written is written once, with the newest state.
+    """
+
+    def __init__(self, kube_client: KubeClient, kube_cache: SwarmKubeCache, workers=default_workers):
+        self.kube_client = kube_client
+        self.kube_cache = kube_cache
+
+        self.condition = threading.Condition()
+        self.stopped = False
+
+        # (namespace, name) -> (provisioning state, when it was asked for, futures waiting for it), oldest first
+        self.pending = {}
+
+        # BMHs a worker is writing right now, which no other worker may write at the same time
+        self.writing = set()
+
+        queued_writes.set_function(lambda: {(): len(self.pending)})
+
+        self.threads = [
+            threading.Thread(target=self.run, name=f"bmh-status-writer-{index}", daemon=True)
+            for index in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def write(self, namespace, name, provisioning_state) -> Future:
+        """
+        Have the BMH's provisioning state set, returns a future that's resolved once it's written (or once a newer
+        state asked for in the meantime is written instead)
+        """
+        written = Future()
+
+        with self.condition:
+            previous = self.pending.get((namespace, name))
+            waiting = [written]
+
+            if previous is not None:
+                status_writes.inc("superseded")
+                waiting = previous[2] + waiting
+
+            # Assigning an existing key keeps its place in the queue
+            self.pending[(namespace, name)] = (provisioning_state, time.monotonic(), waiting)
+            self.condition.notify()
+
+        return written
+
+    def next_write(self):
+        with self.condition:
+            while not self.stopped:
+                # Skips at most as many BMHs as there are workers
+                key = next((key for key in self.pending if key not in self.writing), None)
+                if key is not None:
+                    self.writing.add(key)
+                    return (key, *self.pending.pop(key))
+
+                self.condition.wait()
+
+        return None
+
+    def run(self):
+        while True:
+            write = self.next_write()
+            if write is None:
+                return
+
+            (namespace, name), provisioning_state, asked_at, waiting = write
+
+            error = None
+            try:
+                self.patch(namespace, name, provisioning_state)
+            except Exception as e:
+                error = e
+                status_writes.inc("failed")
+            else:
+                status_writes.inc("written")
+                write_latencies.observe(time.monotonic() - asked_at, provisioning_state)
+            finally:
+                with self.condition:
+                    self.writing.discard((namespace, name))
+                    # The BMH may have been asked for again while it was being written
+                    self.condition.notify()
+
+            for future in waiting:
+                if error is None:
+                    future.set_result(provisioning_state)
+                else:
+                    future.set_exception(error)
+
+    def patch(self, namespace, name, provisioning_state):
+        baremetalhost = self.kube_cache.get_baremetalhost(namespace=namespace, name=name)
+        resource_version = baremetalhost.resource_version if baremetalhost is not None else None
+
+        conflicts = 0
+        while True:
+            patch = {"status": provisioning_status(provisioning_state)}
+            if resource_version is not None:
+                patch["metadata"] = {"resourceVersion": resource_version}
+
+            try:
+                self.kube_client.patch_status(api_types["baremetalhosts"], namespace, name, patch)
+                return
+            except Conflict:
+                status_conflicts.inc()
+
+                conflicts += 1
+                if conflicts > max_conflict_retries:
+                    raise
+
+            resource_version = self.kube_client.get(api_types["baremetalhosts"], namespace, name)["metadata"][
+                "resourceVersion"
+            ]
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            pending, self.pending = self.pending, {}
+            self.condition.notify_all()
+
+        for _, _, waiting in pending.values():
+            for future in waiting:
+                future.cancel()
+
+        self.kube_client.close()
@@ -1,23 +1,176 @@
 import os
+import re
+import asyncio
 import base64
-import jinja2
 import logging
 import subprocess
 import json
+import hashlib
 import tempfile
 from pathlib import Path
 from collections import OrderedDict
 
+from admission import AdmissionController
 from agent import ClusterAgentConfig, SwarmAgentConfig, Agent
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from logging import Logger
-from statemachine import RetryingStateMachine
+from statemachine import RetryingStateMachine, RetryPolicy, Suspension, all_of
 from swarmexecutor import SwarmExecutor
-from swarmkubecache import SwarmKubeCache
+from swarmkubecache import SwarmKubeCache, swarm_label
+from kubeclient import KubeClient, api_types
 from taskpool import TaskPool
+from pipeline import Pipeline
+import teardown
 from withcontainerconfigs import WithContainerConfigs
-from threading import Event
-from typing import Dict
+from journal import Journal
+import manifestrenderer
+from manifestapplier import ManifestApplier
+from typing import Dict, Optional
+
+# Overridable through the service config, see ClusterConfig
+default_retry_policies = {
+    "Applying manifests": RetryPolicy("decorrelated_jitter", base_delay=5, max_delay=120),
+    "Waiting for InfraEnv ISO URL": RetryPolicy("decorrelated_jitter", base_delay=5, max_delay=60, deadline=3600),
+    "Waiting for AgentClusterInstall clusterMetadata infraID": RetryPolicy(
+        "decorrelated_jitter", base_delay=5, max_delay=60, deadline=3600
+    ),
+    "Running controller": RetryPolicy("exponential", base_delay=5, max_delay=300, deadline=4 * 3600),
+}
+
+# How many failed attempts, across all of its states, a cluster gets before it's failed
+default_failure_budget = 50
+
+# The pipeline stages (see pipeline.py) each state runs in. From applying its manifests until it's admitted,
+# a cluster is in the lookahead window, so that a bounded amount of clusters are ready to launch their agents
+# (with their CRs reconciled and their ISO URL ready) the moment agent capacity frees up
+state_stage_names = {
+    "Generating manifests": ("render",),
+    "Applying manifests": ("lookahead", "apply"),
+    "Waiting for InfraEnv ISO URL": ("lookahead", "reconcile"),
+    "Waiting for agent capacity": ("lookahead",),
+    "Tearing down": ("teardown",),
+}
+
+
+@dataclass(frozen=True)
+class ClusterManifestsSpec:
+    """
+    Everything a cluster's manifests are rendered from, so that they can be rendered without a Cluster - e.g.
+    ahead of time, in another process (see Swarm.prerender_manifests)
+    """
+
+    swarm_identifier: str
+    index: int
+    release_image: str
+    ssh_pub_key: str
+    pull_secret: str
+    single_node: bool
+    num_workers: int
+    with_nmstate: bool
+    just_infraenv: bool
+    infraenv_labels: Dict[str, str]
+
+    @property
+    def identifier(self):
+        return f"{self.swarm_identifier}-{self.index}"
+
+    @property
+    def digest(self):
+        return hashlib.sha256(json.dumps(asdict(self), sort_keys=True).encode("utf-8")).hexdigest()
+
+    def path(self, directory: Path):
+        """
+        Where the manifests rendered from this spec are stored in the given directory, addressed by the digest of
+        the spec, so that a file is only ever picked up by a cluster it was rendered for
+        """
+        return directory / f"{self.digest}.yaml"
+
+
+def render_cluster_manifests(spec: ClusterManifestsSpec):
+    per_cluster_manifests = [
+        "namespace",
+        "secret_pull",
+        "infraenv",
+    ]
+
+    if not spec.just_infraenv:
+        per_cluster_manifests.extend(
+            (
+                "agentclusterinstall",
+                "clusterdeployment",
+                "clusterimageset",
+            )
+        )
+
+    if spec.with_nmstate:
+        per_cluster_manifests.append("nmstate")
+
+    per_agent_manifests = (
+        "baremetalhost",
+        "secret_bmh",
+    )
+
+    num_control_plane = Cluster.control_plane_count(spec.single_node)
+
+    template_params = {
+        "release_image": spec.release_image,
+        "machine_network": "10.123.0.0/16",
+        "ssh_pub_key": spec.ssh_pub_key,
+        "pull_secret_b64": base64.b64encode(spec.pull_secret.encode("utf-8")).decode("utf-8"),
+        "num_control_plane": num_control_plane,
+        "num_workers": spec.num_workers,
+        "cluster_identifier": spec.identifier,
+        "swarm_label": swarm_label,
+        "swarm_identifier": spec.swarm_identifier,
+        "single_node": spec.single_node,
+        "just_infraenv": spec.just_infraenv,
+        "infraenv_labels": json.dumps(
+            {**spec.infraenv_labels, swarm_label: spec.swarm_identifier},
+            separators=(",", ":"),
+        ),
+        "api_vip": "10.123.255.253",
+        "ingress_vip": "10.123.255.254",
+    }
+
+    all_rendered_manifests = [
+        manifestrenderer.render(manifest_name, **template_params) for manifest_name in per_cluster_manifests
+    ]
+
+    # Agents' manifests only differ in a few fields, so they're rendered in bulk
+    all_rendered_manifests.extend(
+        manifestrenderer.render_per_item(
+            per_agent_manifests,
+            template_params,
+            [
+                {
+                    "mac_address": Cluster.make_mac(spec.index, agent_index),
+                    "agent_identifier": f"{spec.identifier}-{agent_index}",
+                    "role": "master" if agent_index < num_control_plane else "worker",
+                }
+                for agent_index in range(num_control_plane + spec.num_workers)
+            ],
+        )
+    )
+
+    return "\n---\n".join(all_rendered_manifests)
+
+
+def prerender_cluster_manifests(spec: ClusterManifestsSpec, directory: Path):
+    """
+    Render the manifests of the given spec into the given directory, unless they're already there. Runs in the
+    swarm's pre-render worker processes. The file is written under a temporary name and renamed into place, so a
+    cluster either finds the whole file or none at all.
+    """
+    path = spec.path(directory)
+    if path.exists():
+        return path
+
+    with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".partial", delete=False) as partial_file:
+        partial_file.write(render_cluster_manifests(spec))
+
+    os.replace(partial_file.name, path)
+
+    return path
 
 
 @dataclass
@@ -38,14 +191,30 @@ class ClusterConfig:
     num_locks: int
     executor: SwarmExecutor
     shared_graphroot: Path
-    can_start_agents: Event
-    started_all_agents: Event
+    admission: AdmissionController
+    pipeline: Pipeline
+    kube_client: KubeClient
+    manifest_applier: ManifestApplier
+    teardown: bool
+    journal: Optional[Journal]
+    retry_policies: Dict[str, RetryPolicy]
+    failure_budget: Optional[int]
     with_nmstate: bool
     just_infraenv: bool
     infraenv_labels: Dict[str, str]
+    # Where the swarm pre-renders manifests (see Swarm.prerender_manifests), None when it doesn't
+    prerendered_manifests_dir: Optional[Path] = None
 
 
 class Cluster(RetryingStateMachine, WithContainerConfigs):
+    checkpoint_attributes = (
+        "infra_id",
+        "container_config",
+        "container_storage_conf",
+        "controller_cluster_hosts_file_path",
+        "controller_pid",
+    )
+
     def __init__(self, cluster_config: ClusterConfig, swarm_agent_config: SwarmAgentConfig):
         super().__init__(
             initial_state="Initializing",
@@ -55,16 +224,28 @@ class Cluster(RetryingStateMachine, WithContainerConfigs):
                     "Initializing": self.initialize,
                     "Generating manifests": self.generate_manifests,
                     "Applying manifests": self.apply_manifests,
+                    "Waiting for InfraEnv ISO URL": self.wait_for_infraenv_iso_url,
+                    "Waiting for agent capacity": self.wait_for_agent_capacity,
                     "Launching agents": self.launch_agents,
                     "Waiting for AgentClusterInstall clusterMetadata infraID": self.wait_for_agentclusterinstall_cluster_metadata_infraid,
                     "Generating container configurations": self.create_container_configs,
                     "Running controller": self.run_controller,
                     "Wait for agents to complete": self.wait_for_agents,
+                    "Tearing down": self.tear_down,
                     "Done": self.done,
+                    "Failed": self.failed,
                 }
             ),
             logging=logging,
             name=f"Cluster {cluster_config.index}",
+            async_states={
+                "Waiting for InfraEnv ISO URL": self.wait_for_infraenv_iso_url_async,
+                "Launching agents": self.launch_agents_async,
+                "Waiting for AgentClusterInstall clusterMetadata infraID": self.wait_for_agentclusterinstall_cluster_metadata_infraid_async,
+            },
+            retry_policies={**default_retry_policies, **cluster_config.retry_policies},
+            failure_budget=cluster_config.failure_budget,
+            state_stages=cluster_config.pipeline.state_stages(state_stage_names),
         )
 
         self.cluster_config = cluster_config
@@ -87,18 +268,60 @@ class Cluster(RetryingStateMachine, WithContainerConfigs):
             cluster_config.single_node == False or cluster_config.num_workers == 0
         ), "Cannot have single node with workers"
 
-        self.num_control_plane = 1 if cluster_config.single_node else 3
+        self.num_control_plane = self.control_plane_count(cluster_config.single_node)
         self.num_workers = cluster_config.num_workers
 
         assert (
             self.total_agents <= 2 ** 16 - 4
         ), f"Too many agents in one cluster, {self.total_agents} larger than {2**16 - 4}"
 
+        self.agents = []
+        self.reservation = None
+        self.controller_cluster_hosts_file_path = None
+        self.controller_pid = None
+
         self.controller_stdout_path = self.cluster_dir / "controller.stdout.logs"
         self.controller_stderr_path = self.cluster_dir / "controller.stderr.logs"
 
         self.logging = logging
 
+        # The service's progress with the cluster goes on the cluster's timeline track
+        for api_type in ("agentclusterinstalls", "clusterdeployments"):
+            cluster_config.kube_cache.track_object(api_type, self.identifier, self.identifier, self.timeline_track)
+
+        if cluster_config.journal is not None:
+            self.attach_journal(cluster_config.journal, self.cluster_journal_key(cluster_config.index))
+
+    def restore(self, state, values):
+        super().restore(state, values)
+
+        states = list(self.states)
+        admission_state = states.index("Waiting for agent capacity")
+
+        if states.index(state) < admission_state:
+            # Everything before admission is cheap and idempotent (and the manifests only live in memory), redo it
+            self.move_to(states[0])
+        elif admission_state < states.index(state) < states.index(self.terminal_state):
+            # The cluster's admission reservation and its agents only live in memory. The agents have their own
+            # journal entries, they just have to be created and launched again
+            self.rewind("Waiting for agent capacity")
+
+    @property
+    def timeline_track(self):
+        return (self.identifier, "Cluster")
+
+    @staticmethod
+    def cluster_journal_key(index):
+        return f"c{index}"
+
+    @staticmethod
+    def journaled_cluster_index(journal_key):
+        """
+        The index of the cluster the journal key belongs to, or None if it's not a cluster's key (e.g. an agent's)
+        """
+        match = re.fullmatch(r"c(\d+)", journal_key)
+        return int(match.group(1)) if match is not None else None
+
     def agent_directory(self, agent_index):
         return self.cluster_dir / f"agent-{agent_index}"
 
@@ -123,6 +346,14 @@ class Cluster(RetryingStateMachine, WithContainerConfigs):
             for agent_index in range(self.total_agents)
         ]
 
+    @staticmethod
+    def control_plane_count(single_node):
+        return 1 if single_node else 3
+
+    @classmethod
+    def agents_count(cls, single_node, num_workers):
+        return cls.control_plane_count(single_node) + num_workers
+
     @property
     def total_agents(self):
         return self.num_control_plane + self.num_workers
@@ -142,73 +373,40 @@ class Cluster(RetryingStateMachine, WithContainerConfigs):
         )
         return ":".join(f"{o:02x}" for o in octets)
 
-    def generate_manifests(self, next_state):
-        per_cluster_manifests = [
-            "namespace",
-            "secret_pull",
-            "infraenv",
-        ]
-
-        if not self.cluster_config.just_infraenv:
-            per_cluster_manifests.extend(
-                (
-                    "agentclusterinstall",
-                    "clusterdeployment",
-                    "clusterimageset",
-                )
-            )
-
-        if self.cluster_config.with_nmstate:
-            per_cluster_manifests.append("nmstate")
-
-        per_agent_manifests = (
-            "baremetalhost",
-            "secret_bmh",
+    @property
+    def manifests_spec(self):
+        return ClusterManifestsSpec(
+            swarm_identifier=self.cluster_config.swarm_identifier,
+            index=self.cluster_config.index,
+            release_image=self.cluster_config.release_image,
+            ssh_pub_key=self.cluster_config.ssh_pub_key,
+            pull_secret=self.cluster_config.pull_secret,
+            single_node=self.cluster_config.single_node,
+            num_workers=self.num_workers,
+            with_nmstate=self.cluster_config.with_nmstate,
+            just_infraenv=self.cluster_config.just_infraenv,
+            infraenv_labels=self.cluster_config.infraenv_labels,
         )
 
-        template_params = {
-            "release_image": self.cluster_config.release_image,
-            "machine_network": "10.123.0.0/16",
-            "ssh_pub_key": self.cluster_config.ssh_pub_key,
-            "pull_secret_b64": base64.b64encode(self.cluster_config.pull_secret.encode("utf-8")).decode("utf-8"),
-            "num_control_plane": self.num_control_plane,
-            "num_workers": self.num_workers,
-            "cluster_identifier": self.identifier,
-            "single_node": self.cluster_config.single_node,
-            "just_infraenv": self.cluster_config.just_infraenv,
-            "infraenv_labels": json.dumps(self.cluster_config.infraenv_labels, separators=(",", ":")),
-            "api_vip": "10.123.255.253",
-            "ingress_vip": "10.123.255.254",
-        }
-
-        all_rendered_manifests = []
-
-        def render(manifest_name, **extra_params):
-            with (Path("manifests") / f"{manifest_name}.yaml.j2").open() as manifest_file:
-                all_rendered_manifests.append(
-                    jinja2.Template(manifest_file.read()).render(**template_params, **extra_params)
-                )
-
-        for manifest_name in per_cluster_manifests:
-            render(manifest_name)
+    def generate_manifests(self, next_state):
+        spec = self.manifests_spec
 
-        for agent_index in range(self.total_agents):
-            for manifest_name in per_agent_manifests:
-                render(
-                    manifest_name,
-                    mac_address=self.make_mac(self.cluster_config.index, agent_index),
-                    agent_identifier=f"{self.identifier}-{agent_index}",
-                    role="master" if agent_index < self.num_control_plane else "worker",
-                )
+        prerendered = None
+        if self.cluster_config.prerendered_manifests_dir is not None:
+            prerendered = spec.path(self.cluster_config.prerendered_manifests_dir)
 
-        self.manifests = "\n---\n".join(all_rendered_manifests)
+        if prerendered is not None and prerendered.exists():
+            self.manifests = prerendered.read_text()
+        else:
+            self.manifests = render_cluster_manifests(spec)
 
         with open(self.manifest_dir / "manifests.yaml", "w") as f:
             f.write(self.manifests)
         return next_state
 
     def apply_manifests(self, next_state):
-        subprocess.run(["oc", "apply", "-f", "-"], input=self.manifests.encode("utf-8"), check=True)
+        objects, created = self.cluster_config.manifest_applier.apply(self.manifests)
+        self.logging.info(f"Cluster {self.identifier} manifests applied, {created} of their {objects} objects created")
 
         return next_state
 
@@ -218,38 +416,92 @@ class Cluster(RetryingStateMachine, WithContainerConfigs):
 
         return next_state
 
-    def launch_agents(self, next_state):
-        self.cluster_config.can_start_agents.wait()
-
-        self.agents = [
-            Agent(
-                self.swarm_agent_config,
-                ClusterAgentConfig(
-                    index=agent_index,
-                    mac_address=self.make_mac(self.cluster_config.index, agent_index),
-                    machine_ip=self.agent_ip(agent_index),
-                    machine_hostname=self.hostname(agent_index),
-                    cluster_identifier=self.identifier,
-                    cluster_dir=self.cluster_dir,
-                    identifier=f"{self.identifier}-{agent_index}",
-                    cluster_hosts=self.cluster_hosts,
-                    agent_dir=self.agent_directory(agent_index),
-                    fake_reboot_marker_path=self.dry_reboot_marker(agent_index),
-                ),
+    def create_agent(self, agent_index):
+        agent = Agent(
+            self.swarm_agent_config,
+            ClusterAgentConfig(
+                index=agent_index,
+                mac_address=self.make_mac(self.cluster_config.index, agent_index),
+                machine_ip=self.agent_ip(agent_index),
+                machine_hostname=self.hostname(agent_index),
+                cluster_identifier=self.identifier,
+                cluster_dir=self.cluster_dir,
+                identifier=f"{self.identifier}-{agent_index}",
+                cluster_hosts=self.cluster_hosts,
+                agent_dir=self.agent_directory(agent_index),
+                fake_reboot_marker_path=self.dry_reboot_marker(agent_index),
+            ),
+        )
+
+        if self.journal is not None:
+            agent.attach_journal(self.journal, f"{self.journal_key}a{agent_index}")
+
+        return agent
+
+    @property
+    def infraenv_iso_url_condition(self):
+        return dict(
+            api_type="infraenvs",
+            namespace=self.identifier,
+            name=self.identifier,
+            predicate=lambda infraenv: infraenv.iso_download_url,
+        )
+
+    def wait_for_infraenv_iso_url(self, next_state):
+        # The agents wait for it too, but by then it's already there
+        infraenv = self.cluster_config.kube_cache.wait_for(**self.infraenv_iso_url_condition)
+
+        return self.got_infraenv_iso_url(infraenv, next_state)
+
+    async def wait_for_infraenv_iso_url_async(self, next_state):
+        infraenv = await self.cluster_config.kube_cache.wait_for_async(**self.infraenv_iso_url_condition)
+
+        return self.got_infraenv_iso_url(infraenv, next_state)
+
+    def got_infraenv_iso_url(self, infraenv, next_state):
+        if infraenv is None:
+            self.logging.info(
+                f"Timed out waiting for infraenv {self.identifier}/{self.identifier} .status.isoDownloadURL"
             )
-            for agent_index in range(self.total_agents)
-        ]
+            return self.state
+
+        return next_state
+
+    def wait_for_agent_capacity(self, next_state):
+        # All agents of the cluster are admitted together, see AdmissionController
+        self.reservation = self.cluster_config.admission.request(self.identifier, self.total_agents)
+
+        return Suspension(self.reservation.granted, lambda _: next_state, cancel=self.reservation.withdraw)
+
+    def create_agents(self):
+        self.agents = [self.create_agent(agent_index) for agent_index in range(self.total_agents)]
+
+        # Every agent gives its slot back as soon as it's done
+        for agent in self.agents:
+            agent.finished.add_done_callback(lambda _: self.reservation.release(1))
+
+    def launch_agents(self, next_state):
+        self.create_agents()
 
-        self.agent_tasks = []
         for agent_index, agent in enumerate(self.agents):
             self.logging.info(f"Launching agent {agent_index}")
-            self.agent_tasks.append(self.cluster_config.task_pool.submit(agent.start))
+            self.cluster_config.task_pool.submit(agent.start, self.cluster_config.task_pool)
 
-        self.cluster_config.started_all_agents.set()
+        return self.fast_forward(next_state)
 
-        return next_state
+    async def launch_agents_async(self, next_state):
+        self.create_agents()
 
-    def run_controller(self, next_state):
+        # Agents signal their completion through their finished futures, like in the threads engine, but
+        # the tasks must be kept referenced, otherwise the event loop might garbage collect them
+        self.agent_tasks = []
+        for agent_index, agent in enumerate(self.agents):
+            self.logging.info(f"Launching agent {agent_index}")
+            self.agent_tasks.append(asyncio.create_task(agent.start_async()))
+
+        return self.fast_forward(next_state)
+
+    def start_controller(self):
         podman_environment = {
             "CONTAINERS_CONF": str(self.container_config),
             "CONTAINERS_STORAGE_CONF": str(self.container_storage_conf),
@@ -264,6 +516,8 @@ class Cluster(RetryingStateMachine, WithContainerConfigs):
             cluster_hosts_file.write(json.dumps(self.cluster_hosts))
             cluster_hosts_file_path = cluster_hosts_file.name
 
+        self.controller_cluster_hosts_file_path = cluster_hosts_file_path
+
         controller_environment = {
             "CLUSTER_ID": self.infra_id,
             "DRY_ENABLE": "true",
@@ -286,6 +540,8 @@ class Cluster(RetryingStateMachine, WithContainerConfigs):
             "--pid=host",
             "--privileged",
             "-it",
+            # Removed once it exits, so that its podman lock is freed, see tear_down
+            "--rm",
             *(f"-e={var}={value}" for var, value in controller_environment.items()),
             *(f"-v={host_path}:{container_path}" for host_path, container_path in controller_mounts.items()),
             self.cluster_config.controller_image_path,
@@ -296,7 +552,7 @@ class Cluster(RetryingStateMachine, WithContainerConfigs):
                 controller_stdout_file.write(
                     f"Running controller with command: {podman_command} and env {podman_environment}".encode("utf-8")
                 )
-                controller_process = self.cluster_config.executor.Popen(
+                return self.cluster_config.executor.Popen(
                     self.cluster_config.executor.prepare_sudo_command(podman_command, podman_environment),
                     env={**os.environ, **podman_environment},
                     stdin=subprocess.DEVNULL,
@@ -304,36 +560,156 @@ class Cluster(RetryingStateMachine, WithContainerConfigs):
                     stderr=controller_stderr_file,
                 )
 
-        if controller_process.wait() != 0:
-            self.logging.error(f"Controller exited with non-zero exit code {controller_process.returncode}")
+    def run_controller(self, next_state):
+        executor = self.cluster_config.executor
+
+        # A resumed cluster might still have its controller running from before the swarm restarted
+        controller_exited = None
+        if self.controller_pid is not None:
+            controller_exited = executor.adopt(self.controller_pid, "podman", str(self.container_config))
+
+        if controller_exited is None:
+            controller_process = self.start_controller()
+            controller_exited = executor.supervise(controller_process)
+
+            self.controller_pid = controller_process.pid
+            self.checkpoint()
+
+        return Suspension(
+            controller_exited,
+            lambda returncode: self.controller_exited(returncode, next_state),
+            cancel=self.kill_controller,
+        )
+
+    def kill_controller(self):
+        # The controller, and its container, have the cluster's container config in their environment
+        container_config = getattr(self, "container_config", None)
+        if container_config is not None:
+            teardown.kill_processes(teardown.find_processes(str(container_config)))
+
+    def controller_exited(self, returncode, next_state):
+        self.controller_pid = None
+
+        if returncode is None:
+            self.logging.info(f"Adopted controller process of {self.identifier} exited, its exit code is unknown")
+            return next_state
+
+        if returncode != 0:
+            self.logging.error(f"Controller exited with non-zero exit code {returncode}")
             return self.state
 
         return next_state
 
     def wait_for_agents(self, next_state):
-        for agent in self.agent_tasks:
-            agent.result()
+        return Suspension(
+            all_of([agent.finished for agent in self.agents]), lambda _: next_state, cancel=self.fail_agents
+        )
 
-        return next_state
+    def fail_agents(self):
+        for agent in self.agents:
+            agent.fail(f"cluster {self.identifier} failed")
 
-    def wait_for_agentclusterinstall_cluster_metadata_infraid(self, next_state):
-        agent_cluster_install = self.cluster_config.kube_cache.get_agent_cluster_install(
-            namespace=self.identifier, name=self.identifier
+    @property
+    def infra_id_condition(self):
+        return dict(
+            api_type="agentclusterinstalls",
+            namespace=self.identifier,
+            name=self.identifier,
+            predicate=lambda agent_cluster_install: agent_cluster_install.infra_id,
         )
 
-        if agent_cluster_install is not None:
-            infra_id = agent_cluster_install.get("spec", {}).get("clusterMetadata", {}).get("infraID", None)
+    def wait_for_agentclusterinstall_cluster_metadata_infraid(self, next_state):
+        agent_cluster_install = self.cluster_config.kube_cache.wait_for(**self.infra_id_condition)
+
+        return self.got_infra_id(agent_cluster_install, next_state)
+
+    async def wait_for_agentclusterinstall_cluster_metadata_infraid_async(self, next_state):
+        agent_cluster_install = await self.cluster_config.kube_cache.wait_for_async(**self.infra_id_condition)
+
+        return self.got_infra_id(agent_cluster_install, next_state)
+
+    def got_infra_id(self, agent_cluster_install, next_state):
+        if agent_cluster_install is None:
+            self.logging.info(
+                f"Timed out waiting for agent cluster install {self.identifier}/{self.identifier} clusterMetadata infraID"
+            )
+            return self.state
+
+        self.infra_id = agent_cluster_install.infra_id
 
-            if not infra_id:
-                return self.state
+        return next_state
 
-            self.infra_id = infra_id
+    def remove_containers(self):
+        """
+        Remove the containers of the cluster and of its agents from podman. Every podman instance of the swarm
+        allocates its containers' locks from the same lock segment, so containers which are left registered
+        (e.g. killed rather than exited ones) keep their locks even once their storage is deleted
+        """
+        executor = self.cluster_config.executor
+
+        for machine in (self, *self.agents):
+            container_config = getattr(machine, "container_config", None)
+            if container_config is None:
+                continue
+
+            podman_environment = {
+                "CONTAINERS_CONF": str(container_config),
+                "CONTAINERS_STORAGE_CONF": str(machine.container_storage_conf),
+            }
+            executor.check_call(
+                executor.prepare_sudo_command(["podman", "rm", "--all", "--force"], podman_environment),
+                env={**os.environ, **podman_environment},
+            )
 
+    def tear_down(self, next_state):
+        """
+        Remove everything the cluster left behind, both locally and on the hub, so that a long
+        running swarm (see soak mode) doesn't accumulate storage, podman locks and hub objects
+        """
+        if not self.cluster_config.teardown:
             return next_state
 
-        self.logging.info(f"Waiting for agent cluster install {self.identifier}/{self.identifier} to be created")
+        self.remove_containers()
+        teardown.tear_down_directory(self.cluster_dir)
 
-        return self.state
+        teardown.remove_files(
+            path
+            for path in (
+                self.controller_cluster_hosts_file_path,
+                *(agent.cluster_hosts_file_path for agent in self.agents),
+                *(self.dry_reboot_marker(agent_index) for agent_index in range(self.total_agents)),
+            )
+            if path is not None
+        )
+
+        # Deleting the namespace deletes everything in it. Deletion happens in the background,
+        # there's no need to wait for it as the next cluster has a different namespace anyway
+        self.cluster_config.kube_client.delete(api_types["namespaces"], None, self.identifier)
+        if not self.cluster_config.just_infraenv:
+            self.cluster_config.kube_client.delete(api_types["clusterimagesets"], None, self.identifier)
+
+        return next_state
 
     def done(self, _):
         return self.state
+
+    def failed(self, _):
+        return self.state
+
+    def on_failure(self):
+        self.kill_controller()
+
+        # Agents give their slots back as they finish, which failing them makes happen soon. Slots that weren't
+        # handed to agents yet are given back right away
+        self.fail_agents()
+        if self.reservation is not None and not self.agents:
+            self.reservation.withdraw()
+
+        if self.cluster_config.teardown:
+            # Only once the agents have stopped, so that nothing is torn down from under them, and in the pipeline's
+            # teardown stage, just like clusters that finish
+            self.cluster_config.pipeline.run_in_stage(
+                "teardown",
+                lambda: self.tear_down(None),
+                after=all_of([agent.finished for agent in self.agents]),
+            )
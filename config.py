@@ -1,6 +1,10 @@
+import dataclasses
 import json
 import yaml
 from pathlib import Path
+from statemachine import RetryPolicy
+from pipeline import pipeline_stages
+from ratelimit import any_verb, rate_limit_verbs
 
 
 def validate_test_plan(test_plan):
@@ -26,6 +30,84 @@ def validate_test_plan(test_plan):
             cluster["num_workers"] == 0 or not cluster["single_node"]
         ), "Cannot have more than one worker node in a single node cluster"
 
+    if "load_profile" in test_plan:
+        validate_load_profile(test_plan["load_profile"])
+
+    if "soak" in test_plan:
+        validate_soak(test_plan)
+
+    if "pipeline" in test_plan:
+        validate_pipeline(test_plan["pipeline"])
+
+
+def validate_pipeline(pipeline):
+    for stage, workers in pipeline.items():
+        if stage not in pipeline_stages:
+            raise Exception(f"Unknown pipeline stage '{stage}', choose from {pipeline_stages}")
+
+        if workers is not None and (not isinstance(workers, int) or workers < 1):
+            raise Exception(f"Pipeline stage '{stage}' must have a positive amount of workers, or null for unbounded")
+
+
+def validate_soak(test_plan):
+    soak = test_plan["soak"]
+
+    if "in_flight" not in soak:
+        raise Exception("Soak configuration must have an 'in_flight' field")
+
+    assert soak["in_flight"] > 0, "Soak mode must keep at least one cluster in flight"
+    assert soak.get("hours", 1) > 0, "Soak must last a positive amount of hours"
+
+    if "load_profile" in test_plan:
+        raise Exception("Soak mode can't be combined with a load profile")
+
+    for cluster in test_plan["clusters"]:
+        # Clusters that just populate an infraenv never finish, so they would never be recycled
+        assert not cluster.get("just_infraenv", False), "Soak mode can't run just_infraenv clusters"
+
+
+def validate_load_profile(load_profile):
+    if "type" not in load_profile:
+        raise Exception("Load profile must have a 'type' field")
+
+    profile_type = load_profile["type"]
+
+    if profile_type in ("constant", "poisson"):
+        required = ["rate"]
+    elif profile_type == "ramp":
+        required = ["start_rate", "end_rate", "ramp_minutes"]
+    elif profile_type == "step":
+        required = ["steps"]
+    else:
+        raise Exception(f"Load profile type must be one of constant, ramp, step or poisson, not '{profile_type}'")
+
+    for field in required:
+        if field not in load_profile:
+            raise Exception(f"A '{profile_type}' load profile must have a '{field}' field")
+
+    if profile_type == "step":
+        if not isinstance(load_profile["steps"], list) or len(load_profile["steps"]) == 0:
+            raise Exception("'steps' field must be a non-empty list")
+
+        for step in load_profile["steps"]:
+            if "rate" not in step or "minutes" not in step:
+                raise Exception("Each load profile step must have a 'rate' and a 'minutes' field")
+
+            assert (
+                step["rate"] >= 0 and step["minutes"] > 0
+            ), "Load profile steps must have a non-negative rate and a positive duration"
+
+        final_rate = load_profile["steps"][-1]["rate"]
+    elif profile_type == "ramp":
+        assert load_profile["start_rate"] >= 0, "Load profile ramp must start at a non-negative rate"
+        assert load_profile["ramp_minutes"] > 0, "Load profile ramp must last a positive amount of minutes"
+        final_rate = load_profile["end_rate"]
+    else:
+        final_rate = load_profile["rate"]
+
+    # The last rate lasts until all clusters are released, so it can't be 0
+    assert final_rate > 0, "The last rate of a load profile must be positive"
+
 
 def validate_service_config(service_config):
     if "service_endpoint" not in service_config:
@@ -42,6 +124,42 @@ def validate_service_config(service_config):
     if "release_image" not in service_config:
         raise Exception("Service config must have a 'release_image' field")
 
+    for kind, policies in service_config.get("retry_policies", {}).items():
+        if kind not in ("agent", "cluster"):
+            raise Exception(f"Retry policies can only be given for 'agent' and 'cluster' states, not '{kind}'")
+
+        for state, policy in policies.items():
+            unknown_fields = set(policy) - {f.name for f in dataclasses.fields(RetryPolicy)}
+            if unknown_fields:
+                raise Exception(f"Unknown fields {unknown_fields} in the retry policy of {kind} state '{state}'")
+
+    for kind, budget in service_config.get("failure_budgets", {}).items():
+        if kind not in ("agent", "cluster"):
+            raise Exception(f"Failure budgets can only be given for 'agent' and 'cluster', not '{kind}'")
+
+        if budget is not None and (not isinstance(budget, int) or budget < 0):
+            raise Exception(f"The {kind} failure budget must be a non-negative number of failed attempts, or null")
+
+    for field, value in service_config.get("manifest_apply", {}).items():
+        if field not in ("workers", "per_cluster", "chunk_size"):
+            raise Exception(f"Unknown manifest_apply field '{field}', choose from workers, per_cluster and chunk_size")
+
+        if not isinstance(value, int) or value < 1:
+            raise Exception(f"manifest_apply field '{field}' must be a positive number")
+
+    for target, limits in service_config.get("rate_limits", {}).items():
+        if target not in rate_limit_verbs:
+            raise Exception(f"Unknown rate limit target '{target}', choose from {tuple(rate_limit_verbs)}")
+
+        for verb, limit in limits.items():
+            if verb != any_verb and verb not in rate_limit_verbs[target]:
+                raise Exception(
+                    f"Unknown {target} verb '{verb}', choose from {rate_limit_verbs[target]} or '{any_verb}'"
+                )
+
+            if not limit.get("rate", 0) > 0 or not limit.get("burst", 1) >= 1:
+                raise Exception(f"The {target} {verb} rate limit must have a positive rate, and a burst of at least 1")
+
 
 def load_config(service_config, test_plan):
     with open(service_config, "r") as f:
@@ -16,6 +16,10 @@ oc get agents -A -ojson | jq '.items[].metadata | select(.namespace | test("swar
 export KUBECONFIG=/root/kubeconfig
 oc get agents -A -ojson | jq '.items[].metadata | select(.namespace | test("swarm-")).name' -r | xargs -I@ sh -c "echo @ && cat /var/log/assisted-installer-@.log | tail -1"
 
+# Tear down everything previous swarms left behind (processes, mounts, storage, /var/log files, service
+# accounts, namespaces) in parallel. The swarm does this itself when it starts. The steps below do the same by hand
+sudo KUBECONFIG=/root/kubeconfig ./teardown.py
+
 # Delete all namespaces
 export KUBECONFIG=/root/kubeconfig
 oc get namespace -A -ojson | jq '.items[] | select(.metadata.name | test("swarm"))' | oc delete -f -
@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+
+class Journal:
+    """
+    A compact, append-only, on-disk record of the progress of all of the swarm's state machines, so that
+    a swarm process that crashed or was restarted can be resumed (see main --resume) instead of redoing
+    all of its work.
+
+    Every line is a JSON object. Machine lines ({"m": key, "s": state, "v": values}) record that a machine
+    entered a state, along with the values it captured that changed since its previous line (see
+    RetryingStateMachine.checkpoint_attributes). Other lines hold swarm wide information, such as the plan.
+    Lines are written straight to the file, so they survive the swarm process dying, just not the machine.
+
+    When a journal is loaded it's compacted down to a single line per machine.
+    """
+
+    def __init__(self, path: Path, entries=None, plan=None):
+        self.path = path
+        self.logging = logging.getLogger("swarm")
+        self.lock = threading.Lock()
+
+        # Machine key -> {"state": last state, "values": all values}, for machines being resumed
+        self.entries = entries or {}
+        self.plan = plan
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = path.open("a", buffering=1)
+
+    @classmethod
+    def load(cls, path: Path):
+        entries = {}
+        plan = None
+
+        with path.open() as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line might have been cut short by the crash
+                    continue
+
+                if "plan" in record:
+                    plan = record["plan"]
+                    continue
+
+                entry = entries.setdefault(record["m"], {"state": None, "values": {}})
+                entry["state"] = record["s"]
+                entry["values"].update(record.get("v", {}))
+
+        # Compact, the rewritten file replaces the old one atomically
+        compacted_path = path.with_suffix(".compacting")
+        with compacted_path.open("w") as compacted_file:
+            if plan is not None:
+                compacted_file.write(json.dumps({"plan": plan}, separators=(",", ":")) + "\n")
+
+            for key, entry in entries.items():
+                compacted_file.write(cls.line(key, entry["state"], entry["values"]))
+
+        os.replace(compacted_path, path)
+
+        return cls(path, entries, plan)
+
+    @staticmethod
+    def line(key, state, values):
+        record = {"m": key, "s": state}
+        if values:
+            record["v"] = values
+
+        return json.dumps(record, separators=(",", ":")) + "\n"
+
+    def write(self, line):
+        with self.lock:
+            self.file.write(line)
+
+    def record(self, key, state, values):
+        self.write(self.line(key, state, values))
+
+    def record_plan(self, plan):
+        self.plan = plan
+        self.write(json.dumps({"plan": plan}, separators=(",", ":")) + "\n")
+
+    def restore(self, key, machine):
+        """
+        Restore the machine from its journal entry, if it has one. Returns whether it did.
+        """
+        entry = self.entries.get(key)
+
+        if entry is not None:
+            machine.restore(entry["state"], entry["values"])
+
+        return entry is not None
+
+    def close(self):
+        with self.lock:
+            self.file.close()
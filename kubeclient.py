@@ -0,0 +1,242 @@
+import json
+import socket
+from dataclasses import dataclass
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ratelimit import limiter
+
+
+@dataclass(frozen=True)
+class ApiType:
+    group: str
+    version: str
+    plural: str
+
+    @property
+    def path(self):
+        if self.group == "":
+            return f"/api/{self.version}/{self.plural}"
+
+        return f"/apis/{self.group}/{self.version}/{self.plural}"
+
+    def collection_path(self, namespace):
+        prefix = "/api" if self.group == "" else f"/apis/{self.group}"
+
+        if namespace is None:
+            # Cluster scoped
+            return f"{prefix}/{self.version}/{self.plural}"
+
+        return f"{prefix}/{self.version}/namespaces/{namespace}/{self.plural}"
+
+    def object_path(self, namespace, name):
+        return f"{self.collection_path(namespace)}/{name}"
+
+
+api_types = {
+    "agentclusterinstalls": ApiType("extensions.hive.openshift.io", "v1beta1", "agentclusterinstalls"),
+    "agents": ApiType("agent-install.openshift.io", "v1beta1", "agents"),
+    "baremetalhosts": ApiType("metal3.io", "v1alpha1", "baremetalhosts"),
+    "infraenvs": ApiType("agent-install.openshift.io", "v1beta1", "infraenvs"),
+    "namespaces": ApiType("", "v1", "namespaces"),
+    "clusterimagesets": ApiType("hive.openshift.io", "v1", "clusterimagesets"),
+    "clusterdeployments": ApiType("hive.openshift.io", "v1", "clusterdeployments"),
+    "nmstateconfigs": ApiType("agent-install.openshift.io", "v1beta1", "nmstateconfigs"),
+    "secrets": ApiType("", "v1", "secrets"),
+}
+
+
+class ResourceExpired(Exception):
+    """
+    Raised when the kube-api tells us (with a 410 Gone) that the resourceVersion
+    we're trying to watch from is too old, the only way to recover is to relist.
+    """
+
+
+class Conflict(Exception):
+    """
+    Raised when the kube-api rejects a write (with a 409 Conflict) because it was made against an older
+    resourceVersion of the object than its current one.
+    """
+
+
+class KubeClient:
+    """
+    A minimal in-process kube-api client. All requests go through a single pooled
+    keep-alive session, so the swarm doesn't have to fork an `oc` process (and pay
+    for its discovery / TLS handshake) every time it wants to talk to the hub.
+
+    The client is deliberately dumb - it only knows how to list, watch, create, patch and delete, which
+    is what the swarm needs. It can be pointed at any URL, including a local fake API
+    server, by passing verify=False (or a plain http:// URL).
+    """
+
+    def __init__(self, api_server_url, token, verify, pool_size=16):
+        self.api_server_url = api_server_url.rstrip("/")
+        self.verify = verify
+
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {token}"
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def url(self, path):
+        return f"{self.api_server_url}{path}"
+
+    def list(self, api_type: ApiType, params=None):
+        limiter.acquire("kube-api", "list")
+        response = self.session.get(self.url(api_type.path), params=params, verify=self.verify)
+
+        if response.status_code == 410:
+            raise ResourceExpired(response.text)
+
+        response.raise_for_status()
+        return response.json()
+
+    def get(self, api_type: ApiType, namespace, name):
+        limiter.acquire("kube-api", "get")
+        response = self.session.get(self.url(api_type.object_path(namespace, name)), verify=self.verify)
+        response.raise_for_status()
+        return response.json()
+
+    def create(self, api_type: ApiType, namespace, body):
+        """
+        Create an object (namespace None for cluster scoped objects), returns False if it already existed, in which
+        case it's left as is
+        """
+        limiter.acquire("kube-api", "create")
+        response = self.session.post(self.url(api_type.collection_path(namespace)), json=body, verify=self.verify)
+
+        if response.status_code == 409 and response.json().get("reason") == "AlreadyExists":
+            return False
+
+        response.raise_for_status()
+        return True
+
+    def patch_status(self, api_type: ApiType, namespace, name, patch):
+        """
+        JSON merge patch the status subresource of an object, returns the patched object. A resourceVersion in the
+        patch's metadata makes the patch conditional on the object still being at that version
+        """
+        limiter.acquire("kube-api", "patch")
+        response = self.session.patch(
+            self.url(f"{api_type.object_path(namespace, name)}/status"),
+            data=json.dumps(patch),
+            headers={"Content-Type": "application/merge-patch+json"},
+            verify=self.verify,
+        )
+
+        if response.status_code == 409:
+            raise Conflict(response.text)
+
+        response.raise_for_status()
+        return response.json()
+
+    def delete(self, api_type: ApiType, namespace, name):
+        """
+        Delete an object (namespace None for cluster scoped objects), returns False if it was already gone.
+        Doesn't wait for the object to actually disappear, which for namespaces can take a while.
+        """
+        limiter.acquire("kube-api", "delete")
+        response = self.session.delete(self.url(api_type.object_path(namespace, name)), verify=self.verify)
+
+        if response.status_code == 404:
+            return False
+
+        response.raise_for_status()
+        return True
+
+    def list_pages(self, api_type: ApiType, label_selector=None, limit=500):
+        """
+        Generator of list pages, each holding at most `limit` objects. The kube-api serves all
+        pages of a single list from the same consistent snapshot, so the last page's
+        resourceVersion is a valid starting point for a watch.
+        """
+        params = {"limit": str(limit)}
+        if label_selector is not None:
+            params["labelSelector"] = label_selector
+
+        while True:
+            page = self.list(api_type, params=params)
+            yield page
+
+            continue_token = page["metadata"].get("continue")
+            if not continue_token:
+                return
+
+            params["continue"] = continue_token
+
+    def watch(self, api_type: ApiType, resource_version, label_selector=None, timeout_seconds=300, on_response=None):
+        """
+        Generator of watch events (dictionaries with "type" and "object" keys) starting
+        after the given resourceVersion. The generator ends when the server closes the
+        stream (normally after timeout_seconds), at which point the caller is expected
+        to watch again from the last resourceVersion it saw.
+
+        on_response is called with the streaming response before any event is read, to
+        allow the caller to close it from another thread.
+        """
+        params = {
+            "watch": "true",
+            "resourceVersion": resource_version,
+            "allowWatchBookmarks": "true",
+            "timeoutSeconds": str(timeout_seconds),
+        }
+        if label_selector is not None:
+            params["labelSelector"] = label_selector
+
+        limiter.acquire("kube-api", "watch")
+
+        with self.session.get(
+            self.url(api_type.path),
+            params=params,
+            verify=self.verify,
+            stream=True,
+            # Give the server some slack over its own timeout before we consider the connection dead
+            timeout=(30, timeout_seconds + 30),
+        ) as response:
+            if response.status_code == 410:
+                raise ResourceExpired(response.text)
+
+            response.raise_for_status()
+
+            if on_response is not None:
+                on_response(response)
+
+            for line in response.iter_lines():
+                if not line:
+                    continue
+
+                event = json.loads(line)
+
+                if event["type"] == "ERROR":
+                    status = event.get("object", {})
+                    if status.get("code") == 410:
+                        raise ResourceExpired(status.get("message", ""))
+
+                    raise RuntimeError(f"Watch error: {status}")
+
+                yield event
+
+    @staticmethod
+    def interrupt(response):
+        """
+        Interrupt a streaming response that another thread might be blocked reading from.
+        Simply closing the response doesn't wake up a blocked reader, shutting down the
+        underlying socket does.
+        """
+        connection = getattr(response.raw, "connection", None)
+        sock = getattr(connection, "sock", None)
+
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        response.close()
+
+    def close(self):
+        self.session.close()
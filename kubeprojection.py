@@ -0,0 +1,132 @@
+import sys
+
+
+def dig(api_object, path, default=None):
+    """
+    Follow a path of keys into a nested kube-api object, returning default if any of them is missing
+    """
+    for key in path:
+        if not isinstance(api_object, dict) or key not in api_object:
+            return default
+
+        api_object = api_object[key]
+
+    return api_object
+
+
+def intern_or_none(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ProjectedObject:
+    """
+    A compact, read-only projection of a kube-api object which only holds the handful of fields
+    the swarm actually reads. Full kube-api objects carry managedFields, status conditions,
+    debug info and so on - keeping thousands of those around is a waste of memory when all
+    we ever look at is a URL or an ID.
+
+    Subclasses declare the fields they keep in `fields`, a mapping from attribute name to the
+    path of keys leading to that field in the full object. Every attribute must also be listed
+    in the subclass __slots__.
+    """
+
+    __slots__ = ("namespace", "name", "resource_version", "labels")
+
+    # The object's kube kind, and the fields kept from it
+    kind = None
+    fields = {}
+
+    def __init__(self, api_object):
+        metadata = api_object["metadata"]
+
+        # Namespaces and label keys repeat across many objects, interning lets them share memory
+        self.namespace = sys.intern(metadata["namespace"])
+        self.name = metadata["name"]
+        self.resource_version = metadata["resourceVersion"]
+        self.labels = tuple(
+            (sys.intern(key), intern_or_none(value)) for key, value in metadata.get("labels", {}).items()
+        )
+
+        for attribute, path in self.fields.items():
+            setattr(self, attribute, dig(api_object, path))
+
+    @property
+    def key(self):
+        return f"{self.namespace}/{self.name}"
+
+    def __repr__(self):
+        attributes = ", ".join(f"{attribute}={getattr(self, attribute)!r}" for attribute in ("key", *self.fields))
+        return f"{type(self).__name__}({attributes})"
+
+
+class ConditionedObject(ProjectedObject):
+    """
+    A projection which also keeps the object's status conditions, as (type, status) pairs, so that the cache can
+    tell when they change (see SwarmKubeCache.record_transitions)
+    """
+
+    __slots__ = ("conditions",)
+
+    def __init__(self, api_object):
+        super().__init__(api_object)
+
+        self.conditions = tuple(
+            (sys.intern(condition.get("type", "")), intern_or_none(condition.get("status")))
+            for condition in dig(api_object, ("status", "conditions"), default=None) or ()
+        )
+
+    def condition_states(self):
+        """
+        The (type, status) pairs the object is currently in. Subclasses add pairs of their own for interesting fields
+        """
+        return self.conditions
+
+
+class InfraEnvProjection(ProjectedObject):
+    __slots__ = ("iso_download_url",)
+
+    kind = "InfraEnv"
+    fields = {"iso_download_url": ("status", "isoDownloadURL")}
+
+
+class BareMetalHostProjection(ProjectedObject):
+    __slots__ = ("image_url",)
+
+    kind = "BareMetalHost"
+    fields = {"image_url": ("spec", "image", "url")}
+
+
+class AgentClusterInstallProjection(ConditionedObject):
+    __slots__ = ("infra_id",)
+
+    kind = "AgentClusterInstall"
+    fields = {"infra_id": ("spec", "clusterMetadata", "infraID")}
+
+
+class AgentProjection(ConditionedObject):
+    __slots__ = ("approved",)
+
+    kind = "Agent"
+    fields = {"approved": ("spec", "approved")}
+
+    def condition_states(self):
+        return (*self.conditions, ("Approved", str(bool(self.approved))))
+
+
+class ClusterDeploymentProjection(ConditionedObject):
+    __slots__ = ("installed",)
+
+    kind = "ClusterDeployment"
+    fields = {"installed": ("spec", "installed")}
+
+    def condition_states(self):
+        return (*self.conditions, ("Installed", str(bool(self.installed))))
+
+
+projections = {
+    "agentclusterinstalls": AgentClusterInstallProjection,
+    "agents": AgentProjection,
+    "baremetalhosts": BareMetalHostProjection,
+    "clusterdeployments": ClusterDeploymentProjection,
+    "infraenvs": InfraEnvProjection,
+}
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import math
+import random
+import time
+
+import metrics
+
+target_releases = metrics.Gauge(
+    "swarm_load_profile_target_clusters", "Clusters the load profile expected to have released by now"
+)
+actual_releases = metrics.Gauge("swarm_load_profile_released_clusters", "Clusters actually released so far")
+release_lag = metrics.Histogram(
+    "swarm_load_profile_release_lag_seconds", "How late clusters were released relative to the load profile schedule"
+)
+
+seconds_per_hour = 3600
+
+
+class LoadProfile:
+    """
+    The schedule by which clusters of the test plan are released, defined by an arrival rate that changes
+    over time. The rate is given as a list of segments, each lasting some duration during which the rate
+    changes linearly from its start rate to its end rate (equal for a constant segment), followed by a
+    final rate which applies forever after the last segment. All rates are in clusters per second.
+
+    Arrivals are either evenly spaced according to the rate, or (with poisson=True) follow a Poisson
+    process with that (possibly time varying) rate.
+    """
+
+    def __init__(self, segments, final_rate, poisson=False, seed=None):
+        assert final_rate > 0, "The final rate of a load profile must be positive, otherwise it would never end"
+
+        self.segments = segments
+        self.final_rate = final_rate
+        self.poisson = poisson
+        self.random = random.Random(seed)
+
+    @classmethod
+    def from_config(cls, load_profile):
+        """
+        Build a profile from the test plan's load_profile section, where rates are in clusters per hour
+        and durations are in minutes
+        """
+
+        def per_second(rate):
+            return rate / seconds_per_hour
+
+        profile_type = load_profile["type"]
+        poisson = load_profile.get("poisson", profile_type == "poisson")
+        seed = load_profile.get("seed", None)
+
+        if profile_type in ("constant", "poisson"):
+            return cls([], per_second(load_profile["rate"]), poisson, seed)
+
+        if profile_type == "ramp":
+            return cls(
+                [
+                    (
+                        load_profile["ramp_minutes"] * 60,
+                        per_second(load_profile["start_rate"]),
+                        per_second(load_profile["end_rate"]),
+                    )
+                ],
+                per_second(load_profile["end_rate"]),
+                poisson,
+                seed,
+            )
+
+        if profile_type == "step":
+            steps = load_profile["steps"]
+            return cls(
+                [(step["minutes"] * 60, per_second(step["rate"]), per_second(step["rate"])) for step in steps],
+                per_second(steps[-1]["rate"]),
+                poisson,
+                seed,
+            )
+
+        raise ValueError(f"Unknown load profile type {profile_type}")
+
+    def expected_arrivals(self, elapsed):
+        """
+        The number of clusters the rate calls for in the first `elapsed` seconds (the integral of the rate)
+        """
+        arrivals = 0.0
+
+        for duration, start_rate, end_rate in self.segments:
+            if elapsed <= duration:
+                return arrivals + start_rate * elapsed + (end_rate - start_rate) * elapsed**2 / (2 * duration)
+
+            arrivals += (start_rate + end_rate) * duration / 2
+            elapsed -= duration
+
+        return arrivals + self.final_rate * elapsed
+
+    def time_of(self, arrivals):
+        """
+        The inverse of expected_arrivals - when does the rate add up to the given amount of arrivals
+        """
+        elapsed = 0.0
+
+        for duration, start_rate, end_rate in self.segments:
+            segment_arrivals = (start_rate + end_rate) * duration / 2
+
+            # Strictly less, so that segments with a rate of 0 (pauses) are skipped over
+            if arrivals < segment_arrivals:
+                # Solve start_rate * t + slope * t^2 / 2 = arrivals for t
+                slope = (end_rate - start_rate) / duration
+
+                if slope == 0:
+                    return elapsed + arrivals / start_rate
+
+                return elapsed + (-start_rate + math.sqrt(start_rate**2 + 2 * slope * arrivals)) / slope
+
+            arrivals -= segment_arrivals
+            elapsed += duration
+
+        return elapsed + arrivals / self.final_rate
+
+    def arrival_times(self):
+        """
+        Generator of the offsets, in seconds from the start of the run, at which clusters should be released.
+
+        Poisson arrivals are generated as a unit rate Poisson process in "arrivals space" (exponentially
+        distributed gaps), mapped to time through the profile - which gives a Poisson process whose rate
+        follows the profile.
+        """
+        arrivals = 0.0
+
+        while True:
+            yield self.time_of(arrivals)
+            arrivals += self.random.expovariate(1) if self.poisson else 1
+
+
+class ReleaseSchedule:
+    """
+    Releases items (clusters) according to a load profile, recording the achieved release rate against the target rate
+    """
+
+    def __init__(self, profile: LoadProfile):
+        self.profile = profile
+        self.logging = logging.getLogger("swarm")
+        self.started_at = None
+        self.released = 0
+        self.total_lag = 0.0
+
+        target_releases.set_function(lambda: {(): self.expected()})
+        actual_releases.set_function(lambda: {(): self.released})
+
+    def elapsed(self):
+        return 0.0 if self.started_at is None else time.monotonic() - self.started_at
+
+    def expected(self):
+        return self.profile.expected_arrivals(self.elapsed()) if self.started_at is not None else 0
+
+    def record(self, offset):
+        lag = max(0.0, self.elapsed() - offset)
+        release_lag.observe(lag)
+        self.total_lag += lag
+        self.released += 1
+
+    def release(self, items):
+        """
+        Generator which yields items, sleeping in between so that they're released on schedule
+        """
+        self.started_at = time.monotonic()
+
+        for item, offset in zip(items, self.profile.arrival_times()):
+            delay = offset - self.elapsed()
+            if delay > 0:
+                time.sleep(delay)
+
+            self.record(offset)
+            yield item
+
+        self.log_summary()
+
+    async def release_async(self, items):
+        """
+        Like release, but sleeps on the event loop
+        """
+        self.started_at = time.monotonic()
+
+        for item, offset in zip(items, self.profile.arrival_times()):
+            delay = offset - self.elapsed()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self.record(offset)
+            yield item
+
+        self.log_summary()
+
+    def log_summary(self):
+        elapsed = self.elapsed()
+
+        if self.released < 2 or elapsed == 0:
+            return
+
+        # The first release is at the very start and the last one is right now, so there were released - 1
+        # gaps between releases over the elapsed time
+        achieved_rate = (self.released - 1) / elapsed * seconds_per_hour
+        target_rate = self.profile.expected_arrivals(elapsed) / elapsed * seconds_per_hour
+
+        self.logging.info(
+            f"Released {self.released} clusters over {elapsed:.0f} seconds - achieved {achieved_rate:.1f} "
+            f"clusters/hour against a target of {target_rate:.1f} clusters/hour, average release lag "
+            f"{self.total_lag / self.released:.3f} seconds"
+        )
@@ -1,15 +1,27 @@
 #!/usr/bin/env python3
 
+import asyncio
+import concurrent.futures
+import itertools
 import plac
+import time
 import sys
 from swarm import Swarm
+from admission import AdmissionController
+from pipeline import Pipeline
+from cluster import Cluster
 from pathlib import Path
 import logging
 from config import load_config
+from loadprofile import LoadProfile, ReleaseSchedule
+import metrics
+from timeline import export_chrome_trace, recorder
+from ratelimit import limiter
+from report import generate_report
 from taskpool import TaskPool
+from statemachine import log_failure_summary
 from random import shuffle
 
-from threading import Event
 from rich.logging import RichHandler
 
 logging.basicConfig(
@@ -21,38 +33,127 @@ logging.basicConfig(
 
 log = logging.getLogger("rich")
 
+soak_recycled_clusters = metrics.Counter(
+    "swarm_soak_recycled_clusters_total", "Clusters that finished and were replaced by a fresh one in soak mode"
+)
+
 
-@plac.pos("max_concurrent", "Max concurrent threads - recommended around 6 per core", type=int)
+@plac.pos(
+    "max_concurrent",
+    "Max concurrent threads - recommended around 6 per core. With the asyncio engine, the default agent capacity",
+    type=int,
+)
 @plac.pos("test_plan", "A test plan file. See testplan.example.yaml", type=Path)
 @plac.pos(
     "service_config", "A file containing details about the target service. See service_config.example.yaml", type=Path
 )
-def main(max_concurrent, test_plan, service_config):
+@plac.opt("metrics_port", "Port to serve Prometheus metrics on", type=int)
+@plac.opt(
+    "engine",
+    "How to drive the cluster and agent state machines - a thread per machine, or all of them on an asyncio event loop",
+    choices=["threads", "asyncio"],
+)
+@plac.opt(
+    "agent_capacity",
+    "Max agents running at once on this machine, clusters are only admitted when all of their agents fit. Defaults to max_concurrent",
+    type=int,
+)
+@plac.flg(
+    "resume",
+    "Resume the most recent swarm from its journal, rather than starting a new one. Its clusters and agents continue from where they were",
+)
+@plac.opt(
+    "timeline",
+    "Record every state and command of the run to this file, which is exported as a Chrome trace (.trace.json) and a latency report (.report.json) when the run ends. See timeline.py and report.py",
+    type=Path,
+)
+@plac.flg(
+    "prerender",
+    "Render the manifests of every cluster of the plan ahead of time, in worker processes, while the swarm sets up",
+)
+@plac.opt("prerender_workers", "Worker processes pre-rendering manifests. Defaults to the number of CPUs", type=int)
+def main(
+    max_concurrent,
+    test_plan,
+    service_config,
+    metrics_port=9100,
+    engine="threads",
+    agent_capacity=None,
+    resume=False,
+    timeline=None,
+    prerender=False,
+    prerender_workers=None,
+):
     assert max_concurrent > 5, "Surely you can spare more than 5 concurrent threads?"
 
     logging.basicConfig(level=logging.INFO)
 
+    metrics.start_http_server(metrics_port)
+
+    if timeline is not None:
+        recorder.start(timeline)
+
     pull_secret, service_config, test_plan = load_config(service_config, test_plan)
 
-    with TaskPool(max_workers=max_concurrent) as agents_taskpool:
-        with TaskPool(max_workers=max_concurrent) as clusters_taskpool:
-            swarm = Swarm(
-                pull_secret=pull_secret,
-                pull_secret_file=service_config["pull_secret_file"],
-                service_url=service_config["service_endpoint"],
-                release_image=service_config["release_image"],
-                ssh_pub_key=service_config["ssh_pub_key"],
-            )
+    limiter.configure(service_config.get("rate_limits", None))
+
+    swarm = Swarm(
+        pull_secret=pull_secret,
+        pull_secret_file=service_config["pull_secret_file"],
+        service_url=service_config["service_endpoint"],
+        release_image=service_config["release_image"],
+        ssh_pub_key=service_config["ssh_pub_key"],
+        kube_cache_resync_intervals=service_config.get("kube_cache_resync_intervals", None),
+        resume=resume,
+        retry_policies=service_config.get("retry_policies", None),
+        failure_budgets=service_config.get("failure_budgets", None),
+        prerender_workers=prerender_workers,
+        manifest_apply=service_config.get("manifest_apply", None),
+    )
+
+    admission = AdmissionController(agent_capacity if agent_capacity is not None else max_concurrent)
+    pipeline = Pipeline(test_plan.get("pipeline", None))
+
+    # Fail early rather than having clusters wait forever for capacity that will never be available
+    for cluster in test_plan["clusters"]:
+        cluster_agents = Cluster.agents_count(cluster["single_node"], cluster["num_workers"])
+        assert (
+            cluster_agents <= admission.capacity
+        ), f"A cluster in the test plan has {cluster_agents} agents, more than the agent capacity {admission.capacity}"
+
+    if prerender:
+        # Soak mode launches ever new cluster indices, only those of the plan itself are pre-rendered
+        swarm.prerender_manifests(journaled_plan(test_plan, swarm))
 
-            swarm.start()
+    swarm.start()
 
-            execute_plan(agents_taskpool, clusters_taskpool, test_plan, swarm)
+    if engine == "asyncio":
+        if "soak" in test_plan:
+            asyncio.run(execute_soak_async(admission, pipeline, test_plan, swarm))
+        else:
+            asyncio.run(execute_plan_async(admission, pipeline, test_plan, swarm))
+    else:
+        with TaskPool(max_workers=max_concurrent) as agents_taskpool:
+            with TaskPool(max_workers=max_concurrent) as clusters_taskpool:
+                if "soak" in test_plan:
+                    execute_soak(agents_taskpool, clusters_taskpool, admission, pipeline, test_plan, swarm)
+                else:
+                    execute_plan(agents_taskpool, clusters_taskpool, admission, pipeline, test_plan, swarm)
 
     swarm.logging.info(f"All clusters finished, exiting")
+    log_failure_summary(swarm.logging)
     swarm.finalize()
 
+    if timeline is not None:
+        recorder.stop()
+        export_chrome_trace(timeline, timeline.with_suffix(".trace.json"))
+        swarm.logging.info(f"Timeline exported to {timeline.with_suffix('.trace.json')}")
 
-def execute_plan(agents_taskpool: TaskPool, clusters_taskpool: TaskPool, test_plan, swarm: Swarm):
+        latency_table = generate_report(timeline, timeline.with_suffix(".report.json"))
+        swarm.logging.info(f"Latency report written to {timeline.with_suffix('.report.json')}:\n{latency_table}")
+
+
+def plan_clusters(test_plan):
     clusters = [
         (
             c["single_node"],
@@ -68,35 +169,195 @@ def execute_plan(agents_taskpool: TaskPool, clusters_taskpool: TaskPool, test_pl
     if test_plan.get("shuffle", False):
         shuffle(clusters)
 
-    # We use a couple of events to allow cluster X to signal to cluster Y that
-    # cluster X has launched all of its agents, and only then cluster Y will
-    # launch its own agents. This allows us to launch clusters in parallel
-    # while still giving a cluster that launched early a priority to launch all
-    # of its agents before any of the clusters that were launched after it.
-    # This prevents a situation where all clusters race to create agent
-    # threads, saturating the thread pool, and as a result the clusters are in
-    # a dead lock because non of them have enough agents to finish the
-    # installation (a finished installation is necessary for agents to die and
-    # make space in the thread pool). This synchronization of events makes it
-    # so that only a single cluster at a time may have a partial amount of
-    # agents launched. One cluster's "I've launched all of my agents" event is
-    # another cluster's "can start all agents" event.
-
-    # The reason we don't simply launch clusters one after the other is because
-    # before launching agents, a cluster has a lot of work it needs to do, and
-    # there's no reason for that work to be delayed. That mostly includes
-    # creating CR's and waiting for the service to reconcile them.
-
-    # Create an initial "dummy" event that is immediately set for the first cluster
-    # since it doesn't have any cluster it needs to wait for.
-    previous_cluster_started_all_agents = Event()
-    previous_cluster_started_all_agents.set()
-
-    for cluster_index, (single_node, num_workers, with_nmstate, just_infraenv, infraenv_labels) in enumerate(clusters):
-        current_cluster_started_all_agents = Event()
-
-        clusters_taskpool.submit(
-            swarm.launch_cluster,
+    return clusters
+
+
+def journaled_plan(test_plan, swarm: Swarm):
+    """
+    The plan of the swarm being resumed, or a new plan - which is journaled, so that the swarm can be resumed
+    with the exact same (possibly shuffled) plan
+    """
+    if swarm.journal.plan is not None:
+        return swarm.journal.plan
+
+    clusters = plan_clusters(test_plan)
+    swarm.journal.record_plan(clusters)
+
+    return clusters
+
+
+def resume_first(clusters, swarm: Swarm):
+    """
+    Splits (index, cluster) pairs into those already launched by the swarm being resumed, which are in flight
+    and should be launched again right away, and the rest
+    """
+    journaled = swarm.journaled_clusters()
+
+    return (
+        [(index, cluster) for index, cluster in clusters if index in journaled],
+        [(index, cluster) for index, cluster in clusters if index not in journaled],
+    )
+
+
+def release_schedule(test_plan):
+    """
+    The schedule by which clusters are released, or None if they should all be released right away
+    """
+    if "load_profile" not in test_plan:
+        return None
+
+    return ReleaseSchedule(LoadProfile.from_config(test_plan["load_profile"]))
+
+
+def execute_plan(
+    agents_taskpool: TaskPool,
+    clusters_taskpool: TaskPool,
+    admission: AdmissionController,
+    pipeline: Pipeline,
+    test_plan,
+    swarm: Swarm,
+):
+    resumed_clusters, clusters = resume_first(enumerate(journaled_plan(test_plan, swarm)), swarm)
+
+    # Without a load profile, clusters are all launched right away, as before launching agents a cluster
+    # has a lot of work it needs to do and there's no reason for that work to be delayed - that mostly
+    # includes creating CR's and waiting for the service to reconcile them. To avoid clusters dead locking
+    # each other with partially launched sets of agents, agents are gang scheduled through the admission
+    # controller. With a load profile, clusters are released on its schedule instead, to reproduce realistic
+    # arrival patterns such as a steady hourly rate or a sudden burst.
+    schedule = release_schedule(test_plan)
+    if schedule is not None:
+        clusters = schedule.release(clusters)
+
+    launched_clusters = []
+    for cluster_index, cluster in itertools.chain(resumed_clusters, clusters):
+        single_node, num_workers, with_nmstate, just_infraenv, infraenv_labels = cluster
+        launched_clusters.append(
+            swarm.launch_cluster(
+                clusters_taskpool,
+                index=cluster_index,
+                task_pool=agents_taskpool,
+                single_node=single_node,
+                num_workers=num_workers,
+                with_nmstate=with_nmstate,
+                just_infraenv=just_infraenv,
+                infraenv_labels=infraenv_labels,
+                admission=admission,
+                pipeline=pipeline,
+            )
+        )
+
+    # Suspended clusters and agents are resubmitted to the pools, so waiting on the pools' submissions
+    # isn't enough - wait on the clusters themselves (which wait for their agents)
+    for cluster in launched_clusters:
+        cluster.finished.result()
+
+    # Failed clusters are torn down in the background once their agents stop
+    pipeline.background_work().result()
+
+    clusters_taskpool.wait()
+    agents_taskpool.wait()
+
+
+async def execute_plan_async(admission: AdmissionController, pipeline: Pipeline, test_plan, swarm: Swarm):
+    """
+    Like execute_plan, but all clusters and agents are tasks on a single event loop. Rather than a thread
+    pool, the pipeline's stages bound how many clusters are at each stage, and agents are bounded by the
+    admission controller.
+    """
+    resumed_clusters, clusters = resume_first(enumerate(journaled_plan(test_plan, swarm)), swarm)
+
+    schedule = release_schedule(test_plan)
+
+    async def released_clusters():
+        for cluster in resumed_clusters:
+            yield cluster
+
+        if schedule is None:
+            for cluster in clusters:
+                yield cluster
+        else:
+            async for cluster in schedule.release_async(clusters):
+                yield cluster
+
+    cluster_tasks = []
+    async for cluster_index, cluster in released_clusters():
+        single_node, num_workers, with_nmstate, just_infraenv, infraenv_labels = cluster
+        cluster_tasks.append(
+            asyncio.create_task(
+                swarm.launch_cluster_async(
+                    index=cluster_index,
+                    single_node=single_node,
+                    num_workers=num_workers,
+                    with_nmstate=with_nmstate,
+                    just_infraenv=just_infraenv,
+                    infraenv_labels=infraenv_labels,
+                    admission=admission,
+                    pipeline=pipeline,
+                )
+            )
+        )
+
+    await asyncio.gather(*cluster_tasks)
+
+    # Failed clusters are torn down in the background once their agents stop
+    await asyncio.wrap_future(pipeline.background_work())
+
+
+def soak_cluster(clusters, index):
+    return clusters[index % len(clusters)]
+
+
+def soak_clusters(clusters, first_index):
+    """
+    An endless supply of clusters for soak mode, cycling through the test plan with ever increasing indices
+    """
+    return ((index, soak_cluster(clusters, index)) for index in itertools.count(first_index))
+
+
+def soak_resumed_clusters(clusters, swarm: Swarm):
+    """
+    The clusters the swarm being resumed still had in flight, and the index to continue from
+    """
+    journaled = swarm.journaled_clusters()
+
+    in_flight = [(index, soak_cluster(clusters, index)) for index, finished in journaled.items() if not finished]
+
+    return in_flight, max(journaled, default=-1) + 1
+
+
+def soak_deadline(test_plan):
+    hours = test_plan["soak"].get("hours", None)
+    return None if hours is None else time.monotonic() + hours * 3600
+
+
+def soaking(deadline):
+    return deadline is None or time.monotonic() < deadline
+
+
+def execute_soak(
+    agents_taskpool: TaskPool,
+    clusters_taskpool: TaskPool,
+    admission: AdmissionController,
+    pipeline: Pipeline,
+    test_plan,
+    swarm: Swarm,
+):
+    """
+    Soak mode - keep a fixed amount of clusters in flight for as long as the soak lasts. Every cluster that
+    finishes is torn down (see Cluster.tear_down) and replaced by a fresh cluster with a new index, so that
+    the swarm's storage, podman locks and hub objects stay flat over time rather than growing without bound.
+    """
+    plan = journaled_plan(test_plan, swarm)
+    resumed_clusters, first_index = soak_resumed_clusters(plan, swarm)
+    clusters = soak_clusters(plan, first_index)
+    deadline = soak_deadline(test_plan)
+
+    def launch(cluster_index, cluster):
+        single_node, num_workers, with_nmstate, just_infraenv, infraenv_labels = cluster
+
+        return swarm.launch_cluster(
+            clusters_taskpool,
             index=cluster_index,
             task_pool=agents_taskpool,
             single_node=single_node,
@@ -104,16 +365,79 @@ def execute_plan(agents_taskpool: TaskPool, clusters_taskpool: TaskPool, test_pl
             with_nmstate=with_nmstate,
             just_infraenv=just_infraenv,
             infraenv_labels=infraenv_labels,
-            can_start_agents=previous_cluster_started_all_agents,
-            started_all_agents=current_cluster_started_all_agents,
-        )
+            admission=admission,
+            pipeline=pipeline,
+            teardown=True,
+        ).finished
 
-        previous_cluster_started_all_agents = current_cluster_started_all_agents
+    def launch_next():
+        return launch(*next(clusters))
+
+    in_flight = {launch(cluster_index, cluster) for cluster_index, cluster in resumed_clusters}
+    while len(in_flight) < test_plan["soak"]["in_flight"]:
+        in_flight.add(launch_next())
+
+    while in_flight:
+        finished, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+
+        for _ in finished:
+            if soaking(deadline):
+                soak_recycled_clusters.inc()
+                in_flight.add(launch_next())
+
+    # Failed clusters are torn down in the background once their agents stop
+    pipeline.background_work().result()
 
     clusters_taskpool.wait()
     agents_taskpool.wait()
 
 
+async def execute_soak_async(admission: AdmissionController, pipeline: Pipeline, test_plan, swarm: Swarm):
+    """
+    Like execute_soak, with clusters as tasks on the event loop. The amount of clusters in flight is bounded
+    by the soak configuration, so there's no need for a semaphore.
+    """
+    plan = journaled_plan(test_plan, swarm)
+    resumed_clusters, first_index = soak_resumed_clusters(plan, swarm)
+    clusters = soak_clusters(plan, first_index)
+    deadline = soak_deadline(test_plan)
+
+    def launch(cluster_index, cluster):
+        single_node, num_workers, with_nmstate, just_infraenv, infraenv_labels = cluster
+
+        return asyncio.create_task(
+            swarm.launch_cluster_async(
+                index=cluster_index,
+                single_node=single_node,
+                num_workers=num_workers,
+                with_nmstate=with_nmstate,
+                just_infraenv=just_infraenv,
+                infraenv_labels=infraenv_labels,
+                admission=admission,
+                pipeline=pipeline,
+                teardown=True,
+            )
+        )
+
+    def launch_next():
+        return launch(*next(clusters))
+
+    in_flight = {launch(cluster_index, cluster) for cluster_index, cluster in resumed_clusters}
+    while len(in_flight) < test_plan["soak"]["in_flight"]:
+        in_flight.add(launch_next())
+
+    while in_flight:
+        finished, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+
+        for _ in finished:
+            if soaking(deadline):
+                soak_recycled_clusters.inc()
+                in_flight.add(launch_next())
+
+    # Failed clusters are torn down in the background once their agents stop
+    await asyncio.wrap_future(pipeline.background_work())
+
+
 if __name__ == "__main__":
     try:
         plac.call(main)
@@ -0,0 +1,121 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import yaml
+
+import metrics
+from kubeclient import KubeClient, api_types
+
+applied_objects = metrics.Counter(
+    "swarm_manifest_objects_total",
+    "Manifest objects applied, by kind and by whether they were created or already existed",
+    ("kind", "result"),
+)
+create_latencies = metrics.Histogram(
+    "swarm_manifest_create_seconds", "Time the kube-api took to create a manifest object, by kind", ("kind",)
+)
+
+# libyaml's parser when pyyaml was built with it, it's several times faster
+yaml_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# The kinds of objects the swarm's manifests (see manifests/) hold
+kind_api_types = {
+    "AgentClusterInstall": api_types["agentclusterinstalls"],
+    "BareMetalHost": api_types["baremetalhosts"],
+    "ClusterDeployment": api_types["clusterdeployments"],
+    "ClusterImageSet": api_types["clusterimagesets"],
+    "InfraEnv": api_types["infraenvs"],
+    "Namespace": api_types["namespaces"],
+    "NMStateConfig": api_types["nmstateconfigs"],
+    "Secret": api_types["secrets"],
+}
+
+# Created before anything else, as everything else lives in them
+prerequisite_kinds = ("Namespace",)
+
+# Overridable through the service config, see service_config.example.yaml
+default_workers = 32
+default_per_cluster = 4
+default_chunk_size = 50
+
+
+def parse(manifests):
+    return [document for document in yaml.load_all(manifests, Loader=yaml_loader) if document]
+
+
+class ManifestApplier:
+    """
+    Creates the objects of rendered manifests directly through the kube-api, rather than piping them to an
+    `oc apply` process per cluster - which forks a process, does API discovery and then creates the objects
+    one after the other, each over its own round trip.
+
+    The objects of a cluster are split into chunks, each created by a worker over the applier's pooled keep-alive
+    connections. The workers are shared by all clusters, which bounds how many objects are created at once
+    overall, and a cluster has at most per_cluster chunks in flight, so that one large cluster can't take all
+    of the workers. Objects that already exist are left as they are, so applying the same manifests again
+    (e.g. when the state is retried) only creates what's missing.
+    """
+
+    def __init__(
+        self,
+        kube_client: KubeClient,
+        workers=default_workers,
+        per_cluster=default_per_cluster,
+        chunk_size=default_chunk_size,
+    ):
+        self.kube_client = kube_client
+        self.per_cluster = per_cluster
+        self.chunk_size = chunk_size
+
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="manifest-applier")
+
+    def create(self, manifest):
+        kind = manifest["kind"]
+        api_type = kind_api_types.get(kind)
+        if api_type is None:
+            raise Exception(f"Don't know how to apply {kind} manifests, add the kind to kind_api_types")
+
+        started = time.monotonic()
+        created = self.kube_client.create(api_type, manifest["metadata"].get("namespace"), manifest)
+        create_latencies.observe(time.monotonic() - started, kind)
+        applied_objects.inc(kind, "created" if created else "existing")
+
+        return created
+
+    def create_chunk(self, chunk):
+        return sum(self.create(manifest) for manifest in chunk)
+
+    def create_all(self, manifests):
+        """
+        Returns how many of the manifests' objects were created, the rest already existed
+        """
+        in_flight = set()
+        created = 0
+
+        for start in range(0, len(manifests), self.chunk_size):
+            if len(in_flight) >= self.per_cluster:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                created += sum(future.result() for future in done)
+
+            in_flight.add(self.pool.submit(self.create_chunk, manifests[start : start + self.chunk_size]))
+
+        return created + sum(future.result() for future in in_flight)
+
+    def apply(self, manifests):
+        """
+        Create the objects of the given rendered (multi document YAML) manifests, returns how many objects they
+        hold and how many of them were created
+        """
+        documents = parse(manifests)
+
+        prerequisites = [document for document in documents if document["kind"] in prerequisite_kinds]
+        rest = [document for document in documents if document["kind"] not in prerequisite_kinds]
+
+        created = self.create_all(prerequisites)
+        created += self.create_all(rest)
+
+        return len(documents), created
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.kube_client.close()
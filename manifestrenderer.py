@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import logging
+import re
+import secrets
+import sys
+import time
+from pathlib import Path
+
+import jinja2
+import plac
+
+script_dir = Path(__file__).parent
+manifests_dir = script_dir / "manifests"
+
+# Process-wide. Every template is read and compiled once, the first time it's used, and cached from then on
+environment = jinja2.Environment(loader=jinja2.FileSystemLoader(str(manifests_dir)), auto_reload=False)
+
+
+def template(manifest_name) -> jinja2.Template:
+    return environment.get_template(f"{manifest_name}.yaml.j2")
+
+
+def render(manifest_name, **params):
+    return template(manifest_name).render(**params)
+
+
+class BulkTemplate:
+    """
+    A manifest template that's rendered for many items (e.g. every agent of a cluster) which only differ in a few
+    parameters. The template is rendered once, with unique markers in place of the per-item parameters, and
+    the output is split around the markers - so rendering it for an item is just joining strings.
+
+    That's only right when the per-item parameters are inserted as is, rather than tested or transformed by
+    the template. So the sample items (which should cover every branch the template takes, see sample_items)
+    are rendered both ways, and if any of them don't match, every item is rendered with jinja2 instead.
+    """
+
+    def __init__(self, manifest_name, shared_params, sample_items):
+        self.manifest_name = manifest_name
+        self.shared_params = shared_params
+
+        markers = {name: f"@@{secrets.token_hex(8)}@@" for name in sample_items[0]}
+        parameters = {marker: name for name, marker in markers.items()}
+
+        # Alternating literal text and per-item parameter names, literals at even indices
+        marker_pattern = "|".join(re.escape(marker) for marker in parameters)
+        parts = re.split(f"({marker_pattern})", render(manifest_name, **shared_params, **markers))
+        self.parts = [part if index % 2 == 0 else parameters[part] for index, part in enumerate(parts)]
+
+        self.bulk = all(
+            self.render_bulk(item_params) == render(manifest_name, **shared_params, **item_params)
+            for item_params in sample_items
+        )
+        if not self.bulk:
+            logging.getLogger("swarm").info(f"{manifest_name} can't be rendered in bulk, rendering it with jinja2")
+
+    def render_bulk(self, item_params):
+        parts = list(self.parts)
+        for index in range(1, len(parts), 2):
+            parts[index] = str(item_params[parts[index]])
+
+        return "".join(parts)
+
+    def render(self, **item_params):
+        if self.bulk:
+            return self.render_bulk(item_params)
+
+        return render(self.manifest_name, **self.shared_params, **item_params)
+
+
+def sample_items(items):
+    """
+    One item of every distinct combination of the per-item parameters that items share (e.g. the role of an agent),
+    rather than those that are unique to every item (e.g. its MAC address). Those are what templates branch on
+    """
+    shared_names = [name for name in items[0] if len({item[name] for item in items}) < len(items)]
+
+    samples = {}
+    for item in items:
+        samples.setdefault(tuple(item[name] for name in shared_names), item)
+
+    return list(samples.values())
+
+
+def render_per_item(manifest_names, shared_params, items):
+    """
+    Render every one of the given manifests for every item (a dictionary of per-item parameters), item by item
+    """
+    if not items:
+        return []
+
+    samples = sample_items(items)
+    bulk_templates = [BulkTemplate(manifest_name, shared_params, samples) for manifest_name in manifest_names]
+
+    return [bulk_template.render(**item) for item in items for bulk_template in bulk_templates]
+
+
+def benchmark_params(agents):
+    shared_params = {
+        "cluster_identifier": "swarm-1-1",
+        "swarm_label": "assisted-swarm.openshift.io/swarm",
+        "swarm_identifier": "swarm-1",
+    }
+    items = [
+        {
+            "mac_address": f"00:00:01:00:{agent_index >> 8 & 0xFF:02x}:{agent_index & 0xFF:02x}",
+            "agent_identifier": f"swarm-1-1-{agent_index}",
+            "role": "master" if agent_index < 3 else "worker",
+        }
+        for agent_index in range(agents)
+    ]
+
+    return shared_params, items
+
+
+@plac.opt("agents", "Agents to render the per-agent manifests for", type=int)
+@plac.opt("repeat", "Times to repeat every measurement, the best one is reported", type=int)
+def main(agents=1000, repeat=5):
+    """
+    Benchmark per-agent manifest rendering
+    """
+    per_agent_manifests = ("baremetalhost", "secret_bmh")
+    shared_params, items = benchmark_params(agents)
+
+    def uncached():
+        # How manifests used to be rendered, reading and compiling the template every time
+        for item in items:
+            for manifest_name in per_agent_manifests:
+                with (manifests_dir / f"{manifest_name}.yaml.j2").open() as manifest_file:
+                    jinja2.Template(manifest_file.read()).render(**shared_params, **item)
+
+    def cached():
+        for item in items:
+            for manifest_name in per_agent_manifests:
+                render(manifest_name, **shared_params, **item)
+
+    def bulk():
+        render_per_item(per_agent_manifests, shared_params, items)
+
+    for name, function in (("uncached templates", uncached), ("cached templates", cached), ("bulk", bulk)):
+        best = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            function()
+            best = min(best, time.perf_counter() - started)
+
+        print(f"{name:<20}{best * 1e6 / agents:>10.1f} us per agent")
+
+
+if __name__ == "__main__":
+    try:
+        plac.call(main)
+    except Exception as e:
+        logging.exception(e)
+        sys.exit(1)
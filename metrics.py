@@ -0,0 +1,243 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ShardedValues:
+    """
+    A collection of per-thread dictionaries, each only ever written to by the thread that owns it.
+
+    The swarm runs thousands of threads which all record metrics. Having them all contend on a lock
+    for every increment would turn instrumentation into a hot spot, so instead every thread updates
+    its own shard (which needs no lock, as no other thread writes to it) and shards are only summed
+    up when the metrics are scraped.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards_lock = threading.Lock()
+        self.shards = []
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+
+            # This only happens once per thread, so the lock is cheap
+            with self.shards_lock:
+                self.shards.append(shard)
+
+            return shard
+
+    def snapshots(self):
+        with self.shards_lock:
+            shards = list(self.shards)
+
+        for shard in shards:
+            while True:
+                try:
+                    # Copying a dict is atomic enough for us, but the owner thread might still
+                    # resize it right under our nose, in which case we simply try again
+                    yield dict(shard)
+                    break
+                except RuntimeError:
+                    continue
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = [*zip(label_names, label_values), *extra]
+
+    if not pairs:
+        return ""
+
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+
+        (registry if registry is not None else default_registry).register(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+
+
+class Counter(Metric):
+    """
+    A monotonically increasing value per label set
+    """
+
+    metric_type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values = ShardedValues()
+
+    def inc(self, *label_values, amount=1):
+        shard = self.values.shard()
+        shard[label_values] = shard.get(label_values, 0) + amount
+
+    def collect(self):
+        totals = {}
+
+        for shard in self.values.snapshots():
+            for label_values, value in shard.items():
+                totals[label_values] = totals.get(label_values, 0) + value
+
+        return totals
+
+    def expose(self):
+        return self.header() + [
+            f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}"
+            for label_values, value in sorted(self.collect().items())
+        ]
+
+
+class Gauge(Counter):
+    """
+    A value per label set which can go up and down. Gauges are either updated with inc/dec
+    (which are as cheap as counter increments), or computed at scrape time by a function set
+    with set_function, returning a dictionary of label values tuple to value.
+    """
+
+    metric_type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.function = None
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set_function(self, function):
+        self.function = function
+
+    def collect(self):
+        if self.function is not None:
+            return {label_values: value for label_values, value in self.function().items() if value is not None}
+
+        return super().collect()
+
+
+# Roughly exponential buckets spanning from milliseconds (API calls) to hours (installations)
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 3600, 7200)
+
+
+class Histogram(Metric):
+    """
+    Cumulative bucketed observations per label set, along with their sum and count
+    """
+
+    metric_type = "histogram"
+
+    def __init__(self, *args, buckets=default_buckets, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        self.values = ShardedValues()
+
+    def observe(self, value, *label_values):
+        shard = self.values.shard()
+
+        try:
+            counts = shard[label_values]
+        except KeyError:
+            # Per bucket counts, then a +Inf bucket, then the sum
+            counts = shard[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def collect(self):
+        totals = {}
+
+        for shard in self.values.snapshots():
+            for label_values, counts in shard.items():
+                total = totals.setdefault(label_values, [0] * len(counts))
+                for index, count in enumerate(list(counts)):
+                    total[index] += count
+
+        return totals
+
+    def expose(self):
+        lines = self.header()
+
+        for label_values, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for upper_bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                labels = format_labels(self.label_names, label_values, extra=(("le", format_value(upper_bound)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def expose(self):
+        """
+        Render all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+
+        return "\n".join(lines) + "\n"
+
+
+default_registry = Registry()
+
+
+def start_http_server(port, registry=None, address=""):
+    """
+    Serve the registry's metrics for Prometheus to scrape, from a background thread
+    """
+    registry = registry if registry is not None else default_registry
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+
+            body = registry.expose().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            # Prometheus scrapes every few seconds, that's not worth logging
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+
+    return server
@@ -0,0 +1,141 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import metrics
+from statemachine import all_of
+
+stage_busy = metrics.Gauge("swarm_pipeline_stage_busy", "Machines currently holding a worker of each stage", ("stage",))
+stage_queued = metrics.Gauge("swarm_pipeline_stage_queued", "Machines waiting for a worker of each stage", ("stage",))
+stage_waits = metrics.Histogram(
+    "swarm_pipeline_stage_wait_seconds", "Time machines waited for a worker of each stage", ("stage",)
+)
+
+# Workers per stage, None is unbounded. The lookahead stage bounds how many clusters are prepared (their CRs
+# applied and their ISO URL ready) ahead of being admitted, see Cluster.state_stages
+pipeline_stages = ("render", "apply", "reconcile", "lookahead", "teardown")
+default_stage_workers = {
+    "render": 4,
+    "apply": 8,
+    "reconcile": None,
+    "lookahead": 32,
+    "teardown": 4,
+}
+
+
+class Stage:
+    """
+    A bounded set of workers that machines take turns holding, in the order they asked. Acquiring returns a
+    future rather than blocking, so that a machine waiting for a worker doesn't hold a thread (see
+    RetryingStateMachine.stage_gate).
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.busy = 0
+
+        self.lock = threading.Lock()
+        self.queue = deque()
+
+    def acquire(self) -> Future:
+        """
+        A future that resolves once the caller holds a worker, which it has to release() once it's done
+        """
+        acquired = Future()
+
+        with self.lock:
+            granted = self.workers is None or (self.busy < self.workers and not self.queue)
+            if granted:
+                self.busy += 1
+            else:
+                self.queue.append((acquired, time.monotonic()))
+
+        if granted:
+            stage_waits.observe(0, self.name)
+            acquired.set_result(self)
+
+        return acquired
+
+    def release(self):
+        with self.lock:
+            if self.queue:
+                # The worker is handed over as is, busy stays the same
+                acquired, queued_at = self.queue.popleft()
+            else:
+                acquired = None
+                self.busy -= 1
+
+        if acquired is not None:
+            stage_waits.observe(time.monotonic() - queued_at, self.name)
+            acquired.set_result(self)
+
+
+class Pipeline:
+    """
+    The stages a cluster goes through, each with its own bounded workers, so that e.g. rendering manifests,
+    applying them and tearing clusters down never compete over the same workers, and so that only a window of
+    upcoming clusters (lookahead) is prepared on the hub ahead of agent capacity freeing up. Running agents
+    and controllers is bounded by the admission controller rather than by a stage.
+    """
+
+    def __init__(self, stage_workers=None):
+        workers = {**default_stage_workers, **(stage_workers or {})}
+        self.stages = {name: Stage(name, workers[name]) for name in pipeline_stages}
+
+        # Futures of the work run with run_in_stage, see background_work
+        self.lock = threading.Lock()
+        self.background = []
+
+        stage_busy.set_function(lambda: {(name,): stage.busy for name, stage in self.stages.items()})
+        stage_queued.set_function(lambda: {(name,): len(stage.queue) for name, stage in self.stages.items()})
+
+    def state_stages(self, stage_names_by_state):
+        """
+        Map states to the stages they run in, from a mapping of state names to stage names
+        """
+        return {
+            state: tuple(self.stages[stage_name] for stage_name in stage_names)
+            for state, stage_names in stage_names_by_state.items()
+        }
+
+    def run_in_stage(self, stage_name, function, after=None):
+        """
+        Run function, on a thread of its own, once the future after (if given) completes and a worker of the stage
+        is free - for work that's done outside of any state machine's states (e.g. tearing down a failed cluster).
+        No thread is held while waiting
+        """
+        stage = self.stages[stage_name]
+        done = Future()
+
+        with self.lock:
+            self.background.append(done)
+
+        def run():
+            try:
+                function()
+            except Exception as e:
+                logging.getLogger("swarm").exception(e)
+            finally:
+                stage.release()
+                done.set_result(None)
+
+        def acquire(_):
+            stage.acquire().add_done_callback(
+                lambda _: threading.Thread(target=run, name=f"pipeline-{stage_name}").start()
+            )
+
+        if after is None:
+            acquire(None)
+        else:
+            after.add_done_callback(acquire)
+
+    def background_work(self) -> Future:
+        """
+        A future that completes once all the work run with run_in_stage so far is done, to be waited on before the
+        swarm finishes, so that it isn't cut short
+        """
+        with self.lock:
+            return all_of(list(self.background))
@@ -0,0 +1,217 @@
+import logging
+import os
+import selectors
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import metrics
+
+running_processes = metrics.Gauge(
+    "swarm_supervised_processes", "Child processes currently running under the reaper", ("command",)
+)
+process_exits = metrics.Counter(
+    "swarm_supervised_process_exits_total", "Child processes that exited, by exit code", ("command", "returncode")
+)
+process_lifetimes = metrics.Histogram(
+    "swarm_supervised_process_lifetime_seconds", "Time from process start to exit", ("command",)
+)
+
+# How often to poll processes when the kernel doesn't support pidfds
+fallback_poll_interval = 1
+
+
+def process_mentions(pid, marker: str):
+    """
+    Whether a running process mentions the marker in its environment or command line
+    """
+    try:
+        proc_dir = Path("/proc") / str(pid)
+        contents = (proc_dir / "cmdline").read_bytes() + b"\0" + (proc_dir / "environ").read_bytes()
+    except OSError:
+        return False
+
+    return marker.encode("utf-8") in contents
+
+
+@dataclass
+class ProcessRecord:
+    """
+    The life of a single supervised child process. Timestamps are wall clock (time.time()).
+    """
+
+    pid: int
+    command: str
+    started_at: float
+    exited_at: Optional[float] = None
+    returncode: Optional[int] = None
+    process: subprocess.Popen = field(default=None, repr=False)
+    future: Future = field(default_factory=Future, repr=False)
+
+
+class ProcessReaper:
+    """
+    Watches all the swarm's long running child processes (agents and controllers) from a single
+    thread, rather than having a thread blocked in Popen.wait() for every one of them.
+
+    Every watched process gets a pidfd, which becomes readable when the process exits, and all of
+    them are waited on with a single selector (epoll). When a process exits its record is completed
+    and the future returned by watch() resolves with the exit code - so a state machine can hand
+    its thread back to the pool and get rescheduled once the process is done.
+
+    On kernels without pidfd support, the reaper falls back to polling all processes periodically.
+    """
+
+    def __init__(self):
+        self.logging = logging.getLogger("swarm")
+        self.selector = selectors.DefaultSelector()
+
+        # Registrations are handed over to the reaper thread, which owns the selector. The pipe
+        # wakes it up so it notices them
+        self.lock = threading.Lock()
+        self.pending = []
+        self.polled = []
+        self.records = []
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ, None)
+
+        self.done = threading.Event()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="process-reaper", daemon=True)
+                self.thread.start()
+
+    def watch(self, process: subprocess.Popen, command: str) -> Future:
+        """
+        Supervise an already started process, returns a future that resolves with its exit code
+        """
+        record = ProcessRecord(pid=process.pid, command=command, started_at=time.time(), process=process)
+        running_processes.inc(command)
+
+        with self.lock:
+            self.records.append(record)
+            self.pending.append(record)
+
+        self.start()
+        os.write(self.wakeup_write, b"\0")
+
+        return record.future
+
+    def adopt(self, pid, command: str, marker: str) -> Optional[Future]:
+        """
+        Supervise a process started by a previous incarnation of the swarm, if it's still running. The
+        marker (which must appear in the process' environment or command line) guards against the pid
+        having been reused by an unrelated process. Returns None if there's nothing to adopt.
+
+        Adopted processes aren't our children, so their exit code can't be known - their futures resolve
+        with None.
+        """
+        if not process_mentions(pid, marker):
+            return None
+
+        record = ProcessRecord(pid=pid, command=command, started_at=time.time())
+        running_processes.inc(command)
+
+        with self.lock:
+            self.records.append(record)
+            self.pending.append(record)
+
+        self.start()
+        os.write(self.wakeup_write, b"\0")
+
+        return record.future
+
+    def register_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+
+        for record in pending:
+            try:
+                pidfd = os.pidfd_open(record.pid)
+            except ProcessLookupError:
+                # Already exited (and reaped by someone calling poll / wait)
+                self.reap(record)
+                continue
+            except (AttributeError, OSError):
+                self.polled.append(record)
+                continue
+
+            self.selector.register(pidfd, selectors.EVENT_READ, record)
+
+    def reap(self, record: ProcessRecord):
+        # The process has exited, so this doesn't block. Going through Popen (rather than
+        # waitpid) keeps the Popen object's returncode consistent
+        record.returncode = record.process.wait() if record.process is not None else None
+        record.exited_at = time.time()
+        record.process = None
+
+        # Only running processes are kept, a long running swarm goes through a lot of them
+        with self.lock:
+            self.records.remove(record)
+
+        running_processes.dec(record.command)
+        process_exits.inc(record.command, str(record.returncode) if record.returncode is not None else "unknown")
+        process_lifetimes.observe(record.exited_at - record.started_at, record.command)
+
+        record.future.set_result(record.returncode)
+
+    @staticmethod
+    def exited(record: ProcessRecord):
+        if record.process is not None:
+            return record.process.poll() is not None
+
+        try:
+            os.kill(record.pid, 0)
+        except ProcessLookupError:
+            return True
+
+        return False
+
+    def poll_fallback(self):
+        still_running = []
+
+        for record in self.polled:
+            if self.exited(record):
+                self.reap(record)
+            else:
+                still_running.append(record)
+
+        self.polled = still_running
+
+    def run(self):
+        while not self.done.is_set():
+            self.register_pending()
+
+            for key, _ in self.selector.select(timeout=fallback_poll_interval if self.polled else None):
+                if key.data is None:
+                    os.read(self.wakeup_read, 4096)
+                    continue
+
+                self.selector.unregister(key.fd)
+                os.close(key.fd)
+
+                try:
+                    self.reap(key.data)
+                except Exception as e:
+                    self.logging.exception(e)
+                    key.data.future.set_exception(e)
+
+            self.poll_fallback()
+
+    def running(self):
+        with self.lock:
+            return list(self.records)
+
+    def stop(self):
+        self.done.set()
+        os.write(self.wakeup_write, b"\0")
+
+        if self.thread is not None:
+            self.thread.join()
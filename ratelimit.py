@@ -0,0 +1,105 @@
+import threading
+import time
+
+import metrics
+import timeline
+
+rate_limit_waits = metrics.Histogram(
+    "swarm_rate_limit_wait_seconds",
+    "Time requests to the hub waited for a rate limit token before being sent, by target and verb",
+    ("target", "verb"),
+)
+
+# The verbs of each target requests can be rate limited by, see service_config.example.yaml. "*" limits all of
+# a target's verbs together, on top of their own limits
+rate_limit_verbs = {
+    "kube-api": ("list", "watch", "get", "create", "patch", "delete"),
+    "service": ("get", "download"),
+}
+any_verb = "*"
+
+
+class TokenBucket:
+    """
+    rate tokens per second, up to burst of them saved up. Taking a token never blocks - when there are none
+    left, the caller is told how long it has to wait for its token, which is already its own, so waiters are
+    served in the order they came in without having to hold a lock or poll while they wait.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def take(self):
+        """
+        Take a token, returns how many seconds until it can be used
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate) - 1
+            self.updated_at = now
+
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class RateLimiter:
+    """
+    Bounds the rate of the requests the swarm sends to the hub, from wherever they're sent (the kube cache,
+    clusters applying manifests, agents updating their BMH or downloading the ISO), so that the swarm itself
+    (e.g. a burst of retries) can't flood the service it's measuring. Requests of targets and verbs without a
+    configured limit go through as they are.
+
+    The time requests spend waiting for a token is the swarm's own latency rather than the service's, it's
+    exported as a metric and put on the timeline (see timeline.py) of the machine that waited.
+    """
+
+    def __init__(self):
+        # (target, verb) -> buckets a request has to take a token from
+        self.buckets = {}
+
+    def configure(self, rate_limits):
+        """
+        Set the limits from the rate_limits section of the service config, {target: {verb: {rate, burst}}}
+        """
+        buckets = {}
+
+        for target, limits in (rate_limits or {}).items():
+            target_buckets = {
+                verb: TokenBucket(limit["rate"], limit.get("burst", max(1, limit["rate"])))
+                for verb, limit in limits.items()
+            }
+
+            for verb in rate_limit_verbs[target]:
+                buckets[(target, verb)] = tuple(
+                    target_buckets[key] for key in (verb, any_verb) if key in target_buckets
+                )
+
+        self.buckets = {key: verb_buckets for key, verb_buckets in buckets.items() if verb_buckets}
+
+    def acquire(self, target, verb):
+        """
+        Block until a request of the given verb can be sent to the given target
+        """
+        buckets = self.buckets.get((target, verb))
+        if buckets is None:
+            return
+
+        started = time.monotonic()
+        delay = max(bucket.take() for bucket in buckets)
+
+        if delay > 0:
+            time.sleep(delay)
+
+            track = timeline.current_track.get()
+            if track is not None:
+                timeline.recorder.span(track, f"Rate limited {target} {verb}", "rate-limit", started, time.monotonic())
+
+        rate_limit_waits.observe(time.monotonic() - started, target, verb)
+
+
+# Process-wide, every request the swarm sends to the hub goes through it. Unlimited unless configured
+limiter = RateLimiter()
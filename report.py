@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import math
+import sys
+from array import array
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+
+import plac
+
+percentiles = (50, 90, 99)
+
+# Throughput is counted per bucket of this many seconds
+default_bucket_seconds = 60
+
+# Of clusters and agents, marked on the timeline by instant events
+terminal_states = ("Done", "Failed")
+
+
+@dataclass(frozen=True)
+class Phase:
+    """
+    A phase of a cluster's or an agent's lifetime, measured from one point of its timeline track to another.
+    Points are (state, "start" / "end") pairs - the start or the end of a state's span, or an instant event.
+    """
+
+    name: str
+    kind: str
+    start: tuple
+    end: tuple
+
+
+phases = (
+    Phase("Manifest apply", "cluster", ("Applying manifests", "start"), ("Applying manifests", "end")),
+    Phase("Admission wait", "cluster", ("Waiting for agent capacity", "start"), ("Waiting for agent capacity", "end")),
+    Phase(
+        "Manifest apply to InfraEnv ISO URL",
+        "cluster",
+        ("Applying manifests", "start"),
+        ("Waiting for InfraEnv ISO URL", "end"),
+    ),
+    Phase(
+        "BMH provisioning",
+        "agent",
+        ('Seting BMH provisioning state to "ready"', "start"),
+        ('Seting BMH provisioning state to "provisioned"', "end"),
+    ),
+    Phase("ISO download", "agent", ("Download ISO", "start"), ("Download ISO", "end")),
+    Phase(
+        "Agents launch to installation start",
+        "cluster",
+        ("Launching agents", "start"),
+        ("Waiting for AgentClusterInstall clusterMetadata infraID", "end"),
+    ),
+    Phase("Agent registration", "agent", ("Running agent", "start"), ("Agent Seen=True", "start")),
+    Phase("Agent approval", "agent", ("Agent Seen=True", "start"), ("Agent Approved=True", "start")),
+    Phase("Agent run", "agent", ("Running agent", "start"), ("Running agent", "end")),
+    Phase("Installation", "cluster", ("Running controller", "start"), ("Running controller", "end")),
+    Phase(
+        "Agents launch to installation completed",
+        "cluster",
+        ("Launching agents", "start"),
+        ("AgentClusterInstall Completed=True", "start"),
+    ),
+    Phase("Cluster total", "cluster", ("Initializing", "start"), ("Done", "start")),
+)
+
+
+def track_kind(track_name):
+    if track_name == "Cluster":
+        return "cluster"
+
+    if track_name.startswith("Agent ") and not track_name.endswith(" commands"):
+        return "agent"
+
+    return None
+
+
+def percentile(sorted_values, percent):
+    # Nearest rank
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+
+class LatencyReport:
+    """
+    Per phase latency distributions and throughput over time of a run, computed from its timeline (see
+    timeline.py) in a single pass.
+
+    Only the points of machines that are still running are kept around, and every finished machine is reduced
+    to one duration per phase, so memory grows with the number of measurements rather than with the number of
+    events - a few floats per host.
+    """
+
+    def __init__(self, bucket_seconds=default_bucket_seconds):
+        self.bucket_seconds = bucket_seconds
+
+        # (pid, tid) -> track name
+        self.tracks = {}
+
+        # (pid, tid) -> {point: timestamp} of machines still running
+        self.points = defaultdict(dict)
+
+        self.durations = {phase.name: array("d") for phase in phases}
+
+        # (kind, terminal state) -> bucket -> machines that reached it within that bucket
+        self.throughput = defaultdict(lambda: defaultdict(int))
+
+    def add(self, event):
+        track = (event.get("pid"), event.get("tid"))
+
+        if event["ph"] == "M":
+            if event["name"] == "thread_name":
+                self.tracks[track] = event["args"]["name"]
+            return
+
+        kind = track_kind(self.tracks.get(track, ""))
+        if kind is None:
+            return
+
+        points = self.points[track]
+        if event["ph"] == "X":
+            points.setdefault((event["name"], "start"), event["ts"])
+            points[(event["name"], "end")] = event["ts"] + event["dur"]
+        elif event["ph"] == "i":
+            # Terminal states never end, they're only entered. Other instants (e.g. the service's progress,
+            # see SwarmKubeCache.record_transitions) are points of their own
+            points.setdefault((event["name"], "start"), event["ts"])
+
+            if event["name"] in terminal_states:
+                self.finished(track, kind, event["name"], event["ts"])
+
+    def finished(self, track, kind, state, timestamp):
+        points = self.points.pop(track, {})
+
+        for phase in phases:
+            if phase.kind != kind:
+                continue
+
+            start = points.get(phase.start)
+            end = points.get(phase.end)
+            if start is not None and end is not None:
+                self.durations[phase.name].append((end - start) / 1e6)
+
+        self.throughput[(kind, state)][int(timestamp / 1e6 // self.bucket_seconds)] += 1
+
+    def add_file(self, events_path: Path):
+        with events_path.open() as events_file:
+            for line in events_file:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # Cut short by a crash
+                    continue
+
+                self.add(event)
+
+    def phase_summary(self, name):
+        values = sorted(self.durations[name])
+        if not values:
+            return {"count": 0}
+
+        return {
+            "count": len(values),
+            **{f"p{percent}": percentile(values, percent) for percent in percentiles},
+            "max": values[-1],
+        }
+
+    def summary(self):
+        throughput = []
+        buckets = sorted({bucket for counts in self.throughput.values() for bucket in counts})
+        for bucket in range(buckets[-1] + 1 if buckets else 0):
+            throughput.append(
+                {
+                    "start_seconds": bucket * self.bucket_seconds,
+                    **{f"{kind}s_{state.lower()}": counts[bucket] for (kind, state), counts in self.throughput.items()},
+                }
+            )
+
+        return {
+            "phases": {phase.name: self.phase_summary(phase.name) for phase in phases},
+            "bucket_seconds": self.bucket_seconds,
+            "throughput": throughput,
+        }
+
+
+def format_table(summary):
+    lines = [f"{'phase':<40}{'count':>8}" + "".join(f"{f'p{p}':>10}" for p in percentiles) + f"{'max':>10}"]
+
+    for name, stats in summary["phases"].items():
+        if stats["count"] == 0:
+            lines.append(f"{name:<40}{0:>8}")
+            continue
+
+        lines.append(
+            f"{name:<40}{stats['count']:>8}"
+            + "".join(f"{stats[f'p{p}']:>9.1f}s" for p in percentiles)
+            + f"{stats['max']:>9.1f}s"
+        )
+
+    totals = defaultdict(int)
+    for bucket in summary["throughput"]:
+        for key, count in bucket.items():
+            if key != "start_seconds":
+                totals[key] += count
+
+    minutes = len(summary["throughput"]) * summary["bucket_seconds"] / 60
+    for key, total in sorted(totals.items()):
+        lines.append(f"{key.replace('_', ' ')}: {total}" + (f" ({total / minutes:.1f}/minute)" if minutes else ""))
+
+    return "\n".join(lines)
+
+
+def generate_report(events_path: Path, report_path: Path, bucket_seconds=default_bucket_seconds):
+    """
+    Write the JSON report of the given timeline, returns its text table
+    """
+    report = LatencyReport(bucket_seconds)
+    report.add_file(events_path)
+    summary = report.summary()
+
+    report_path.write_text(json.dumps(summary, indent=2))
+
+    return format_table(summary)
+
+
+@plac.pos("events", "A timeline recorded by the swarm, see main --timeline", type=Path)
+@plac.pos("report", "Where to write the JSON report. Defaults to the timeline with a .report.json suffix", type=Path)
+@plac.opt("bucket_seconds", "Throughput is counted per this many seconds", type=int)
+def main(events, report=None, bucket_seconds=default_bucket_seconds):
+    print(generate_report(events, report or events.with_suffix(".report.json"), bucket_seconds))
+
+
+if __name__ == "__main__":
+    try:
+        plac.call(main)
+    except Exception as e:
+        logging.exception(e)
+        sys.exit(1)
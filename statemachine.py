@@ -1,13 +1,219 @@
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+import asyncio
+import heapq
+import logging
+import random
+import threading
 import time
-from itertools import takewhile
+from itertools import count, takewhile
+from typing import Optional
+
+import metrics
+import timeline
+
+state_machines = metrics.Gauge(
+    "swarm_state_machines", "Number of state machines currently in each state", ("kind", "state")
+)
+state_transitions = metrics.Counter(
+    "swarm_state_transitions_total", "State machine transitions", ("kind", "from_state", "to_state")
+)
+state_retries = metrics.Counter(
+    "swarm_state_retries_total", "Failed state attempts that will be retried", ("kind", "state")
+)
+state_backoff = metrics.Counter(
+    "swarm_state_backoff_seconds_total",
+    "Time state machines spent backing off before retrying a state",
+    ("kind", "state"),
+)
+state_retries_exhausted = metrics.Counter(
+    "swarm_state_retries_exhausted_total",
+    "States that ran out of attempts (or time) and moved the machine to a failure state",
+    ("kind", "state"),
+)
+state_machine_failures = metrics.Counter(
+    "swarm_state_machine_failures_total",
+    "State machines that were marked failed, by the state they failed in",
+    ("kind", "state"),
+)
+state_durations = metrics.Histogram(
+    "swarm_state_duration_seconds", "Time state machines spent in each state, retries included", ("kind", "state")
+)
+
+
+retry_policy_kinds = ("fixed", "exponential", "decorrelated_jitter")
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    How a failed state is retried.
+
+    fixed waits base_delay between attempts. exponential doubles the delay on every attempt, starting from
+    base_delay. decorrelated_jitter picks a random delay between base_delay and three times the previous
+    delay, so that many machines failing together (e.g. when the hub hiccups) don't retry in lockstep.
+    All of them are capped at max_delay.
+
+    Once the state was attempted max_attempts times, or has been in the state for longer than deadline seconds,
+    the machine gives up and moves to failure_state. The deadline is enforced even while the state is blocked
+    or suspended (see Watchdog). By default states are retried forever.
+    """
+
+    kind: str = "fixed"
+    base_delay: float = 5
+    max_delay: float = 120
+    max_attempts: Optional[int] = None
+    deadline: Optional[float] = None
+    failure_state: str = "Failed"
+
+    def __post_init__(self):
+        assert self.kind in retry_policy_kinds, f"Retry policy kind must be one of {retry_policy_kinds}"
+
+    def delay(self, attempt, previous_delay):
+        """
+        How long to wait after the given (1-based) failed attempt
+        """
+        if self.kind == "exponential":
+            delay = self.base_delay * 2 ** (attempt - 1)
+        elif self.kind == "decorrelated_jitter":
+            delay = random.uniform(self.base_delay, max(self.base_delay, previous_delay * 3))
+        else:
+            delay = self.base_delay
+
+        return min(self.max_delay, delay)
+
+    def exhausted(self, attempts, failing_for):
+        return (self.max_attempts is not None and attempts >= self.max_attempts) or (
+            self.deadline is not None and failing_for >= self.deadline
+        )
+
+
+# Retry forever, every 5 seconds
+default_retry_policy = RetryPolicy()
+
+
+def parse_retry_policies(config):
+    """
+    Retry policies from configuration - a dictionary of machine kinds (agent, cluster) to dictionaries
+    of state names to RetryPolicy fields
+    """
+    return {
+        kind: {state: RetryPolicy(**policy) for state, policy in policies.items()}
+        for kind, policies in (config or {}).items()
+    }
+
+
+class Watchdog:
+    """
+    Calls callbacks once their deadlines (in time.monotonic() terms) pass, all from a single thread, so
+    that machines stuck in a state - blocked, or suspended on something that never happens - can still
+    be failed once their state's deadline passes.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.sequence = count()
+        self.thread = None
+
+        # Heap of (deadline, sequence, callback), the sequence breaks ties as callbacks can't be compared
+        self.deadlines = []
+
+    def watch(self, deadline, callback):
+        with self.condition:
+            heapq.heappush(self.deadlines, (deadline, next(self.sequence), callback))
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="watchdog", daemon=True)
+                self.thread.start()
+
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.deadlines or self.deadlines[0][0] > time.monotonic():
+                    self.condition.wait(self.deadlines[0][0] - time.monotonic() if self.deadlines else None)
+
+                _, _, callback = heapq.heappop(self.deadlines)
+
+            try:
+                callback()
+            except Exception as e:
+                logging.getLogger("swarm").exception(e)
+
+
+watchdog = Watchdog()
+
+# (kind, state the machine failed in, reason) -> number of machines, see log_failure_summary
+failed_machines = Counter()
+failed_machines_lock = threading.Lock()
+
+
+def log_failure_summary(logging):
+    with failed_machines_lock:
+        failures = sorted(failed_machines.items())
+
+    if not failures:
+        logging.info("No state machines failed")
+        return
+
+    logging.info(f"{sum(count for _, count in failures)} state machines failed:")
+    for (kind, state, reason), machines in failures:
+        logging.info(f'  {machines} x {kind} in state "{state}": {reason}')
+
+
+def all_of(futures) -> Future:
+    """
+    A future that completes once all of the given futures have completed
+    """
+    combined = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] != 0:
+                return
+
+        combined.set_result(None)
+
+    if not futures:
+        combined.set_result(None)
+
+    for future in futures:
+        future.add_done_callback(on_done)
+
+    return combined
+
+
+class Suspension:
+    """
+    Returned by a state which has to wait a long time for something (e.g. for a process to exit),
+    instead of the next state. The machine releases whatever is driving it (its task pool thread,
+    or its asyncio task) until the future completes, and then calls then(future.result()) - which,
+    just like a regular state, returns the true next state.
+
+    cancel, if given, makes the future complete early (e.g. by killing the process being waited for),
+    for when the machine is failed while it's suspended.
+    """
+
+    def __init__(self, future: Future, then, cancel=None):
+        self.future = future
+        self.then = then
+        self.cancel = cancel
+
+    def resolve(self):
+        return self.then(self.future.result())
 
 
 class RetryingStateMachine:
     """
     A statemachine that's designed to be mostly used for running a bunch of linear states in a row.
-    Retries a state forever when the step raises an exception (this is helpful for trying
-    to deal with intermittent service issues / downtime).
+    A state that raises an exception (or returns its own name) is retried after a backoff, as set by its
+    retry policy, which helps with intermittent service issues / downtime. Once the policy's attempts or
+    deadline are used up, the machine moves to the policy's failure state (see below).
 
     This statemachine is used to model the behavior of the entire swarm and for single
     swarm agents as well.
@@ -19,28 +225,320 @@ class RetryingStateMachine:
     via its return value. This allows states to mostly not care which states come after them (by just
     returning the recommended value), but still allows them to break the linearity if they choose to do
     so, by returning a state of their choice.
+
+    The statemachine can be driven by one of two engines - start() runs it to completion on the
+    calling thread, while start_async() is a coroutine that runs it on an asyncio event loop, so a
+    single thread can drive a huge amount of statemachines. In the asyncio engine, states that have
+    an entry in async_states (a dictionary of state names to coroutine functions, with the same
+    signature as regular states) are awaited on the loop. All other states are assumed to be
+    blocking and are run in the loop's default executor.
+
+    States may also return a Suspension (see above) rather than a state. When start() is given a task
+    pool, the suspended machine's thread is returned to the pool and the machine is resubmitted to the
+    pool once the suspension's future completes. The finished future completes when the machine
+    reaches its terminal state, whichever engine drives it.
+
+    Failed states are retried according to their retry policy (see RetryPolicy), given per state name in
+    retry_policies. States without one use default_retry_policy. A machine whose state exhausted its retry
+    policy moves to the policy's failure state, which ends the machine just like its terminal state does.
+    So does a machine whose failed attempts, across all of its states, exceed its failure_budget, and one
+    that was failed from the outside with fail(). Either way the machine's failure reason is recorded,
+    and on_failure() gets to clean up after it (e.g. kill its processes).
+
+    States can be made to run in stages (see pipeline.py), given per state name in state_stages. Before running
+    such a state the machine waits (without holding a thread, like a suspension) until it holds a worker of each
+    of the state's stages, and it gives the workers back once it moves on to a state outside of their stage.
+
+    Once attached to a journal, every transition is journaled along with the values of the attributes
+    in checkpoint_attributes - values captured by states which later states depend on - so that the
+    machine can later be restored to where it was.
     """
-    def __init__(self, initial_state: str, terminal_state: str, states: OrderedDict, name: str, logging):
+
+    checkpoint_attributes = ()
+
+    def __init__(
+        self,
+        initial_state: str,
+        terminal_state: str,
+        states: OrderedDict,
+        name: str,
+        logging,
+        async_states=None,
+        retry_policies=None,
+        failure_budget=None,
+        state_stages=None,
+    ):
         self.state = initial_state
         self.terminal_state = terminal_state
         self.states = states
+        self.async_states = async_states or {}
         self.logging = logging
         self.name = name
-        self.exponential_backoff = 0
+        self.finished = Future()
+
+        self.retry_policies = retry_policies or {}
+        failure_states = {policy.failure_state for policy in (default_retry_policy, *self.retry_policies.values())}
+        self.terminal_states = {terminal_state} | (failure_states & set(states))
+
+        for state, policy in self.retry_policies.items():
+            gives_up = policy.max_attempts is not None or policy.deadline is not None
+            assert (
+                not gives_up or policy.failure_state in states
+            ), f'The retry policy of "{state}" gives up, but "{name}" has no "{policy.failure_state}" state'
+
+        assert (
+            failure_budget is None or default_retry_policy.failure_state in states
+        ), f'"{name}" has a failure budget, but no "{default_retry_policy.failure_state}" state'
+
+        # Failed attempts of the current state, and the last delay before retrying it
+        self.attempts = 0
+        self.last_retry_delay = 0
+
+        # Failed attempts across all states, limited by the failure budget
+        self.failures = 0
+        self.failure_budget = failure_budget
+
+        # Set once the machine has to fail, it moves to its failure state as soon as its current state ends
+        self.failure_reason = None
+
+        # Set by fail(), cuts short the backoff between attempts. The asyncio engine waits on its own event, which is
+        # set on its loop
+        self.failure_requested = threading.Event()
+        self.loop = None
+        self.failure_requested_async = None
+
+        # What the machine is suspended on, so that it can be cancelled if the machine fails meanwhile
+        self.suspension = None
+
+        # When the state whose deadline is being watched was entered, see watch_deadline
+        self.watched_entry = None
+
+        # State name -> the pipeline stages it runs in, and the stages the machine holds workers of
+        self.state_stages = state_stages or {}
+        self.held_stages = []
+
+        self.journal = None
+        self.journal_key = None
+        self.checkpointed = {}
 
-    def start(self):
-        while self.state != self.terminal_state:
-            state_successful = self.statemachine()
+        # The state a restored machine should fast forward to, see fast_forward
+        self.resume_state = None
 
-            if not state_successful:
-                # Retry again soon
-                self.exponential_backoff += 1
-                # time.sleep(min(120, 2 ** self.exponential_backoff))
-                time.sleep(5)
+        # Swarm / Cluster / Agent, used to tell apart machines in metrics
+        self.kind = type(self).__name__.lower()
+        self.state_entered_at = time.monotonic()
+        state_machines.inc(self.kind, self.state)
+
+    def start(self, task_pool=None):
+        while self.state not in self.terminal_states:
+            stage_acquired = self.stage_gate()
+            if stage_acquired is not None:
+                if task_pool is not None:
+                    stage_acquired.add_done_callback(lambda _: task_pool.submit(self.start, task_pool))
+                    return
+
+                stage_acquired.result()
+                continue
+
+            next_state = self.begin_state()
+            true_next_state = self.call_state(self.states[self.state], next_state)
+
+            if isinstance(true_next_state, Suspension):
+                self.track_suspension(true_next_state)
+
+                if task_pool is not None:
+                    self.suspend(true_next_state, task_pool)
+                    return
+
+                true_next_state = self.call_state(true_next_state.resolve)
+
+            self.complete_state(true_next_state)
+
+        self.finish()
+
+    def suspend(self, suspension: Suspension, task_pool):
+        self.logging.info(f'State machine "{self.name}" suspended in state: "{self.state}"')
+        suspension.future.add_done_callback(lambda _: task_pool.submit(self.resume, suspension, task_pool))
+
+    def resume(self, suspension: Suspension, task_pool):
+        self.complete_state(self.call_state(suspension.resolve))
+        self.start(task_pool)
+
+    async def start_async(self):
+        self.failure_requested_async = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        if self.failure_requested.is_set():
+            self.failure_requested_async.set()
+
+        while self.state not in self.terminal_states:
+            stage_acquired = self.stage_gate()
+            if stage_acquired is not None:
+                await asyncio.wait([asyncio.wrap_future(stage_acquired)])
+                continue
+
+            next_state = self.begin_state()
+
+            if self.state in self.async_states:
+                true_next_state = await self.call_state_async(self.async_states[self.state], next_state)
             else:
-                self.exponential_backoff = 0
+                true_next_state = await asyncio.get_running_loop().run_in_executor(
+                    None, self.call_state, self.states[self.state], next_state
+                )
+
+            if isinstance(true_next_state, Suspension):
+                self.track_suspension(true_next_state)
+                await asyncio.wait([asyncio.wrap_future(true_next_state.future)])
+                true_next_state = self.call_state(true_next_state.resolve)
+
+            if not self.end_state(true_next_state):
+                await self.back_off_async()
+
+        self.finish()
+
+    def stage_gate(self):
+        """
+        Start acquiring the next stage the current state runs in which the machine doesn't hold yet. Returns the
+        future of its acquisition if the machine has to wait for it, or None once it holds all of them
+        """
+        for stage in self.state_stages.get(self.state, ()):
+            if stage in self.held_stages:
+                continue
+
+            self.held_stages.append(stage)
+            acquired = stage.acquire()
+            if not acquired.done():
+                self.logging.info(f'State machine "{self.name}" waiting for a {stage.name} worker')
+                return acquired
 
+        return None
+
+    def release_stages(self, new_state):
+        new_stages = self.state_stages.get(new_state, ())
+
+        for stage in [stage for stage in self.held_stages if stage not in new_stages]:
+            self.held_stages.remove(stage)
+            stage.release()
+
+    def track_suspension(self, suspension: Suspension):
+        self.suspension = suspension
+
+        # The machine might have been failed while the state that suspended it was still running
+        if self.failure_reason is not None and suspension.cancel is not None:
+            suspension.cancel()
+
+    def fail(self, reason):
+        """
+        Fail the machine from the outside (e.g. from another thread). It moves to its failure state as soon as its
+        current state ends, and if it's suspended the suspension is cancelled so that happens right away
+        """
+        if self.failure_reason is not None or self.state in self.terminal_states:
+            return
+
+        self.failure_reason = reason
+        self.failure_requested.set()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.failure_requested_async.set)
+
+        suspension = self.suspension
+        if suspension is not None and suspension.cancel is not None and not suspension.future.done():
+            suspension.cancel()
+
+    def watch_deadline(self):
+        """
+        Have the watchdog fail the machine once the current state's deadline passes, unless it moved on by then
+        """
+        deadline = self.retry_policy().deadline
+        if deadline is None or self.watched_entry == self.state_entered_at:
+            return
+
+        state = self.state
+        entered_at = self.watched_entry = self.state_entered_at
+
+        def deadline_passed():
+            if self.state == state and self.state_entered_at == entered_at:
+                self.fail(f"exceeded the {deadline:g} second deadline of the state")
+
+        watchdog.watch(entered_at + deadline, deadline_passed)
+
+    def on_failure(self):
+        """
+        Called once the machine moved to its failure state, to clean up after it
+        """
+
+    @property
+    def timeline_track(self):
+        """
+        Where the machine's states go on the timeline, a (group, name) pair, see Timeline
+        """
+        return (self.name, self.name)
+
+    def finish(self):
         self.logging.info(f'Statemachine "{self.name}" complete')
+        timeline.recorder.instant(self.timeline_track, self.state, self.kind)
+        self.finished.set_result(self.state)
+
+    def attach_journal(self, journal, key):
+        """
+        Journal the machine's progress under the given key, restoring the machine if it's already in the journal.
+        Returns whether the machine was restored.
+        """
+        self.journal = journal
+        self.journal_key = key
+
+        return journal.restore(key, self)
+
+    def checkpoint(self):
+        """
+        Journal the current state, along with the checkpointed attributes that changed since the last checkpoint
+        """
+        if self.journal is None:
+            return
+
+        values = {}
+        for attribute in self.checkpoint_attributes:
+            value = getattr(self, attribute, None)
+            if value != self.checkpointed.get(attribute, None):
+                values[attribute] = value
+
+        self.checkpointed.update(values)
+        self.journal.record(self.journal_key, self.state, values)
+
+    def move_to(self, state):
+        # Unlike transition, this isn't progress - it's not measured, and it's not journaled
+        state_machines.dec(self.kind, self.state)
+        state_machines.inc(self.kind, state)
+        self.state = state
+
+    def restore(self, state, values):
+        self.logging.info(f'State machine "{self.name}" restored in state: "{state}"')
+        self.move_to(state)
+
+        for attribute, value in values.items():
+            setattr(self, attribute, value)
+
+        self.checkpointed = dict(values)
+
+    def rewind(self, state):
+        """
+        Go back to an earlier state of a restored machine, to redo in-memory work that was lost along with the
+        previous swarm process. The state that redoes the last of that work returns fast_forward(next_state),
+        to get the machine back to where it was.
+        """
+        self.resume_state = self.state
+        self.move_to(state)
+
+    def fast_forward(self, next_state):
+        if self.resume_state is None:
+            return next_state
+
+        resume_state, self.resume_state = self.resume_state, None
+
+        # Resuming in the state that's running right now (or an earlier one) would just run it again
+        states = list(self.states)
+        if states.index(resume_state) <= states.index(self.state):
+            return next_state
+
+        return resume_state
 
     def get_next_state(self):
         keys_iter = iter(self.states.keys())
@@ -51,21 +549,130 @@ class RetryingStateMachine:
         except StopIteration:
             return None
 
-    def statemachine(self):
+    def transition(self, new_state):
+        now = time.monotonic()
+
+        state_durations.observe(now - self.state_entered_at, self.kind, self.state)
+        timeline.recorder.span(
+            self.timeline_track,
+            self.state,
+            self.kind,
+            self.state_entered_at,
+            now,
+            {"failed_attempts": self.attempts} if self.attempts else None,
+        )
+        state_transitions.inc(self.kind, self.state, new_state)
+        state_machines.dec(self.kind, self.state)
+        state_machines.inc(self.kind, new_state)
+
+        self.release_stages(new_state)
+
+        self.state = new_state
+        self.state_entered_at = now
+        self.attempts = 0
+        self.last_retry_delay = 0
+
+        self.checkpoint()
+
+    def begin_state(self):
         # States typically don't care what's the next state, so we can just recommend the next one in the list
         next_state = self.get_next_state()
         self.logging.info(f'State machine "{self.name}" running state: "{self.state}"')
+        self.watch_deadline()
+        return next_state
+
+    def call_state(self, state_function, *args):
+        timeline.current_track.set(self.timeline_track)
+        try:
+            return state_function(*args)
+        except Exception as e:
+            self.logging.exception(e)
+            return self.state
 
+    async def call_state_async(self, state_function, *args):
+        timeline.current_track.set(self.timeline_track)
         try:
-            true_next_state = self.states[self.state](next_state)
+            return await state_function(*args)
         except Exception as e:
             self.logging.exception(e)
-            true_next_state = self.state
+            return self.state
 
-        if true_next_state != self.state:
-            self.state = true_next_state
+    def end_state(self, true_next_state):
+        """
+        Move on to the state the state function returned, returns False if the state has to be retried
+        """
+        self.suspension = None
+
+        if self.failure_reason is None and true_next_state != self.state:
+            self.transition(true_next_state)
             return True
 
-        return False
+        if self.failure_reason is None:
+            self.attempts += 1
+            self.failures += 1
+            policy = self.retry_policy()
+
+            if policy.exhausted(self.attempts, time.monotonic() - self.state_entered_at):
+                state_retries_exhausted.inc(self.kind, self.state)
+                self.failure_reason = (
+                    f"gave up after {self.attempts} attempts"
+                    if policy.max_attempts is not None and self.attempts >= policy.max_attempts
+                    else f"exceeded the {policy.deadline:g} second deadline of the state"
+                )
+            elif self.failure_budget is not None and self.failures > self.failure_budget:
+                self.failure_reason = f"used up its failure budget of {self.failure_budget} failed attempts"
+            else:
+                state_retries.inc(self.kind, self.state)
+                return False
+
+        self.fail_now()
+        return True
+
+    def fail_now(self):
+        failed_state = self.state
+        self.logging.error(f'State machine "{self.name}" failed in state "{failed_state}": {self.failure_reason}')
+
+        state_machine_failures.inc(self.kind, failed_state)
+        timeline.recorder.instant(
+            self.timeline_track, "Failing", self.kind, {"state": failed_state, "reason": self.failure_reason}
+        )
+        with failed_machines_lock:
+            failed_machines[self.kind, failed_state, self.failure_reason] += 1
+
+        self.transition(self.retry_policy().failure_state)
+
+        try:
+            self.on_failure()
+        except Exception as e:
+            self.logging.exception(e)
+
+    def retry_policy(self) -> RetryPolicy:
+        return self.retry_policies.get(self.state, default_retry_policy)
+
+    def retry_delay(self):
+        delay = self.retry_policy().delay(self.attempts, self.last_retry_delay)
+
+        self.last_retry_delay = delay
+        state_backoff.inc(self.kind, self.state, amount=delay)
+
+        return delay
+
+    def back_off(self):
+        """
+        Wait before retrying the state, unless the machine is failed meanwhile
+        """
+        if self.failure_requested.wait(self.retry_delay()):
+            self.fail_now()
+
+    async def back_off_async(self):
+        try:
+            await asyncio.wait_for(self.failure_requested_async.wait(), self.retry_delay())
+        except asyncio.TimeoutError:
+            return
 
+        self.fail_now()
 
+    def complete_state(self, true_next_state):
+        if not self.end_state(true_next_state):
+            # Retry again soon
+            self.back_off()
@@ -4,7 +4,6 @@ from collections import OrderedDict
 from pathlib import Path
 import time
 import threading
-from threading import Event
 import logging
 import json
 import subprocess
@@ -12,8 +11,10 @@ import base64
 from collections import OrderedDict
 import requests
 import os
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 
-from statemachine import RetryingStateMachine
+from statemachine import RetryingStateMachine, parse_retry_policies
 from swarmexecutor import SwarmExecutor
 from containerconfig import (
     ContainerConfigWithEnvAndNumLocks,
@@ -21,9 +22,23 @@ from containerconfig import (
     system_container_storage_config,
     system_container_config,
 )
-from agent import SwarmAgentConfig
-from cluster import Cluster, ClusterConfig
+from agent import SwarmAgentConfig, default_failure_budget as default_agent_failure_budget
+from cluster import (
+    Cluster,
+    ClusterConfig,
+    ClusterManifestsSpec,
+    prerender_cluster_manifests,
+    default_failure_budget as default_cluster_failure_budget,
+)
 from swarmkubecache import SwarmKubeCache
+from kubeclient import KubeClient
+import bmhstatuswriter
+from bmhstatuswriter import BmhStatusWriter
+import manifestapplier
+from manifestapplier import ManifestApplier
+from teardown import SwarmTeardown, swarm_identifier_pattern
+from journal import Journal
+from ratelimit import limiter
 
 script_dir = Path(__file__).parent
 
@@ -41,9 +56,41 @@ num_locks = 9000
 bad_lock_return_code = 125
 
 
+# Setup states that would either destroy or try to recreate what the swarm being resumed already has
+skipped_on_resume = (
+    "Killing previous swarm",
+    "Deleting previous swarm storage",
+    "Deleting previous swarm hub objects",
+    "Creating service account",
+    "Creating clusterrolebinding",
+    "Createing tmpfs",
+)
+
+
 class Swarm(RetryingStateMachine):
-    def __init__(self, pull_secret, pull_secret_file, service_url, release_image, ssh_pub_key):
+    def __init__(
+        self,
+        pull_secret,
+        pull_secret_file,
+        service_url,
+        release_image,
+        ssh_pub_key,
+        kube_cache_resync_intervals=None,
+        resume=False,
+        retry_policies=None,
+        failure_budgets=None,
+        prerender_workers=None,
+        manifest_apply=None,
+    ):
         self.ssh_pub_key = ssh_pub_key
+        self.kube_cache_resync_intervals = kube_cache_resync_intervals
+        self.manifest_apply = manifest_apply or {}
+        self.retry_policies = parse_retry_policies(retry_policies)
+        self.failure_budgets = {
+            "agent": default_agent_failure_budget,
+            "cluster": default_cluster_failure_budget,
+            **(failure_budgets or {}),
+        }
         self.pull_secret = pull_secret
         self.pull_secret_file = pull_secret_file
         self.service_url = service_url
@@ -51,10 +98,24 @@ class Swarm(RetryingStateMachine):
         self.logging = logging.getLogger("swarm")
         self.executor = SwarmExecutor(self.logging)
 
-        now_second = int(time.time())
-        self.identifier = f"swarm-{now_second}"
+        # A resumed swarm picks up the identifier (and with it the directory, service account, namespaces and
+        # processes) of the most recent swarm, and continues from where its journal says it got to
+        if resume:
+            self.identifier = self.latest_identifier()
+            self.journal = Journal.load(self.journal_path)
+        else:
+            now_second = int(time.time())
+            self.identifier = f"swarm-{now_second}"
+            self.journal = Journal(self.journal_path)
+
         self.swarm_dir = global_swarm_directory / self.identifier
 
+        # See prerender_manifests
+        self.prerender_workers = prerender_workers
+        self.prerender_plan = None
+        self.prerender_pool = None
+        self.prerendered_manifests_dir = None
+
         super().__init__(
             initial_state="Initializing",
             terminal_state="Ready to create clusters",
@@ -66,6 +127,7 @@ class Swarm(RetryingStateMachine):
                     "Validating system podman lock config": self.validate_system_podman_lock_config,
                     "Killing previous swarm": self.kill_previous_swarm,
                     "Deleting previous swarm storage": self.delete_previous_swarm_storage,
+                    "Deleting previous swarm hub objects": self.delete_previous_swarm_hub_objects,
                     "Creating service account": self.create_serviceaccount,
                     "Creating clusterrolebinding": self.create_cluserrolebinding,
                     "Retrieving service account credentials": self.retrieve_serviceaccount_credentials,
@@ -75,10 +137,12 @@ class Swarm(RetryingStateMachine):
                     "Creating dummy master.ign": self.create_master_ign,
                     "Copying fake coreos-installer": self.copy_fake_coreos_installer,
                     "Createing tmpfs": self.create_tmpfs,
+                    "Starting manifests pre-render": self.start_manifests_prerender,
                     "Creating shared container image storage": self.create_shared_container_image_storage,
                     "Pre-caching service images": self.precache_service_images,
                     "Retrieving binary": self.retrieve_agent_binary,
                     "Creating CA Cert": self.create_ca_cert,
+                    "Starting kube cache": self.start_kube_cache,
                     "Determining hostname": self.determine_hostname,
                     "Ready to create clusters": self.ready_to_create_clusters,
                 }
@@ -87,6 +151,42 @@ class Swarm(RetryingStateMachine):
             name=f"Swarm",
         )
 
+        if resume:
+            for state in skipped_on_resume:
+                self.states[state] = self.skip_on_resume
+
+    @staticmethod
+    def latest_identifier():
+        identifiers = [
+            path.stem
+            for path in global_swarm_directory.glob("swarm-*.journal")
+            if swarm_identifier_pattern.match(path.stem) is not None
+        ]
+
+        if not identifiers:
+            raise Exception(f"There's no swarm to resume, no swarm journal found in {global_swarm_directory}")
+
+        return max(identifiers, key=lambda identifier: int(identifier.split("-")[1]))
+
+    @property
+    def journal_path(self):
+        # Next to the swarm directory rather than inside it, as the swarm directory gets a tmpfs mounted over it
+        return global_swarm_directory / f"{self.identifier}.journal"
+
+    def journaled_clusters(self):
+        """
+        The indices of the clusters launched by the swarm being resumed, mapped to whether they finished (or failed)
+        """
+        return {
+            Cluster.journaled_cluster_index(key): entry["state"] in ("Done", "Failed")
+            for key, entry in self.journal.entries.items()
+            if Cluster.journaled_cluster_index(key) is not None
+        }
+
+    def skip_on_resume(self, next_state):
+        self.logging.info(f'Skipping "{self.state}", resuming swarm {self.identifier}')
+        return next_state
+
     def copy_fake_coreos_installer(self, next_state):
         self.executor.check_call(["sudo", "cp", str(script_dir / "dry-installer"), "/usr/local/bin/"])
         return next_state
@@ -296,6 +396,59 @@ class Swarm(RetryingStateMachine):
 
         return next_state
 
+    def prerender_manifests(self, plan):
+        """
+        Have the manifests of every cluster of the plan rendered ahead of time, in a pool of worker processes, while
+        the rest of the swarm's setup states run (and then while clusters run) - rather than by each cluster as it
+        starts, competing with all the other clusters and agents over the GIL. Must be called before the swarm is
+        started. Clusters that are launched before their manifests are ready render them on their own.
+        """
+        self.prerender_plan = plan
+
+    def start_manifests_prerender(self, next_state):
+        if self.prerender_plan is None:
+            return next_state
+
+        # Inside the tmpfs, so it can only be created once the tmpfs is mounted
+        self.prerendered_manifests_dir = self.swarm_dir / "prerendered-manifests"
+        self.prerendered_manifests_dir.mkdir(parents=True, exist_ok=True)
+
+        # Spawned rather than forked, as this process already runs threads (e.g. the executor's reaper)
+        self.prerender_pool = ProcessPoolExecutor(
+            max_workers=self.prerender_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+        for index, (single_node, num_workers, with_nmstate, just_infraenv, infraenv_labels) in enumerate(
+            self.prerender_plan
+        ):
+            spec = ClusterManifestsSpec(
+                swarm_identifier=self.identifier,
+                index=index,
+                release_image=self.release_image,
+                ssh_pub_key=self.ssh_pub_key,
+                pull_secret=self.pull_secret,
+                single_node=single_node,
+                num_workers=num_workers,
+                with_nmstate=with_nmstate,
+                just_infraenv=just_infraenv,
+                infraenv_labels=infraenv_labels,
+            )
+            prerendered = self.prerender_pool.submit(prerender_cluster_manifests, spec, self.prerendered_manifests_dir)
+            prerendered.add_done_callback(self.prerendered)
+
+        self.logging.info(f"Pre-rendering the manifests of {len(self.prerender_plan)} clusters in the background")
+
+        return next_state
+
+    def prerendered(self, future):
+        if future.cancelled():
+            return
+
+        error = future.exception()
+        if error is not None:
+            # Not fatal, the cluster renders its manifests on its own
+            self.logging.warning(f"Failed to pre-render cluster manifests: {error!r}")
+
     def retrieve_agent_binary(self, next_state):
         agent_binary_dir = self.swarm_dir / "bin"
         agent_binary_dir.mkdir(parents=True, exist_ok=True)
@@ -337,13 +490,22 @@ class Swarm(RetryingStateMachine):
         self.agent_bin = agent_binary_dir / "agent"
         return next_state
 
+    @property
+    def previous_swarm_teardown(self):
+        return SwarmTeardown(self.executor, global_swarm_directory, keep_identifier=self.identifier)
+
     def kill_previous_swarm(self, next_state):
-        # TODO: Find previous swarm and kill all processes
+        self.previous_swarm_teardown.run(["processes"])
 
         return next_state
 
     def delete_previous_swarm_storage(self, next_state):
-        # TODO: Find previous swarm storage and delete it
+        self.previous_swarm_teardown.run(["mounts", "storage", "logs"])
+
+        return next_state
+
+    def delete_previous_swarm_hub_objects(self, next_state):
+        self.previous_swarm_teardown.run(["serviceaccounts", "namespaces"])
 
         return next_state
 
@@ -354,6 +516,7 @@ class Swarm(RetryingStateMachine):
         return next_state
 
     def get_image_urls_from_service(self, next_state):
+        limiter.acquire("service", "get")
         resp = requests.get(
             f"{self.service_url}/api/assisted-install/v2/component-versions",
             verify=False,
@@ -372,17 +535,61 @@ class Swarm(RetryingStateMachine):
 
     def initialize(self, next_state):
         self.kube_cache_done = threading.Event()
-        self.kube_cache = SwarmKubeCache(self.kube_cache_done)
+        self.kube_cache_thread = None
+        self.manifest_applier = None
+        self.bmh_status_writer = None
+
+        return next_state
+
+    def start_kube_cache(self, next_state):
+        # The cache talks to the kube-api directly, so it can only start once we have the
+        # service account credentials and the CA cert
+        self.kube_client = KubeClient(self.k8s_api_server_url, self.token, verify=str(self.ca_cert_path))
+        self.kube_cache = SwarmKubeCache(
+            self.kube_cache_done,
+            self.kube_client,
+            swarm_identifier=self.identifier,
+            resync_intervals=self.kube_cache_resync_intervals,
+        )
         self.kube_cache_thread = threading.Thread(target=self.kube_cache.monitor, args=())
         self.kube_cache_thread.start()
 
+        # Its own client, so that its connection pool is as large as the amount of objects it creates at once
+        workers = self.manifest_apply.get("workers", manifestapplier.default_workers)
+        self.manifest_applier = ManifestApplier(
+            KubeClient(self.k8s_api_server_url, self.token, verify=str(self.ca_cert_path), pool_size=workers),
+            **self.manifest_apply,
+        )
+        self.bmh_status_writer = BmhStatusWriter(
+            KubeClient(
+                self.k8s_api_server_url,
+                self.token,
+                verify=str(self.ca_cert_path),
+                pool_size=bmhstatuswriter.default_workers,
+            ),
+            self.kube_cache,
+        )
+
         return next_state
 
     def finalize(self):
-        self.kube_cache_done.set()
-        self.kube_cache_thread.join()
+        if self.kube_cache_thread is not None:
+            self.kube_cache.stop()
+            self.kube_cache_thread.join()
+
+        if self.manifest_applier is not None:
+            self.manifest_applier.close()
+
+        if self.bmh_status_writer is not None:
+            self.bmh_status_writer.close()
+
+        if self.prerender_pool is not None:
+            self.prerender_pool.shutdown(wait=False, cancel_futures=True)
 
-    def launch_cluster(
+        self.executor.reaper.stop()
+        self.journal.close()
+
+    def create_cluster(
         self,
         index,
         task_pool,
@@ -391,10 +598,11 @@ class Swarm(RetryingStateMachine):
         with_nmstate,
         just_infraenv,
         infraenv_labels,
-        can_start_agents: Event,
-        started_all_agents: Event,
+        admission,
+        pipeline,
+        teardown=False,
     ):
-        cluster = Cluster(
+        return Cluster(
             ClusterConfig(
                 logging=self.logging,
                 single_node=single_node,
@@ -415,8 +623,15 @@ class Swarm(RetryingStateMachine):
                 kube_cache=self.kube_cache,
                 executor=self.executor,
                 shared_graphroot=self.shared_graphroot,
-                can_start_agents=can_start_agents,
-                started_all_agents=started_all_agents,
+                admission=admission,
+                pipeline=pipeline,
+                kube_client=self.kube_client,
+                manifest_applier=self.manifest_applier,
+                teardown=teardown,
+                journal=self.journal,
+                retry_policies=self.retry_policies.get("cluster", {}),
+                failure_budget=self.failure_budgets["cluster"],
+                prerendered_manifests_dir=self.prerendered_manifests_dir,
             ),
             SwarmAgentConfig(
                 agent_binary=self.agent_bin,
@@ -432,9 +647,26 @@ class Swarm(RetryingStateMachine):
                 shared_graphroot=self.shared_graphroot,
                 k8s_api_server_url=self.k8s_api_server_url,
                 kube_cache=self.kube_cache,
+                bmh_status_writer=self.bmh_status_writer,
                 num_locks=num_locks,
+                retry_policies=self.retry_policies.get("agent", {}),
+                failure_budget=self.failure_budgets["agent"],
             ),
         )
 
+    def launch_cluster(self, clusters_task_pool, **kwargs):
+        """
+        Start a cluster on the clusters task pool, returns the cluster (whose finished future can be waited on)
+        """
+        cluster = self.create_cluster(**kwargs)
+
+        self.logging.info("Launching cluster")
+        clusters_task_pool.submit(cluster.start, clusters_task_pool)
+
+        return cluster
+
+    async def launch_cluster_async(self, **kwargs):
+        cluster = self.create_cluster(task_pool=None, **kwargs)
+
         self.logging.info("Launching cluster")
-        return cluster.start()
+        return await cluster.start_async()
@@ -1,10 +1,36 @@
 import os
 import subprocess
+import time
+
+import metrics
+import timeline
+from processreaper import ProcessReaper
+
+executor_commands = metrics.Counter(
+    "swarm_executor_commands_total", "Commands executed by the swarm", ("command", "method")
+)
+
+
+def command_name(command):
+    """
+    The name of the binary a command runs, looking past sudo and its flags
+    """
+    if isinstance(command, str):
+        command = command.split()
+
+    for argument in command:
+        if argument == "sudo" or argument.startswith("-"):
+            continue
+
+        return os.path.basename(argument)
+
+    return ""
 
 
 class SwarmExecutor:
     def __init__(self, logging):
         self.logging = logging
+        self.reaper = ProcessReaper()
 
     def log_cmd(self, *args, **kwargs):
         def dictionary_diff(a, b):
@@ -22,15 +48,60 @@ class SwarmExecutor:
 
     def Popen(self, *args, **kwargs):
         self.log_cmd(*args, **kwargs)
-        return subprocess.Popen(*args, **kwargs)
+        executor_commands.inc(command_name(args[0]), "Popen")
+        process = subprocess.Popen(*args, **kwargs)
 
-    def check_call(self, *args, **kwargs):
+        # For the timeline, the process' span ends once it's reaped, see supervise
+        process.started_at = time.monotonic()
+        process.timeline_track = timeline.current_track.get()
+
+        return process
+
+    def supervise(self, process: subprocess.Popen):
+        """
+        Hand a started process over to the reaper, returns a future of its exit code
+        """
+        exited = self.reaper.watch(process, command_name(process.args))
+
+        if timeline.recorder.enabled:
+            exited.add_done_callback(
+                lambda future: timeline.recorder.command(
+                    process.timeline_track,
+                    command_name(process.args),
+                    process.started_at,
+                    time.monotonic(),
+                    {"returncode": future.result()},
+                )
+            )
+
+        return exited
+
+    def timed(self, method, run, *args, **kwargs):
+        """
+        Run a command to completion with the given subprocess function, recording it on the timeline
+        """
         self.log_cmd(*args, **kwargs)
-        return subprocess.check_call(*args, **kwargs)
+        executor_commands.inc(command_name(args[0]), method)
+
+        track = timeline.current_track.get()
+        started = time.monotonic()
+        try:
+            return run(*args, **kwargs)
+        finally:
+            timeline.recorder.command(track, command_name(args[0]), started, time.monotonic())
+
+    def adopt(self, pid, command, marker):
+        """
+        Supervise a process left running by a previous incarnation of the swarm, returns a future of its
+        exit code (always None), or None if it's no longer running. See ProcessReaper.adopt
+        """
+        return self.reaper.adopt(pid, command, marker)
+
+    def check_call(self, *args, **kwargs):
+        return self.timed("check_call", subprocess.check_call, *args, **kwargs)
 
     def check_output(self, *args, **kwargs) -> bytes:
-        self.log_cmd(*args, **kwargs)
-        output = subprocess.check_output(*args, **kwargs)
+        output = self.timed("check_output", subprocess.check_output, *args, **kwargs)
 
         if type(output) is bytes:
             return output
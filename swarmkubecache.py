@@ -1,51 +1,598 @@
-import subprocess
-import json
+import asyncio
+import logging
+import threading
 import time
+from collections import defaultdict
 from threading import Event
 
+import metrics
+import timeline
+from kubeclient import KubeClient, ResourceExpired, api_types
+from kubeprojection import ConditionedObject, projections
+
+# Every object the swarm creates carries this label, with the swarm identifier as the
+# value, so that we only ever fetch our own objects from a (potentially shared) hub
+swarm_label = "assisted-swarm.openshift.io/swarm"
+
+# The API types the cache follows. Agents are created by the service rather than by the swarm, they get the
+# swarm label through their InfraEnv's agentLabels
+cached_api_types = ("agentclusterinstalls", "agents", "baremetalhosts", "clusterdeployments", "infraenvs")
+
+# How long state machines wait on the cache before giving up and letting their state be retried
+default_wait_timeout = 60
+
+# How often each API type is fully relisted, on top of following its watch. Watches are
+# reliable, so this is mostly a safety net against missed events
+default_resync_intervals = {
+    "agentclusterinstalls": 300,
+    "agents": 300,
+    "baremetalhosts": 600,
+    "clusterdeployments": 600,
+    "infraenvs": 300,
+}
+
+# The pseudo condition of an object having been seen at all, see SwarmKubeCache.record_transitions
+seen_condition = ("Seen", "True")
+
+# Types nobody is waiting on get their resync interval doubled on every idle resync, up to this many doublings
+max_idle_backoff = 4
+
+# Upper bound of the delay between attempts to recover a failing list / watch
+max_failure_backoff = 60
+
+list_durations = metrics.Histogram(
+    "swarm_kube_cache_list_duration_seconds", "Time it took to fully (re)list an API type", ("api_type",)
+)
+watch_events = metrics.Counter(
+    "swarm_kube_cache_watch_events_total", "Watch events applied to the cache", ("api_type", "event_type")
+)
+cached_objects = metrics.Gauge("swarm_kube_cache_objects", "Number of cached objects", ("api_type",))
+condition_latencies = metrics.Histogram(
+    "swarm_kube_condition_latency_seconds",
+    "Time from the swarm first seeing an object to first seeing each of its conditions in each status",
+    ("api_type", "condition", "status"),
+)
+cache_staleness = metrics.Gauge(
+    "swarm_kube_cache_staleness_seconds", "Seconds since the API type was last known to be in sync", ("api_type",)
+)
+
+
+class Subscription:
+    """
+    A request to be called back (once) when a cached object satisfies a predicate
+    """
+
+    def __init__(self, api_type, key, predicate, callback):
+        self.api_type = api_type
+        self.key = key
+        self.predicate = predicate
+        self.callback = callback
+        self.fired = False
+
+
+def updated_index(index, bucket_key, name, record):
+    """
+    Copy-on-write update of a two level index (bucket_key -> name -> record). Only the outer
+    dict and the single affected bucket are copied, every other bucket is shared with the
+    original index. A record of None removes the name from the bucket.
+    """
+    index = dict(index)
+    bucket = dict(index.get(bucket_key, {}))
+
+    if record is None:
+        bucket.pop(name, None)
+    else:
+        bucket[name] = record
+
+    if bucket:
+        index[bucket_key] = bucket
+    else:
+        index.pop(bucket_key, None)
+
+    return index
+
+
+class CacheGeneration:
+    """
+    An immutable snapshot of all the cached objects of a single API type.
+
+    Generations are never modified after they've been published - every change creates a new
+    generation (sharing as much as possible with the previous one), which then replaces the old
+    one with a single reference assignment. Readers simply grab the current generation and get a
+    consistent view without taking any locks, no matter how many updates happen meanwhile.
+
+    Objects are indexed by namespace and by label (label -> namespace -> name), so questions like
+    "all BMHs in my namespace" are answered in time proportional to the answer.
+    """
+
+    __slots__ = ("number", "by_namespace", "by_label", "count")
+
+    def __init__(self, number, by_namespace, by_label, count):
+        self.number = number
+        self.by_namespace = by_namespace
+        self.by_label = by_label
+        self.count = count
+
+    @classmethod
+    def build(cls, number, records):
+        by_namespace = defaultdict(dict)
+        by_label = defaultdict(lambda: defaultdict(dict))
+
+        for record in records:
+            by_namespace[record.namespace][record.name] = record
+
+            for label in record.labels:
+                by_label[label][record.namespace][record.name] = record
+
+        return cls(
+            number,
+            dict(by_namespace),
+            {label: dict(namespaces) for label, namespaces in by_label.items()},
+            sum(len(bucket) for bucket in by_namespace.values()),
+        )
+
+    def get(self, namespace, name):
+        return self.by_namespace.get(namespace, {}).get(name, None)
+
+    def in_namespace(self, namespace):
+        return list(self.by_namespace.get(namespace, {}).values())
+
+    def with_label(self, key, value, namespace=None):
+        namespaces = self.by_label.get((key, value), {})
+
+        if namespace is not None:
+            return list(namespaces.get(namespace, {}).values())
+
+        return [record for bucket in namespaces.values() for record in bucket.values()]
+
+    def __iter__(self):
+        for bucket in self.by_namespace.values():
+            yield from bucket.values()
+
+    def replace(self, namespace, name, record):
+        """
+        Create the next generation, with the object namespace/name replaced by record (or removed if record is None)
+        """
+        old_record = self.get(namespace, name)
+
+        by_label = self.by_label
+
+        if old_record is not None:
+            for label in old_record.labels:
+                by_label = {**by_label, label: updated_index(by_label.get(label, {}), namespace, name, None)}
+                if not by_label[label]:
+                    del by_label[label]
+
+        if record is not None:
+            for label in record.labels:
+                by_label = {**by_label, label: updated_index(by_label.get(label, {}), namespace, name, record)}
+
+        return CacheGeneration(
+            self.number + 1,
+            updated_index(self.by_namespace, namespace, name, record),
+            by_label,
+            self.count - (old_record is not None) + (record is not None),
+        )
+
 
 class SwarmKubeCache:
     """
-    Periodically fetch swarm-related kube-api objects and store them in a cache.
+    Keep an in-memory cache of swarm-related kube-api objects.
     This gives swarm agents an in-memory cache of the kube-api objects, to avoid each agent
     blasting the kube-api endpoint with requests (and consuming a lot of memory, CPU, and network
     resources in the process).
+
+    Every API type is listed once, and from then on the cache is kept up to date by consuming
+    the kube-api watch event stream starting from the list's resourceVersion. The objects are
+    only listed again when the API tells us our resourceVersion is too old (410 Gone) or when
+    the watch fails in some other unexpected way.
+
+    Both listing and watching are scoped with a label selector on the swarm identifier, so
+    objects belonging to other swarms (or to real users of the hub) are never even sent to us,
+    and lists are paginated so no single response grows with the size of the hub.
+
+    Each API type's objects are published as immutable generations (see CacheGeneration), so
+    readers always get a consistent snapshot, and objects deleted from the hub are evicted.
+
+    The cache doesn't keep the full objects, only compact projections of the few fields the swarm
+    reads (see kubeprojection.py). Callers which need the full object can fetch it on demand with
+    get_full_object.
+
+    Every API type is monitored by its own thread, on its own schedule, so a slow list of one
+    type never delays the others. staleness() reports how far behind the hub each type might be.
+
+    Rather than polling the cache, swarm state machines can subscribe to a particular object
+    and get woken up the moment a cache update makes a condition about it true.
+
+    For types whose projections keep conditions (see ConditionedObject) the cache records when it first saw
+    every (condition, status) of every object, which measures how long the service takes to reconcile them
+    without scraping the hub after the fact. Transitions also go on the timeline, on the track of the state
+    machine the object belongs to (see track_object).
     """
-    def __init__(self, done: Event):
-        self.cache = {
-            "agentclusterinstalls": {},
-            "baremetalhosts": {},
-            "infraenvs": {},
-        }
+
+    def __init__(self, done: Event, kube_client: KubeClient, swarm_identifier, page_size=500, resync_intervals=None):
+        # Only the monitor thread of each API type ever replaces its generation
+        self.generations = {api_type: CacheGeneration.build(0, ()) for api_type in cached_api_types}
 
         self.done = done
+        self.kube_client = kube_client
+        self.label_selector = f"{swarm_label}={swarm_identifier}"
+        self.page_size = page_size
+        self.resync_intervals = {**default_resync_intervals, **(resync_intervals or {})}
+        self.logging = logging.getLogger("swarm")
+
+        self.responses_lock = threading.Lock()
+        self.responses = {}
+
+        self.subscriptions_lock = threading.Lock()
+        self.subscriptions = defaultdict(list)
+
+        # (api_type, namespace, name) -> {(condition, status): monotonic time first seen}, and -> timeline track
+        self.transitions = defaultdict(dict)
+        self.object_tracks = {}
+
+        # Monotonic time at which we last knew each type to be in sync with the hub, and whether
+        # a watch is currently streaming updates for it (in which case it's never stale)
+        self.synced_at = {api_type: None for api_type in cached_api_types}
+        self.watching = {api_type: False for api_type in cached_api_types}
+        self.idle_resyncs = {api_type: 0 for api_type in cached_api_types}
+
+        cached_objects.set_function(
+            lambda: {(api_type,): generation.count for api_type, generation in self.generations.items()}
+        )
+        cache_staleness.set_function(
+            lambda: {(api_type,): staleness for api_type, staleness in self.staleness().items()}
+        )
+
+    def snapshot(self, api_type) -> CacheGeneration:
+        return self.generations[api_type]
+
+    def get(self, api_type, name, namespace):
+        return self.generations[api_type].get(namespace, name)
+
+    def list_namespace(self, api_type, namespace):
+        return self.generations[api_type].in_namespace(namespace)
+
+    def list_label(self, api_type, key, value, namespace=None):
+        return self.generations[api_type].with_label(key, value, namespace)
 
     def get_infraenv(self, name, namespace):
-        return self.cache["infraenvs"].get(f"{namespace}/{name}", None)
+        return self.get("infraenvs", name, namespace)
 
     def get_agent_cluster_install(self, name, namespace):
-        return self.cache["agentclusterinstalls"].get(f"{namespace}/{name}", None)
+        return self.get("agentclusterinstalls", name, namespace)
 
     def get_baremetalhost(self, name, namespace):
-        return self.cache["baremetalhosts"].get(f"{namespace}/{name}", None)
+        return self.get("baremetalhosts", name, namespace)
 
-    def cache_api_type(self, api_type):
+    def get_full_object(self, api_type, name, namespace):
         """
-        Cache all the kube-api objects of a given type.
+        Fetch the complete, up-to-date object straight from the kube-api, bypassing the cache
         """
-        result = json.loads(subprocess.check_output(["oc", "get", api_type, "-A", "-ojson"]).decode("utf-8"))
+        return self.kube_client.get(api_types[api_type], namespace, name)
 
-        for api_object in result["items"]:
-            self.cache[api_type][f"{api_object['metadata']['namespace']}/{api_object['metadata']['name']}"] = api_object
+    def condition_transitions(self, api_type, namespace, name):
+        """
+        When (in time.monotonic() terms) each (condition, status) of the object was first seen
+        """
+        return dict(self.transitions.get((api_type, namespace, name), {}))
+
+    def track_object(self, api_type, namespace, name, track):
+        """
+        Put the object's condition transitions on the given timeline track
+        """
+        self.object_tracks[(api_type, namespace, name)] = track
+
+    def record_transitions(self, api_type, old_record, record):
+        if not isinstance(record, ConditionedObject):
+            return
+
+        key = (api_type, record.namespace, record.name)
+        first_seen = self.transitions[key]
+
+        new_states = set(record.condition_states()) - set(old_record.condition_states() if old_record else ())
+        new_states = [state for state in (seen_condition, *new_states) if state not in first_seen]
+        if not new_states:
+            return
+
+        now = time.monotonic()
+        seen_at = first_seen.setdefault(seen_condition, now)
+        track = self.object_tracks.get(key, (record.namespace, f"{record.kind} {record.name}"))
+
+        for condition, status in new_states:
+            first_seen[(condition, status)] = now
+            condition_latencies.observe(now - seen_at, api_type, condition, status)
+            timeline.recorder.instant(track, f"{record.kind} {condition}={status}", "kube", {"name": record.name})
+
+    def forget_object(self, api_type, namespace, name):
+        self.transitions.pop((api_type, namespace, name), None)
+        self.object_tracks.pop((api_type, namespace, name), None)
+
+    def subscribe(self, api_type, namespace, name, predicate, callback):
+        """
+        Call callback (from a cache thread) with the projected object once the cached object with the given
+        namespace/name exists and predicate(object) is truthy. If that's already the case, the
+        callback is called immediately from the calling thread.
+        """
+        subscription = Subscription(api_type, (namespace, name), predicate, callback)
+
+        with self.subscriptions_lock:
+            self.subscriptions[(api_type, subscription.key)].append(subscription)
+
+        # Updates that happen from now on will notify the subscription, but the
+        # object might already be in the desired state
+        self.check_subscription(subscription, self.generations[api_type].get(namespace, name))
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.subscriptions_lock:
+            subscriptions = self.subscriptions.get((subscription.api_type, subscription.key), [])
+
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+
+            if not subscriptions:
+                self.subscriptions.pop((subscription.api_type, subscription.key), None)
+
+    def check_subscription(self, subscription: Subscription, api_object):
+        if api_object is None:
+            return
+
+        try:
+            satisfied = subscription.predicate(api_object)
+        except Exception as e:
+            self.logging.exception(e)
+            return
+
+        if not satisfied:
+            return
+
+        with self.subscriptions_lock:
+            if subscription.fired:
+                return
+
+            subscription.fired = True
+
+        self.unsubscribe(subscription)
+        subscription.callback(api_object)
+
+    def notify(self, api_type, key):
+        with self.subscriptions_lock:
+            subscriptions = list(self.subscriptions.get((api_type, key), ()))
+
+        if not subscriptions:
+            return
+
+        api_object = self.generations[api_type].get(*key)
+
+        for subscription in subscriptions:
+            self.check_subscription(subscription, api_object)
+
+    def notify_all(self, api_type):
+        with self.subscriptions_lock:
+            keys = [key for subscribed_api_type, key in self.subscriptions if subscribed_api_type == api_type]
+
+        for key in keys:
+            self.notify(api_type, key)
+
+    def has_subscribers(self, api_type):
+        with self.subscriptions_lock:
+            return any(subscribed_api_type == api_type for subscribed_api_type, _ in self.subscriptions)
+
+    def staleness(self):
+        """
+        Seconds since each API type was last known to be in sync with the hub (None if never synced)
+        """
+        now = time.monotonic()
+
+        return {
+            api_type: 0.0 if self.watching[api_type] else (None if synced_at is None else now - synced_at)
+            for api_type, synced_at in self.synced_at.items()
+        }
+
+    def resync_interval(self, api_type):
+        """
+        The time until the next full relist of api_type. Types that nothing is waiting on back off
+        exponentially, as there's no point in putting load on the hub just to keep them fresh.
+        """
+        if self.has_subscribers(api_type):
+            self.idle_resyncs[api_type] = 0
+        else:
+            self.idle_resyncs[api_type] = min(self.idle_resyncs[api_type] + 1, max_idle_backoff)
+
+        return self.resync_intervals[api_type] * 2 ** self.idle_resyncs[api_type]
+
+    def wait_for(self, api_type, namespace, name, predicate, timeout=default_wait_timeout):
+        """
+        Block until the cached object with the given namespace/name satisfies predicate, returns
+        the projected object, or None if that didn't happen within timeout seconds
+        """
+        satisfied = Event()
+        result = []
+
+        def on_satisfied(api_object):
+            result.append(api_object)
+            satisfied.set()
+
+        subscription = self.subscribe(api_type, namespace, name, predicate, on_satisfied)
+
+        if not satisfied.wait(timeout):
+            self.unsubscribe(subscription)
+
+        return result[0] if result else None
+
+    async def wait_for_async(self, api_type, namespace, name, predicate, timeout=default_wait_timeout):
+        """
+        Like wait_for, but awaits on the running event loop rather than blocking a thread
+        """
+        loop = asyncio.get_running_loop()
+        satisfied = loop.create_future()
+
+        def set_result(api_object):
+            if not satisfied.done():
+                satisfied.set_result(api_object)
+
+        subscription = self.subscribe(
+            api_type,
+            namespace,
+            name,
+            predicate,
+            lambda api_object: loop.call_soon_threadsafe(set_result, api_object),
+        )
+
+        try:
+            return await asyncio.wait_for(satisfied, timeout)
+        except asyncio.TimeoutError:
+            self.unsubscribe(subscription)
+            return None
+
+    def list_api_type(self, api_type):
+        """
+        Cache all the kube-api objects of a given type in a brand new generation, which replaces
+        whatever was cached before (so objects that were deleted while we weren't watching are evicted).
+
+        Returns the resourceVersion of the list, which is where watching should start from.
+        """
+        records = []
+        projection = projections[api_type]
+        list_start = time.monotonic()
+
+        for page in self.kube_client.list_pages(
+            api_types[api_type], label_selector=self.label_selector, limit=self.page_size
+        ):
+            records.extend(projection(api_object) for api_object in page["items"])
+            resource_version = page["metadata"]["resourceVersion"]
+
+        self.synced_at[api_type] = time.monotonic()
+        list_durations.observe(self.synced_at[api_type] - list_start, api_type)
+
+        previous_generation = self.generations[api_type]
+        for record in records:
+            self.record_transitions(api_type, previous_generation.get(record.namespace, record.name), record)
+
+        generation = CacheGeneration.build(previous_generation.number + 1, records)
+        self.generations[api_type] = generation
+
+        evicted = [
+            (record.namespace, record.name)
+            for record in previous_generation
+            if generation.get(record.namespace, record.name) is None
+        ]
+        for namespace, name in evicted:
+            self.forget_object(api_type, namespace, name)
+
+        if evicted:
+            self.logging.info(f"Evicted {len(evicted)} deleted {api_type} from the cache")
+
+        self.notify_all(api_type)
+
+        return resource_version
+
+    def apply_event(self, api_type, event):
+        """
+        Apply a single watch event to the cache, returns the resourceVersion the event brings us to
+        """
+        api_object = event["object"]
+        metadata = api_object["metadata"]
+        watch_events.inc(api_type, event["type"])
+
+        if event["type"] in ("ADDED", "MODIFIED"):
+            record = projections[api_type](api_object)
+            generation = self.generations[api_type]
+
+            self.record_transitions(api_type, generation.get(record.namespace, record.name), record)
+            self.generations[api_type] = generation.replace(metadata["namespace"], metadata["name"], record)
+            self.notify(api_type, (metadata["namespace"], metadata["name"]))
+        elif event["type"] == "DELETED":
+            self.generations[api_type] = self.generations[api_type].replace(
+                metadata["namespace"], metadata["name"], None
+            )
+            self.forget_object(api_type, metadata["namespace"], metadata["name"])
+
+        self.synced_at[api_type] = time.monotonic()
+
+        # BOOKMARK events carry nothing but the resourceVersion
+        return api_object["metadata"]["resourceVersion"]
+
+    def track_response(self, api_type, response):
+        with self.responses_lock:
+            self.responses[api_type] = response
+
+        self.watching[api_type] = True
+        self.synced_at[api_type] = time.monotonic()
+
+        # We might have been stopped while the request was in flight
+        if self.done.is_set():
+            self.kube_client.interrupt(response)
+
+    def watch_api_type(self, api_type, resource_version, timeout_seconds):
+        """
+        Consume watch events until the server ends the stream, returns the last seen resourceVersion
+        """
+        try:
+            for event in self.kube_client.watch(
+                api_types[api_type],
+                resource_version,
+                label_selector=self.label_selector,
+                timeout_seconds=timeout_seconds,
+                on_response=lambda response: self.track_response(api_type, response),
+            ):
+                resource_version = self.apply_event(api_type, event)
+        finally:
+            if self.watching[api_type]:
+                self.watching[api_type] = False
+                self.synced_at[api_type] = time.monotonic()
+
+        return resource_version
+
+    def monitor_api_type(self, api_type):
+        resource_version = None
+        next_resync = 0
+        failures = 0
 
-    def monitor(self):
         while not self.done.is_set():
-            for api_type in self.cache:
-                try:
-                    self.cache_api_type(api_type)
-                except Exception:
-                    # API is imperfect, this is okay, just try again later
-                    pass
+            try:
+                if resource_version is None or time.monotonic() >= next_resync:
+                    resource_version = self.list_api_type(api_type)
+                    next_resync = time.monotonic() + self.resync_interval(api_type)
+
+                # Have the server end the watch when it's time to resync
+                resource_version = self.watch_api_type(
+                    api_type, resource_version, timeout_seconds=max(1, int(next_resync - time.monotonic()))
+                )
+                failures = 0
+            except ResourceExpired:
+                self.logging.info(f"Watch on {api_type} expired, relisting")
+                resource_version = None
+            except Exception as e:
+                if self.done.is_set():
+                    break
+
+                # API is imperfect, this is okay, just relist a bit later
+                failures += 1
+                delay = min(max_failure_backoff, 2 ** failures)
+                self.logging.info(f"Watch on {api_type} failed, relisting in {delay} seconds: {e}")
+                resource_version = None
+                self.done.wait(delay)
+
+    def monitor(self):
+        threads = [
+            threading.Thread(target=self.monitor_api_type, args=(api_type,), name=f"kube-cache-{api_type}")
+            for api_type in self.generations
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        self.done.set()
 
-            time.sleep(5)
+        with self.responses_lock:
+            for response in self.responses.values():
+                self.kube_client.interrupt(response)
 
+        self.kube_client.close()
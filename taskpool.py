@@ -1,19 +1,46 @@
+import concurrent.futures
+import threading
 from concurrent.futures import ThreadPoolExecutor
 
 class TaskPool(ThreadPoolExecutor):
     """
     A wrapper around ThreadPoolExecutor that keeps track of submissions
-    so they can be waited on, and also provides a delayed start() method
+    so they can be waited on, and also provides a delayed start() method.
+
+    Submissions that completed successfully are forgotten, so that a long running swarm
+    (see soak mode) doesn't accumulate them forever - there's nothing to wait on anyway.
     """
     def __init__(self, *args, **kargs):
         super().__init__(*args, **kargs)
-        self.submissions = []
+        self.submissions_lock = threading.Lock()
+        self.submissions = set()
 
     def submit(self, func, *args, **kwargs):
         submission = super().submit(func, *args, **kwargs)
-        self.submissions.append(submission)
-        return submission 
+
+        with self.submissions_lock:
+            self.submissions.add(submission)
+
+        submission.add_done_callback(self.forget)
+        return submission
+
+    def forget(self, submission):
+        if submission.exception() is None:
+            with self.submissions_lock:
+                self.submissions.discard(submission)
 
     def wait(self):
-        for submission in self.submissions:
+        # Running submissions might submit more, so wait until there's nothing left running
+        while True:
+            with self.submissions_lock:
+                submissions = list(self.submissions)
+
+            pending = [submission for submission in submissions if not submission.done()]
+            if not pending:
+                break
+
+            concurrent.futures.wait(pending)
+
+        # Raise the failures, if any
+        for submission in submissions:
             submission.result()
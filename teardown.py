@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import plac
+
+import metrics
+from swarmexecutor import SwarmExecutor
+
+teardown_phase_durations = metrics.Histogram(
+    "swarm_teardown_phase_duration_seconds", "Time it took to tear down previous swarms, by phase", ("phase",)
+)
+
+# Swarm identifiers are swarm-<creation second>, and everything that belongs to a swarm (cluster
+# namespaces, hostnames, directories) is named after its identifier followed by a dash
+swarm_identifier_pattern = re.compile(r"^swarm-\d+$")
+swarm_owned_name_pattern = re.compile(r"^(swarm-\d+)-")
+
+# In the order they run, each phase depends on the ones before it (e.g. storage can only be removed
+# once it's unmounted, and it can only be unmounted once the processes using it are gone)
+teardown_phases = ("processes", "mounts", "storage", "logs", "serviceaccounts", "namespaces")
+
+default_parallelism = 16
+
+# How many objects to delete with a single oc command
+delete_chunk_size = 100
+
+
+def find_processes(marker: str, exclude: str = None):
+    """
+    Pids of all processes that mention the marker (typically a swarm / cluster directory) in their
+    command line or environment, except for those that also mention exclude. Swarm processes (agents,
+    controllers, and the containers they run) all have container configuration files from their
+    directory in their environment, so this finds them even after they've been reparented or re-exec'd.
+    """
+    marker = marker.encode("utf-8")
+    exclude = exclude.encode("utf-8") if exclude is not None else None
+    pids = []
+
+    for proc_dir in Path("/proc").iterdir():
+        if not proc_dir.name.isdigit() or int(proc_dir.name) == os.getpid():
+            continue
+
+        try:
+            contents = (proc_dir / "cmdline").read_bytes() + b"\0" + (proc_dir / "environ").read_bytes()
+        except OSError:
+            # Exited while we were looking at it, or a kernel thread
+            continue
+
+        if marker in contents and (exclude is None or exclude not in contents):
+            pids.append(int(proc_dir.name))
+
+    return pids
+
+
+def kill_processes(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def find_mounts(under: Path):
+    """
+    Mount points under the given directory, deepest first so they can be unmounted in order. Mounts
+    stacked on the same mount point appear once for every layer.
+    """
+    under = str(under)
+    mounts = []
+
+    with open("/proc/self/mountinfo") as mountinfo:
+        for line in mountinfo:
+            # Spaces (and other special characters) in mount points are octal escaped
+            mount_point = re.sub(r"\\([0-7]{3})", lambda escape: chr(int(escape.group(1), 8)), line.split()[4])
+
+            if mount_point == under or mount_point.startswith(under + "/"):
+                mounts.append(mount_point)
+
+    return sorted(mounts, key=lambda mount_point: mount_point.count("/"), reverse=True)
+
+
+def unmount(mount_point):
+    # Lazy, so that a process we didn't manage to kill doesn't keep the mount (and everything under it) busy
+    subprocess.run(["umount", "--lazy", mount_point], check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def remove_tree(path: Path):
+    def on_error(_, failed_path, exc_info):
+        logging.getLogger("swarm").info(f"Failed to remove {failed_path}: {exc_info[1]}")
+
+    if path.exists():
+        shutil.rmtree(path, onerror=on_error)
+
+
+def remove_files(paths):
+    for path in paths:
+        Path(path).unlink(missing_ok=True)
+
+
+def tear_down_directory(directory: Path):
+    """
+    Kill every process that uses the directory, unmount everything under it, then delete it
+    """
+    # With a trailing slash, so that tearing down swarm-1234-1 doesn't kill the processes of swarm-1234-10
+    kill_processes(find_processes(f"{directory}/"))
+
+    for mount_point in find_mounts(directory):
+        unmount(mount_point)
+
+    remove_tree(directory)
+
+
+class SwarmTeardown:
+    """
+    Finds everything that belongs to previous swarms - every swarm identifier other than the one to
+    keep - and cleans it all up, phase by phase, with up to `parallelism` concurrent operations within
+    each phase.
+    """
+
+    def __init__(
+        self, executor: SwarmExecutor, swarm_root: Path, keep_identifier=None, parallelism=default_parallelism
+    ):
+        self.executor = executor
+        self.swarm_root = swarm_root
+        self.keep_identifier = keep_identifier
+        self.parallelism = parallelism
+        self.logging = logging.getLogger("swarm")
+
+        self.phases = dict(
+            zip(
+                teardown_phases,
+                (
+                    self.kill_processes,
+                    self.unmount,
+                    self.remove_storage,
+                    self.remove_log_files,
+                    self.delete_service_accounts,
+                    self.delete_namespaces,
+                ),
+            )
+        )
+
+    def is_previous_identifier(self, identifier):
+        return swarm_identifier_pattern.match(identifier) is not None and identifier != self.keep_identifier
+
+    def owned_by_previous_swarm(self, name):
+        owner = swarm_owned_name_pattern.match(name)
+        return owner is not None and self.is_previous_identifier(owner.group(1))
+
+    def previous_swarm_dirs(self):
+        if not self.swarm_root.exists():
+            return []
+
+        return [path for path in self.swarm_root.iterdir() if self.is_previous_identifier(path.name)]
+
+    def parallel(self, function, items):
+        with ThreadPoolExecutor(max_workers=self.parallelism) as pool:
+            # Consumed, so that errors are raised
+            return list(pool.map(function, items))
+
+    def remove_containers(self):
+        """
+        Stop and remove the containers of previous swarms (each cluster's controller and each agent's containers),
+        with the container configuration each of them was created with
+        """
+        container_configs = []
+        for swarm_dir in self.previous_swarm_dirs():
+            # Cluster directories, and the agent directories within them
+            for pattern in ("*/container_config_*", "*/*/container_config_*"):
+                for container_config in swarm_dir.glob(pattern):
+                    storage_config = next(container_config.parent.glob("container_storage_config_*"), None)
+                    if storage_config is not None:
+                        container_configs.append((container_config, storage_config))
+
+        def remove(configs):
+            container_config, storage_config = configs
+            subprocess.run(
+                ["podman", "rm", "--all", "--force"],
+                env={
+                    **os.environ,
+                    "CONTAINERS_CONF": str(container_config),
+                    "CONTAINERS_STORAGE_CONF": str(storage_config),
+                },
+                check=False,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+
+        self.parallel(remove, container_configs)
+
+    def kill_processes(self):
+        self.remove_containers()
+
+        exclude = f"{self.swarm_root / self.keep_identifier}/" if self.keep_identifier is not None else None
+        pids = find_processes(f"{self.swarm_root}/swarm-", exclude=exclude)
+
+        # Processes within controller containers don't necessarily mention the swarm directory, but they have their
+        # cluster's reboot marker (see Cluster.dry_reboot_marker), which is named after their swarm, in their
+        # environment
+        exclude = f"/var/log/{self.keep_identifier}-" if self.keep_identifier is not None else None
+        pids.extend(pid for pid in find_processes("/var/log/swarm-", exclude=exclude) if pid not in pids)
+
+        kill_processes(pids)
+
+        return len(pids)
+
+    def unmount(self):
+        previous_swarm_dirs = [str(path) for path in self.previous_swarm_dirs()]
+
+        def previous(mount_point):
+            return any(mount_point == path or mount_point.startswith(path + "/") for path in previous_swarm_dirs)
+
+        # Mount points of the same depth can't be nested in one another, so they're unmounted concurrently,
+        # one depth at a time. Mounts stacked on the same mount point are unmounted one layer after the other
+        by_depth = defaultdict(lambda: defaultdict(int))
+        mount_points = [mount_point for mount_point in find_mounts(self.swarm_root) if previous(mount_point)]
+        for mount_point in mount_points:
+            by_depth[mount_point.count("/")][mount_point] += 1
+
+        def unmount_layers(mount_point_layers):
+            mount_point, layers = mount_point_layers
+            for _ in range(layers):
+                unmount(mount_point)
+
+        for depth in sorted(by_depth, reverse=True):
+            self.parallel(unmount_layers, by_depth[depth].items())
+
+        return len(mount_points)
+
+    def remove_storage(self):
+        swarm_dirs = self.previous_swarm_dirs()
+
+        # Most of the storage is in the per-agent graphroots, so removal is spread over the contents of
+        # the cluster directories, after which whatever remains of the swarm directories is removed
+        units = [
+            unit
+            for swarm_dir in swarm_dirs
+            for cluster_dir in swarm_dir.iterdir()
+            if cluster_dir.is_dir() and not cluster_dir.is_symlink()
+            for unit in cluster_dir.iterdir()
+        ]
+
+        self.parallel(remove_tree, units)
+        self.parallel(remove_tree, swarm_dirs)
+
+        # The journals are kept next to the swarm directories, see Swarm.journal_path
+        remove_files(path for path in self.swarm_root.glob("swarm-*.journal") if self.is_previous_identifier(path.stem))
+
+        return len(swarm_dirs)
+
+    def remove_log_files(self):
+        log_dir = Path("/var/log")
+
+        def owned_by_previous_swarm(path: Path):
+            if path.name.startswith("swarm-"):
+                return self.owned_by_previous_swarm(path.name)
+
+            # Cluster hosts files have random names, but they list the hostnames of their cluster. Files that can't
+            # be told apart (e.g. still being written by the current swarm) are kept
+            try:
+                hosts = json.loads(path.read_text())
+            except (OSError, ValueError):
+                return False
+
+            return (
+                isinstance(hosts, list)
+                and len(hosts) > 0
+                and all(
+                    isinstance(host, dict)
+                    and isinstance(host.get("hostname"), str)
+                    and self.owned_by_previous_swarm(host["hostname"])
+                    for host in hosts
+                )
+            )
+
+        def remove_if_previous(path: Path):
+            if not owned_by_previous_swarm(path):
+                return False
+
+            path.unlink(missing_ok=True)
+            return True
+
+        candidates = [
+            *log_dir.glob("agent_cluster_hosts_*"),
+            *log_dir.glob("controller_cluster_hosts_*"),
+            *log_dir.glob("swarm-*-cluster_fake_reboot_marker"),
+        ]
+
+        return sum(self.parallel(remove_if_previous, candidates))
+
+    def oc_names(self, *get_args):
+        items = json.loads(self.executor.check_output(["oc", "get", *get_args, "-ojson"]))["items"]
+        return [item["metadata"]["name"] for item in items]
+
+    def oc_delete(self, kind, names, *delete_args):
+        chunks = [names[i : i + delete_chunk_size] for i in range(0, len(names), delete_chunk_size)]
+
+        self.parallel(
+            lambda chunk: self.executor.check_call(["oc", "delete", kind, "--ignore-not-found", *delete_args, *chunk]),
+            chunks,
+        )
+
+        return len(names)
+
+    def delete_service_accounts(self):
+        service_accounts = [
+            name for name in self.oc_names("serviceaccount", "--namespace=default") if self.is_previous_identifier(name)
+        ]
+        cluster_role_bindings = [
+            name for name in self.oc_names("clusterrolebinding") if self.is_previous_identifier(name)
+        ]
+
+        return self.oc_delete("serviceaccount", service_accounts, "--namespace=default") + self.oc_delete(
+            "clusterrolebinding", cluster_role_bindings
+        )
+
+    def delete_namespaces(self):
+        # Deleting a namespace deletes everything in it, but cluster image sets are cluster scoped. Deletion
+        # happens in the background on the hub, there's no point in waiting for it
+        namespaces = [name for name in self.oc_names("namespace") if self.owned_by_previous_swarm(name)]
+        cluster_image_sets = [name for name in self.oc_names("clusterimageset") if self.owned_by_previous_swarm(name)]
+
+        return self.oc_delete("namespace", namespaces, "--wait=false") + self.oc_delete(
+            "clusterimageset", cluster_image_sets, "--wait=false"
+        )
+
+    def run_phase(self, phase):
+        started = time.monotonic()
+        count = self.phases[phase]()
+        duration = time.monotonic() - started
+
+        teardown_phase_durations.observe(duration, phase)
+        self.logging.info(f"Tearing down previous swarms' {phase} ({count} removed) took {duration:.1f} seconds")
+
+        return duration
+
+    def run(self, phases=teardown_phases):
+        """
+        Run the given phases in order, returns how long each of them took
+        """
+        return {phase: self.run_phase(phase) for phase in teardown_phases if phase in phases}
+
+
+@plac.opt("parallelism", "Max concurrent teardown operations within each phase", type=int)
+@plac.opt("keep", "A swarm identifier to leave alone")
+@plac.pos("phases", f"Phases to run, all of them by default. Any of: {', '.join(teardown_phases)}")
+def main(parallelism=default_parallelism, keep=None, *phases):
+    # Imported here rather than at the top, as swarm itself (through cluster) imports this module
+    from swarm import global_swarm_directory
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    unknown_phases = set(phases) - set(teardown_phases)
+    assert not unknown_phases, f"Unknown teardown phases {unknown_phases}, choose from {teardown_phases}"
+
+    swarm_teardown = SwarmTeardown(
+        SwarmExecutor(logging.getLogger("swarm")), global_swarm_directory, keep_identifier=keep, parallelism=parallelism
+    )
+    durations = swarm_teardown.run(phases or teardown_phases)
+
+    for phase, duration in durations.items():
+        print(f"{phase:<20}{duration:>10.1f}s")
+    print(f"{'total':<20}{sum(durations.values()):>10.1f}s")
+
+
+if __name__ == "__main__":
+    try:
+        plac.call(main)
+    except Exception as e:
+        logging.exception(e)
+        sys.exit(1)
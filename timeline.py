@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import contextvars
+import json
+import logging
+import sys
+import threading
+import time
+from pathlib import Path
+
+import plac
+
+# The track (see Timeline) of the state machine whose state is currently running, so that commands it
+# executes can be placed next to it. State machines set it whenever they run a state
+current_track = contextvars.ContextVar("current_track", default=None)
+
+
+class Timeline:
+    """
+    Records every state machine state and every command the swarm executes as spans on a timeline, for
+    seeing where the time of a run goes (see main --timeline).
+
+    Events are written as they happen, one per line, straight to a JSON lines file, so recording costs
+    nothing but a write per event, and it survives the swarm process dying. Every line is already a Chrome
+    trace event (https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU), with
+    timestamps in microseconds of time.monotonic() since the timeline was started. See export_chrome_trace
+    for turning the file into a trace that Perfetto (https://ui.perfetto.dev) or chrome://tracing open.
+
+    Events are placed on tracks, which are (group, name) pairs - every cluster is a group (a trace
+    "process") with one track (a trace "thread") for the cluster itself and one for each of its agents.
+    Commands go on a track of their own next to the track of the machine that executed them, as they
+    don't necessarily nest within its states.
+    """
+
+    def __init__(self):
+        self.file = None
+        self.origin = None
+        self.lock = threading.Lock()
+
+        # group -> pid, (group, name) -> tid, assigned as they're first seen
+        self.groups = {}
+        self.tracks = {}
+
+    @property
+    def enabled(self):
+        return self.file is not None
+
+    def start(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.origin = time.monotonic()
+        self.file = path.open("w", buffering=1)
+
+    def stop(self):
+        with self.lock:
+            file, self.file = self.file, None
+
+        if file is not None:
+            file.close()
+
+    def timestamp(self, monotonic):
+        return round((monotonic - self.origin) * 1e6)
+
+    def track_ids(self, track):
+        """
+        The (pid, tid) of the given track, declaring it (and its group) first if it's new. Must be called with the
+        lock held
+        """
+        group, name = track
+        ids = self.tracks.get(track)
+        if ids is not None:
+            return ids
+
+        if group not in self.groups:
+            pid = self.groups[group] = len(self.groups) + 1
+            self.write({"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": group}})
+            self.write({"name": "process_sort_index", "ph": "M", "pid": pid, "tid": 0, "args": {"sort_index": pid}})
+
+        ids = self.tracks[track] = (self.groups[group], len(self.tracks) + 1)
+        self.write({"name": "thread_name", "ph": "M", "pid": ids[0], "tid": ids[1], "args": {"name": name}})
+
+        return ids
+
+    def write(self, event):
+        self.file.write(json.dumps(event, separators=(",", ":")) + "\n")
+
+    def record(self, track, event):
+        with self.lock:
+            if self.file is None:
+                return
+
+            pid, tid = self.track_ids(track)
+            self.write({**event, "pid": pid, "tid": tid})
+
+    def span(self, track, name, category, started, ended, args=None):
+        """
+        Something that started and ended at the given time.monotonic() times
+        """
+        if not self.enabled:
+            return
+
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": self.timestamp(started),
+            "dur": self.timestamp(ended) - self.timestamp(started),
+        }
+        if args:
+            event["args"] = args
+
+        self.record(track, event)
+
+    def instant(self, track, name, category, args=None):
+        """
+        Something that happened right now
+        """
+        if not self.enabled:
+            return
+
+        event = {"name": name, "cat": category, "ph": "i", "s": "t", "ts": self.timestamp(time.monotonic())}
+        if args:
+            event["args"] = args
+
+        self.record(track, event)
+
+    def command(self, track, command, started, ended, args=None):
+        """
+        A command executed by the state machine with the given track (the current_track when the command started)
+        """
+        group, name = track = track or ("Swarm", "Swarm")
+
+        # Declared first, so that the machine's own track comes before its commands track
+        with self.lock:
+            if self.file is not None:
+                self.track_ids(track)
+
+        self.span((group, f"{name} commands"), command, "command", started, ended, args)
+
+
+# The swarm process' timeline, disabled unless started
+recorder = Timeline()
+
+
+def export_chrome_trace(events_path: Path, trace_path: Path):
+    """
+    Stream a recorded timeline into a Chrome trace JSON file. Lines cut short by a crash are skipped
+    """
+    with events_path.open() as events_file, trace_path.open("w") as trace_file:
+        trace_file.write('{"displayTimeUnit":"ms","traceEvents":[\n')
+
+        separator = ""
+        for line in events_file:
+            try:
+                json.loads(line)
+            except ValueError:
+                continue
+
+            trace_file.write(separator + line.rstrip("\n"))
+            separator = ",\n"
+
+        trace_file.write("\n]}\n")
+
+
+@plac.pos("events", "A timeline recorded by the swarm, see main --timeline", type=Path)
+@plac.pos("trace", "Where to write the Chrome trace. Defaults to the timeline with a .trace.json suffix", type=Path)
+def main(events, trace=None):
+    trace = trace or events.with_suffix(".trace.json")
+    export_chrome_trace(events, trace)
+    print(f"Open {trace} in https://ui.perfetto.dev or chrome://tracing")
+
+
+if __name__ == "__main__":
+    try:
+        plac.call(main)
+    except Exception as e:
+        logging.exception(e)
+        sys.exit(1)